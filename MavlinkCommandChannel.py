@@ -0,0 +1,246 @@
+import time
+import struct
+import logging
+import threading
+from collections import deque
+from pymavlink import mavutil
+
+from Metrics import registry
+
+
+# Messages the command channel needs decoded.
+COMMAND_CHANNEL_MESSAGE_IDS = (mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT, mavutil.mavlink.MAVLINK_MSG_ID_COMMAND_ACK,
+                               mavutil.mavlink.MAVLINK_MSG_ID_PARAM_VALUE)
+# COMMAND_ARM_DISARM param2 that disarms even in the air.
+FORCE_DISARM_MAGIC = 21196
+
+
+class MavlinkCommandRequest:
+    """A PARAM_SET or COMMAND_LONG sent by a MavlinkCommandChannel, completed by the matching PARAM_VALUE or COMMAND_ACK."""
+
+    def __init__(self, key, name, send, encodedValue=None):
+        """
+        Args:
+            key (tuple): Identifies the acknowledgement, the parameter name or the command id.
+            name (str): Name used in the log.
+            send (callable): Called as send(mav, attempt) to send the request with a pymavlink encoder.
+            encodedValue (bytes, optional): The parameter value as PX4 reports it back when it is accepted.
+        """
+        self.key = key
+        self.name = name
+        self.send = send
+        self.encodedValue = encodedValue
+        self.accepted = False
+        # The MAV_RESULT of a command, or the value PX4 reported for a parameter. None when it timed out.
+        self.result = None
+        self.attempts = 0
+        self.sendTime = 0.0
+        self.submitTime = time.monotonic()
+        self._done = threading.Event()
+
+    def IsDone(self):
+        return self._done.is_set()
+
+    def Wait(self, timeout=None):
+        """
+        Waits until the request is acknowledged, rejected or given up on.
+        Returns:
+            bool: True if PX4 accepted it.
+        """
+        self._done.wait(timeout)
+        return self.accepted
+
+    def _Complete(self, accepted, result):
+        self.accepted = accepted
+        self.result = result
+        self._done.set()
+
+
+class MavlinkCommandChannel:
+    """
+    Sends parameters and commands to PX4 over the MAVLink connection and tracks their acknowledgement: PARAM_SET is
+    answered with PARAM_VALUE and COMMAND_LONG with COMMAND_ACK. Requests can be submitted from any thread and
+    waited on; the sending, matching and retrying happens in Update, called with every received message and
+    periodically without one by whichever loop owns the connection.
+
+    Neither acknowledgement carries a request id, so at most one request per parameter name and per command id is in
+    flight. Requests with different keys are pipelined, requests with the same key go out in submission order.
+    """
+
+    ACK_TIMEOUT = 0.5
+    MAX_ATTEMPTS = 3
+    MAX_IN_FLIGHT = 8
+
+    def __init__(self, vehicleId=0):
+        """
+        Args:
+            vehicleId (int): Vehicle id used in the metrics and the log.
+        """
+        self._vehicleId = vehicleId
+        self._targetSystem = None
+        self._targetComponent = None
+        self._mutex = threading.Lock()
+        self._queuedRequests = deque()
+        self._inFlightRequests = {}
+        self._closed = False
+        self._ackHistogram = registry.Histogram("avcimaster_mavlink_command_seconds",
+                                                "Time from submitting a MAVLink command or parameter to its acknowledgement",
+                                                vehicle=vehicleId)
+        self._retriesCounter = registry.Counter("avcimaster_mavlink_command_retries_total",
+                                                "MAVLink commands and parameters sent again after an acknowledgement timeout",
+                                                vehicle=vehicleId)
+
+    def SetTarget(self, targetSystem, targetComponent):
+        """Addresses the requests, otherwise the target is taken from the first autopilot heartbeat."""
+        self._targetSystem = targetSystem
+        self._targetComponent = targetComponent
+
+    def GetTarget(self):
+        """Returns the system and component id of the autopilot, or None before its first heartbeat."""
+        if self._targetSystem is None:
+            return None
+        return self._targetSystem, self._targetComponent
+
+    def SetParameter(self, name, value, parameterType=mavutil.mavlink.MAV_PARAM_TYPE_REAL32):
+        """
+        Sets a PX4 parameter. The request is accepted once PX4 reports the new value.
+        Args:
+            name (str): Parameter name, at most 16 characters.
+            value (float): New value, integer types are encoded bytewise as PX4 expects.
+            parameterType (int): MAV_PARAM_TYPE of the parameter.
+
+        Returns:
+            MavlinkCommandRequest: The request to wait on.
+        """
+        if parameterType == mavutil.mavlink.MAV_PARAM_TYPE_REAL32:
+            encodedValue = struct.unpack("<f", struct.pack("<f", value))[0]
+        else:
+            encodedValue = struct.unpack("<f", struct.pack("<i", int(value)))[0]
+        send = lambda mav, attempt: mav.param_set_send(self._targetSystem, self._targetComponent, name.encode("ascii"),
+                                                       encodedValue, parameterType)
+        return self._Submit(MavlinkCommandRequest(("PARAM", name), name, send, struct.pack("<f", encodedValue)))
+
+    def SendCommand(self, command, *params):
+        """
+        Sends a COMMAND_LONG. The request is accepted once PX4 acknowledges it with MAV_RESULT_ACCEPTED.
+        Args:
+            command (int): MAV_CMD id.
+            params (float): Up to seven command parameters, missing ones are 0.
+
+        Returns:
+            MavlinkCommandRequest: The request to wait on.
+        """
+        params = list(params) + [0.0] * (7 - len(params))
+        # The confirmation field counts the retransmissions
+        send = lambda mav, attempt: mav.command_long_send(self._targetSystem, self._targetComponent, command, attempt, *params)
+        return self._Submit(MavlinkCommandRequest(("COMMAND", command), self._GetCommandName(command), send))
+
+    def Update(self, mavlinkConnection, msg=None):
+        """
+        Matches an acknowledgement, sends queued requests and retries or gives up on the timed out ones.
+        Args:
+            mavlinkConnection: Connection the requests are sent on, anything with a pymavlink encoder as .mav.
+            msg: The message just received, or None when called periodically.
+        """
+        now = time.monotonic()
+        if msg is not None:
+            match msg.get_type():
+                case "HEARTBEAT":
+                    if self._targetSystem is None and msg.autopilot != mavutil.mavlink.MAV_AUTOPILOT_INVALID:
+                        self.SetTarget(msg.get_srcSystem(), msg.get_srcComponent())
+                case "COMMAND_ACK":
+                    self._HandleCommandAck(msg, now)
+                case "PARAM_VALUE":
+                    self._HandleParameterValue(msg)
+        if self._targetSystem is None:
+            return
+
+        with self._mutex:
+            for request in list(self._inFlightRequests.values()):
+                if now - request.sendTime < self.ACK_TIMEOUT:
+                    continue
+                if request.attempts >= self.MAX_ATTEMPTS:
+                    logging.error(f"{request.name} was not acknowledged by vehicle {self._vehicleId}.")
+                    del self._inFlightRequests[request.key]
+                    request._Complete(False, None)
+                else:
+                    self._retriesCounter.Increment()
+                    self._Send(mavlinkConnection, request, now)
+
+            for request in list(self._queuedRequests):
+                if len(self._inFlightRequests) >= self.MAX_IN_FLIGHT:
+                    break
+                if request.key in self._inFlightRequests:
+                    continue
+                self._queuedRequests.remove(request)
+                self._inFlightRequests[request.key] = request
+                self._Send(mavlinkConnection, request, now)
+
+    def Close(self):
+        """Gives up on every pending request, so nobody keeps waiting on a closed connection."""
+        with self._mutex:
+            self._closed = True
+            pendingRequests = list(self._inFlightRequests.values()) + list(self._queuedRequests)
+            self._inFlightRequests = {}
+            self._queuedRequests.clear()
+        for request in pendingRequests:
+            request._Complete(False, None)
+
+    def _Submit(self, request):
+        with self._mutex:
+            if not self._closed:
+                self._queuedRequests.append(request)
+                return request
+        request._Complete(False, None)
+        return request
+
+    def _Send(self, mavlinkConnection, request, now):
+        request.sendTime = now
+        try:
+            request.send(mavlinkConnection.mav, request.attempts)
+        except OSError as e:
+            logging.error(f"Error sending {request.name} to vehicle {self._vehicleId}: {e}")
+        request.attempts += 1
+
+    def _HandleCommandAck(self, msg, now):
+        with self._mutex:
+            request = self._inFlightRequests.get(("COMMAND", msg.command))
+            if request is None:
+                return
+            if msg.result == mavutil.mavlink.MAV_RESULT_IN_PROGRESS:
+                # Still running, the command is not sent again while progress keeps being reported
+                request.sendTime = now
+                return
+            del self._inFlightRequests[request.key]
+        accepted = msg.result == mavutil.mavlink.MAV_RESULT_ACCEPTED
+        if not accepted:
+            logging.error(f"{request.name} rejected by vehicle {self._vehicleId}: {self._GetResultName(msg.result)}")
+        self._ackHistogram.Observe(now - request.submitTime)
+        request._Complete(accepted, msg.result)
+
+    def _HandleParameterValue(self, msg):
+        with self._mutex:
+            request = self._inFlightRequests.get(("PARAM", msg.param_id))
+            if request is None:
+                return
+            del self._inFlightRequests[request.key]
+        # A rejected value is answered with the unchanged one
+        accepted = struct.pack("<f", msg.param_value) == request.encodedValue
+        if not accepted:
+            logging.error(f"{request.name} rejected by vehicle {self._vehicleId}, it is {msg.param_value}.")
+        self._ackHistogram.Observe(time.monotonic() - request.submitTime)
+        request._Complete(accepted, msg.param_value)
+
+    @staticmethod
+    def _GetCommandName(command):
+        try:
+            return mavutil.mavlink.enums["MAV_CMD"][command].name
+        except KeyError:
+            return f"MAV_CMD {command}"
+
+    @staticmethod
+    def _GetResultName(result):
+        try:
+            return mavutil.mavlink.enums["MAV_RESULT"][result].name
+        except KeyError:
+            return f"result {result}"
@@ -0,0 +1,287 @@
+import multiprocessing
+import struct
+import time
+import logging
+from multiprocessing import shared_memory
+from pymavlink import mavutil
+
+from MavlinkVehicleState import MavlinkVehicleState
+from MavlinkStreamNegotiator import MavlinkStreamNegotiator, NEGOTIATION_MESSAGE_IDS
+from MavlinkFastReceiver import MavlinkFastReceiver
+
+# Ring header: write sequence (u64), capacity (u64), padded to RING_HEADER_SIZE.
+RING_HEADER = struct.Struct("<QQ")
+RING_HEADER_SIZE = 64
+# Slot sequence, odd while record n is being written (2n + 1) and even once it is complete (2n + 2).
+SLOT_SEQUENCE = struct.Struct("<Q")
+# Vehicle state record, 104 bytes: pose timestamp, simulation time, lat, lon, alt, relative altitude, roll, pitch, yaw,
+# velocity north, east, down, roll, pitch, yaw rate, decode time of the message, flags (RECORD_FLAG_*), system status
+# and landed state (255 when unknown), estimator flags (-1 when unknown), heartbeat and estimator report counts.
+VEHICLE_STATE_RECORD = struct.Struct("<6d10f4Bi2I")
+SLOT_SIZE = SLOT_SEQUENCE.size + VEHICLE_STATE_RECORD.size
+
+RECORD_FLAG_VELOCITY = 1
+RECORD_FLAG_ANGULAR_RATE = 2
+RECORD_FLAG_ARMED = 4
+RECORD_FLAG_POSE_CHANGED = 8
+UNKNOWN_STATUS = 255
+
+
+class VehicleStateRing:
+    """
+    Single-producer ring of vehicle state snapshots in shared memory. Every slot is guarded by its own sequence
+    number, seqlock style, so the reader detects records that were overwritten while or before it read them
+    without any lock shared between the processes.
+    """
+
+    def __init__(self, name=None, capacity=4096):
+        """
+        Args:
+            name (str, optional): Name of an existing ring to attach to. A new ring is created when omitted.
+            capacity (int): Number of slots of a new ring.
+        """
+        if name is None:
+            self._sharedMemory = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + capacity * SLOT_SIZE)
+            self._owner = True
+            RING_HEADER.pack_into(self._sharedMemory.buf, 0, 0, capacity)
+        else:
+            # Processes spawned by multiprocessing share the resource tracker of the creator, which already tracks
+            # the segment, so attaching needs no unregistering here
+            self._sharedMemory = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.name = self._sharedMemory.name
+        self._buffer = self._sharedMemory.buf
+        self._writeSequence, self._capacity = RING_HEADER.unpack_from(self._buffer, 0)
+        self._readSequence = self._writeSequence
+        self.overrunCount = 0
+
+    def Publish(self, state, decodeTime=0.0):
+        """Writes a snapshot of a MavlinkVehicleState as the next record. Producer side only."""
+        sequence = self._writeSequence
+        offset = RING_HEADER_SIZE + (sequence % self._capacity) * SLOT_SIZE
+        pose = state.pose
+        flags = ((RECORD_FLAG_VELOCITY if pose.hasVelocity else 0) | (RECORD_FLAG_ANGULAR_RATE if pose.hasAngularRate else 0) |
+                 (RECORD_FLAG_ARMED if state.armed else 0) | (RECORD_FLAG_POSE_CHANGED if state.poseChanged else 0))
+        SLOT_SEQUENCE.pack_into(self._buffer, offset, 2 * sequence + 1)
+        VEHICLE_STATE_RECORD.pack_into(
+            self._buffer, offset + SLOT_SEQUENCE.size,
+            pose.timestamp, pose.simTime, pose.lat, pose.lon, pose.alt, state.relativeAltitude,
+            pose.roll, pose.pitch, pose.yaw,
+            pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+            pose.rollRate, pose.pitchRate, pose.yawRate, decodeTime, flags,
+            UNKNOWN_STATUS if state.systemStatus is None else state.systemStatus,
+            UNKNOWN_STATUS if state.landedState is None else state.landedState, 0,
+            -1 if state.estimatorFlags is None else state.estimatorFlags,
+            state.heartbeatCount, state.estimatorReportCount)
+        SLOT_SEQUENCE.pack_into(self._buffer, offset, 2 * sequence + 2)
+        self._writeSequence = sequence + 1
+        RING_HEADER.pack_into(self._buffer, 0, self._writeSequence, self._capacity)
+
+    def ReadNext(self, state):
+        """
+        Reads the oldest unread record into a MavlinkVehicleState, straight from shared memory. Records the producer
+        already overwrote are skipped and counted in overrunCount. Consumer side only.
+
+        Returns:
+            float: Decode time of the record in seconds, or None if there is no unread record.
+        """
+        while True:
+            writeSequence = RING_HEADER.unpack_from(self._buffer, 0)[0]
+            if self._readSequence >= writeSequence:
+                return None
+            if writeSequence - self._readSequence > self._capacity:
+                self.overrunCount += writeSequence - self._capacity - self._readSequence
+                self._readSequence = writeSequence - self._capacity
+
+            sequence = self._readSequence
+            offset = RING_HEADER_SIZE + (sequence % self._capacity) * SLOT_SIZE
+            slotSequence = SLOT_SEQUENCE.unpack_from(self._buffer, offset)[0]
+            record = VEHICLE_STATE_RECORD.unpack_from(self._buffer, offset + SLOT_SEQUENCE.size)
+            if slotSequence != 2 * sequence + 2 or SLOT_SEQUENCE.unpack_from(self._buffer, offset)[0] != slotSequence:
+                # Overwritten before or while it was read
+                self.overrunCount += 1
+                self._readSequence += 1
+                continue
+            self._readSequence += 1
+            return self._ApplyRecord(record, state)
+
+    @staticmethod
+    def _ApplyRecord(record, state):
+        pose = state.pose
+        (pose.timestamp, pose.simTime, pose.lat, pose.lon, pose.alt, state.relativeAltitude,
+         pose.roll, pose.pitch, pose.yaw,
+         pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+         pose.rollRate, pose.pitchRate, pose.yawRate, decodeTime, flags,
+         systemStatus, landedState, _, estimatorFlags, state.heartbeatCount, state.estimatorReportCount) = record
+        pose.hasVelocity = bool(flags & RECORD_FLAG_VELOCITY)
+        pose.hasAngularRate = bool(flags & RECORD_FLAG_ANGULAR_RATE)
+        state.armed = bool(flags & RECORD_FLAG_ARMED)
+        state.poseChanged = state.poseChanged or bool(flags & RECORD_FLAG_POSE_CHANGED)
+        state.systemStatus = None if systemStatus == UNKNOWN_STATUS else systemStatus
+        state.landedState = None if landedState == UNKNOWN_STATUS else landedState
+        state.estimatorFlags = None if estimatorFlags < 0 else estimatorFlags
+        return decodeTime
+
+    def Close(self):
+        self._buffer = None
+        self._sharedMemory.close()
+        if self._owner:
+            self._sharedMemory.unlink()
+
+
+def _RunMavlinkDecoder(mavlinkPort, vehicleId, ringName, notifyConnection, stopEvent, selectTimeout, streamRates, suppressUnusedStreams,
+                       fastIngest):
+    """Entry point of the decoder process: receives and decodes MAVLink and publishes every state change."""
+    ring = VehicleStateRing(ringName)
+    state = MavlinkVehicleState(vehicleId)
+    streamNegotiator = None
+    if streamRates or suppressUnusedStreams:
+        streamNegotiator = MavlinkStreamNegotiator(streamRates, suppressUnusedStreams, state.GetMessageTypes(), vehicleId)
+    if fastIngest:
+        mavlinkConnection = MavlinkFastReceiver(mavlinkPort, state)
+        mavlinkConnection.SetDecodedMessageIds(NEGOTIATION_MESSAGE_IDS)
+    else:
+        mavlinkConnection = mavutil.mavlink_connection(f'udp:localhost:{mavlinkPort}')
+    try:
+        while not stopEvent.is_set():
+            if fastIngest:
+                published = _ReceiveFast(mavlinkConnection, state, ring, streamNegotiator, selectTimeout)
+            else:
+                published = _ReceivePymavlink(mavlinkConnection, state, ring, streamNegotiator, selectTimeout)
+            if published:
+                # One wakeup per drained batch, not per record
+                notifyConnection.send_bytes(b"\0")
+            if streamNegotiator is not None:
+                streamNegotiator.Update(mavlinkConnection)
+                if streamNegotiator.IsCompleted():
+                    streamNegotiator = None
+                    if fastIngest:
+                        mavlinkConnection.SetDecodedMessageIds(())
+    except (BrokenPipeError, EOFError, KeyboardInterrupt):
+        pass # Master went away
+    finally:
+        if fastIngest:
+            mavlinkConnection.Close()
+        else:
+            mavlinkConnection.close()
+        ring.Close()
+
+
+def _ReceivePymavlink(mavlinkConnection, state, ring, streamNegotiator, selectTimeout):
+    """Drains the pymavlink connection, or waits for data if it is empty. Returns True if a record was published."""
+    published = False
+    while True:
+        decodeStartTime = time.perf_counter()
+        msg = mavlinkConnection.recv_msg()
+        if msg is None:
+            break
+        if state.HandleMessage(msg):
+            ring.Publish(state, time.perf_counter() - decodeStartTime)
+            state.poseChanged = False
+            published = True
+        if streamNegotiator is not None:
+            streamNegotiator.Update(mavlinkConnection, msg)
+    if not published:
+        mavlinkConnection.select(selectTimeout)
+    return published
+
+
+def _ReceiveFast(mavlinkFastReceiver, state, ring, streamNegotiator, selectTimeout):
+    """Waits for and processes one batch of datagrams on the fast receiver. Returns True if a record was published."""
+    publishedCount = 0
+
+    def PublishState():
+        nonlocal publishedCount
+        ring.Publish(state)
+        state.poseChanged = False
+        publishedCount += 1
+
+    messageCallback = None
+    if streamNegotiator is not None:
+        messageCallback = lambda messageType, msg: streamNegotiator.Update(mavlinkFastReceiver, msg, messageType)
+    mavlinkFastReceiver.Receive(selectTimeout, PublishState, messageCallback)
+    return publishedCount > 0
+
+
+class MavlinkDecoderProcess:
+    """
+    Receives and decodes the MAVLink stream of a vehicle in a separate process, so decoding neither competes for
+    the GIL with the controller threads nor jitters with their load. Decoded state snapshots are published into a
+    VehicleStateRing in shared memory, and the master is woken once per drained batch.
+    """
+
+    STOP_TIMEOUT = 2.0
+    # How often the decoder process checks the stop event while no data arrives.
+    SELECT_TIMEOUT = 0.1
+
+    def __init__(self, mavlinkPort, vehicleId=0, ringCapacity=4096, streamRates=None, suppressUnusedStreams=False, fastIngest=False):
+        """
+        Args:
+            mavlinkPort (int): UDP port PX4 sends MAVLink to.
+            vehicleId (int): Vehicle id stored in the decoded poses.
+            ringCapacity (int): Number of state snapshots the ring holds.
+            streamRates (dict, optional): Message rates the decoder process negotiates, see MavlinkStreamNegotiator.
+            suppressUnusedStreams (bool): Let the decoder process disable the streams that are not used.
+            fastIngest (bool): Parse with MavlinkFastReceiver instead of pymavlink.
+        """
+        self._mavlinkPort = mavlinkPort
+        self._vehicleId = vehicleId
+        self._streamRates = dict(streamRates or {})
+        self._suppressUnusedStreams = suppressUnusedStreams
+        self._fastIngest = fastIngest
+        self._ring = VehicleStateRing(capacity=ringCapacity)
+        # Forking a process with running threads is unsafe, the decoder starts from a fresh interpreter
+        self._context = multiprocessing.get_context("spawn")
+        self._notifyReader, self._notifyWriter = self._context.Pipe(duplex=False)
+        self._stopEvent = self._context.Event()
+        self._process = None
+
+    def Start(self):
+        process = self._context.Process(
+            target=_RunMavlinkDecoder,
+            args=(self._mavlinkPort, self._vehicleId, self._ring.name, self._notifyWriter, self._stopEvent, self.SELECT_TIMEOUT,
+                  self._streamRates, self._suppressUnusedStreams, self._fastIngest),
+            daemon=True)
+        process.start()
+        # Only a started process is joined by Stop
+        self._process = process
+
+    def IsRunning(self):
+        return self._process is not None and self._process.is_alive()
+
+    def Receive(self, state, timeout, callback):
+        """
+        Waits up to timeout seconds for the decoder, then applies every published snapshot to a state in order,
+        calling callback(decodeTime) after each one.
+
+        Returns:
+            int: Number of snapshots applied.
+        """
+        if not self._notifyReader.poll(timeout):
+            return 0
+        while self._notifyReader.poll():
+            self._notifyReader.recv_bytes()
+        count = 0
+        while True:
+            decodeTime = self._ring.ReadNext(state)
+            if decodeTime is None:
+                return count
+            count += 1
+            callback(decodeTime)
+
+    def GetOverrunCount(self):
+        """Returns the number of snapshots overwritten before the master read them."""
+        return self._ring.overrunCount
+
+    def Stop(self):
+        self._stopEvent.set()
+        if self._process is not None:
+            self._process.join(self.STOP_TIMEOUT)
+            if self._process.is_alive():
+                logging.error(f"MAVLink decoder process of vehicle {self._vehicleId} did not stop, killing it.")
+                self._process.kill()
+                self._process.join()
+            self._process = None
+        self._notifyReader.close()
+        self._notifyWriter.close()
+        self._ring.Close()
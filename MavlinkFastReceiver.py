@@ -0,0 +1,224 @@
+import socket
+import select
+import struct
+import binascii
+import logging
+from pymavlink import mavutil
+
+MAVLINK_V1_MAGIC = 0xFE
+MAVLINK_V2_MAGIC = 0xFD
+# Header plus checksum bytes around the payload.
+MAVLINK_V1_OVERHEAD = 8
+MAVLINK_V2_OVERHEAD = 12
+MAVLINK_V2_INCOMPAT_SIGNED = 0x01
+MAVLINK_V2_SIGNATURE_SIZE = 13
+MAVLINK_MAX_PAYLOAD_SIZE = 255
+# Every byte value with its bit order reversed.
+BIT_REVERSED_BYTES = bytes(int(f"{value:08b}"[::-1], 2) for value in range(256))
+
+# Payload layouts in MAVLink wire order, largest fields first.
+GLOBAL_POSITION_INT_PAYLOAD = struct.Struct("<IiiiihhhH") # time_boot_ms, lat, lon, alt, relative_alt, vx, vy, vz, hdg
+ATTITUDE_PAYLOAD = struct.Struct("<Iffffff") # time_boot_ms, roll, pitch, yaw, rollspeed, pitchspeed, yawspeed
+HEARTBEAT_PAYLOAD = struct.Struct("<IBBBBB") # custom_mode, type, autopilot, base_mode, system_status, mavlink_version
+EXTENDED_SYS_STATE_PAYLOAD = struct.Struct("<BB") # vtol_state, landed_state
+ESTIMATOR_STATUS_PAYLOAD = struct.Struct("<Q8fH") # time_usec, 8 ratios and accuracies, flags
+EKF_STATUS_REPORT_PAYLOAD = struct.Struct("<5fH") # 5 variances, flags
+
+
+def ComputeMavlinkChecksum(data, crcExtra):
+    """
+    Computes the MAVLink X.25 checksum of a packet. X.25 is CRC-CCITT with reflected bits, so it is computed by
+    binascii.crc_hqx over the bit-reversed bytes instead of byte by byte in Python.
+
+    Args:
+        data (bytes): Packet bytes after the magic, up to the end of the payload.
+        crcExtra (int): Seed byte of the message definition.
+
+    Returns:
+        int: The checksum as sent after the payload.
+    """
+    crc = binascii.crc_hqx(data.translate(BIT_REVERSED_BYTES), 0xFFFF)
+    crc = binascii.crc_hqx(BIT_REVERSED_BYTES[crcExtra:crcExtra + 1], crc)
+    return (BIT_REVERSED_BYTES[crc & 0xFF] << 8) | BIT_REVERSED_BYTES[crc >> 8]
+
+
+class MavlinkFastReceiver:
+    """
+    MAVLink ingest that bypasses pymavlink for the messages the vehicle state is built from. Datagrams are read in
+    bulk, only the MAVLink v1/v2 header of each packet is parsed for its message id, and the payloads of the
+    state messages are unpacked with precompiled layouts straight into a MavlinkVehicleState. Packets of other
+    messages are skipped without decoding, unless their id is in the fully decoded set, which is handed to pymavlink.
+
+    The checksum, seeded with the crc_extra of the message definition, is verified for every packet that is applied
+    to the state or fully decoded, so a packet built from a different message definition is never applied.
+    Skipped packets are not verified.
+    """
+
+    RECEIVE_BUFFER_SIZE = 65536
+    RECEIVE_SOCKET_BUFFER_SIZE = 1 << 20
+    MAX_DATAGRAMS_PER_READ = 256
+
+    def __init__(self, port, vehicleState, host="127.0.0.1"):
+        """
+        Args:
+            port (int): UDP port PX4 sends MAVLink to.
+            vehicleState (MavlinkVehicleState): State the messages are applied to.
+            host (str): Address to listen on.
+        """
+        self._vehicleState = vehicleState
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_SOCKET_BUFFER_SIZE)
+        self._socket.bind((host, port))
+        self._socket.setblocking(False)
+        self._buffer = bytearray(self.RECEIVE_BUFFER_SIZE)
+        # Payloads are zero-extended here when MAVLink v2 truncated their trailing zero bytes
+        self._payloadBuffer = bytearray(MAVLINK_MAX_PAYLOAD_SIZE)
+        self._peerAddress = None
+        self._telemetryRecorder = None
+        self._decodedMessageIds = frozenset()
+        self._payloadHandlers = {
+            mavutil.mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT: (GLOBAL_POSITION_INT_PAYLOAD, self._ApplyGlobalPositionInt),
+            mavutil.mavlink.MAVLINK_MSG_ID_ATTITUDE: (ATTITUDE_PAYLOAD, self._ApplyAttitude),
+            mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT: (HEARTBEAT_PAYLOAD, self._ApplyHeartbeat),
+            mavutil.mavlink.MAVLINK_MSG_ID_EXTENDED_SYS_STATE: (EXTENDED_SYS_STATE_PAYLOAD, self._ApplyExtendedSysState),
+            mavutil.mavlink.MAVLINK_MSG_ID_ESTIMATOR_STATUS: (ESTIMATOR_STATUS_PAYLOAD, self._ApplyEstimatorStatus),
+            mavutil.mavlink.MAVLINK_MSG_ID_EKF_STATUS_REPORT: (EKF_STATUS_REPORT_PAYLOAD, self._ApplyEstimatorStatus),
+        }
+        self._messageTypes = {messageId: messageClass.msgname for messageId, messageClass in mavutil.mavlink.mavlink_map.items()}
+        self._crcExtras = {messageId: messageClass.crc_extra for messageId, messageClass in mavutil.mavlink.mavlink_map.items()}
+        # Encoder for the messages sent back to PX4, with the pymavlink connection defaults
+        self.mav = mavutil.mavlink.MAVLink(self, srcSystem=255, srcComponent=0)
+        self.messageCount = 0
+        self.skippedByteCount = 0
+        self.invalidChecksumCount = 0
+
+    def SetDecodedMessageIds(self, messageIds):
+        """Selects the message ids that are also fully decoded with pymavlink for the message callback."""
+        self._decodedMessageIds = frozenset(messageIds)
+
+    def SetTelemetryRecorder(self, telemetryRecorder):
+        """Records every received frame to a TelemetryRecorder, None stops recording."""
+        self._telemetryRecorder = telemetryRecorder
+
+    def write(self, buffer):
+        """Sends an encoded message to the address the last datagram came from. Named for the pymavlink encoder."""
+        if self._peerAddress is not None:
+            self._socket.sendto(buffer, self._peerAddress)
+
+    def Receive(self, timeout, stateCallback, messageCallback=None):
+        """
+        Waits up to timeout seconds for datagrams and processes every packet they contain.
+
+        Args:
+            timeout (float): Maximum wait in seconds.
+            stateCallback (callable): Called after every message applied to the vehicle state.
+            messageCallback (callable, optional): Called as messageCallback(messageType, msg) for every packet,
+                msg is the pymavlink message for the fully decoded ids and None otherwise.
+
+        Returns:
+            int: Number of packets processed.
+        """
+        if not select.select((self._socket,), (), (), timeout)[0]:
+            return 0
+        messageCount = self.messageCount
+        for _ in range(self.MAX_DATAGRAMS_PER_READ):
+            try:
+                size, self._peerAddress = self._socket.recvfrom_into(self._buffer)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logging.error(f"Error receiving MAVLink: {e}")
+                break
+            self._ParseDatagram(size, stateCallback, messageCallback)
+        return self.messageCount - messageCount
+
+    def _ParseDatagram(self, size, stateCallback, messageCallback):
+        buffer = self._buffer
+        offset = 0
+        while offset < size:
+            magic = buffer[offset]
+            if magic == MAVLINK_V2_MAGIC and size - offset >= MAVLINK_V2_OVERHEAD:
+                payloadSize = buffer[offset + 1]
+                messageId = buffer[offset + 7] | (buffer[offset + 8] << 8) | (buffer[offset + 9] << 16)
+                payloadOffset = offset + 10
+                packetSize = MAVLINK_V2_OVERHEAD + payloadSize
+                if buffer[offset + 2] & MAVLINK_V2_INCOMPAT_SIGNED:
+                    packetSize += MAVLINK_V2_SIGNATURE_SIZE
+            elif magic == MAVLINK_V1_MAGIC and size - offset >= MAVLINK_V1_OVERHEAD:
+                payloadSize = buffer[offset + 1]
+                messageId = buffer[offset + 5]
+                payloadOffset = offset + 6
+                packetSize = MAVLINK_V1_OVERHEAD + payloadSize
+            else:
+                # Not at a packet start, resynchronize on the next byte
+                self.skippedByteCount += 1
+                offset += 1
+                continue
+            if offset + packetSize > size:
+                self.skippedByteCount += size - offset
+                return
+
+            payloadHandler = self._payloadHandlers.get(messageId)
+            decoded = messageId in self._decodedMessageIds
+            if (payloadHandler is not None or decoded) and not self._IsChecksumValid(offset, payloadOffset + payloadSize, messageId):
+                offset += packetSize
+                continue
+
+            self.messageCount += 1
+            if self._telemetryRecorder is not None:
+                self._telemetryRecorder.RecordMavlinkFrame(messageId, bytes(buffer[offset:offset + packetSize]))
+            if payloadHandler is not None:
+                layout, apply = payloadHandler
+                if payloadSize >= layout.size:
+                    apply(layout.unpack_from(buffer, payloadOffset))
+                else:
+                    payloadBuffer = self._payloadBuffer
+                    payloadBuffer[:layout.size] = bytes(layout.size)
+                    payloadBuffer[:payloadSize] = buffer[payloadOffset:payloadOffset + payloadSize]
+                    apply(layout.unpack_from(payloadBuffer))
+                stateCallback()
+            if messageCallback is not None:
+                msg = None
+                if decoded:
+                    msg = self._Decode(buffer[offset:offset + packetSize])
+                messageCallback(self._messageTypes.get(messageId, "UNKNOWN"), msg)
+            offset += packetSize
+
+    def _IsChecksumValid(self, offset, checksumOffset, messageId):
+        buffer = self._buffer
+        checksum = buffer[checksumOffset] | (buffer[checksumOffset + 1] << 8)
+        if checksum == ComputeMavlinkChecksum(buffer[offset + 1:checksumOffset], self._crcExtras[messageId]):
+            return True
+        self.invalidChecksumCount += 1
+        if self.invalidChecksumCount == 1:
+            logging.error(f"Dropped MAVLink packet with invalid checksum, message id {messageId}. Further ones are only counted.")
+        return False
+
+    def _Decode(self, packet):
+        try:
+            return self.mav.decode(packet)
+        except Exception as e:
+            logging.error(f"Error decoding MAVLink packet: {e}")
+            return None
+
+    def _ApplyGlobalPositionInt(self, values):
+        timeBootMs, lat, lon, alt, relativeAlt, vx, vy, vz, _ = values
+        self._vehicleState.ApplyGlobalPosition(lat, lon, alt, relativeAlt, vx, vy, vz, timeBootMs)
+
+    def _ApplyAttitude(self, values):
+        timeBootMs, roll, pitch, yaw, rollSpeed, pitchSpeed, yawSpeed = values
+        self._vehicleState.ApplyAttitude(roll, pitch, yaw, rollSpeed, pitchSpeed, yawSpeed, timeBootMs)
+
+    def _ApplyHeartbeat(self, values):
+        _, _, autopilot, baseMode, systemStatus, _ = values
+        self._vehicleState.ApplyHeartbeat(autopilot, baseMode, systemStatus)
+
+    def _ApplyExtendedSysState(self, values):
+        self._vehicleState.ApplyLandedState(values[1])
+
+    def _ApplyEstimatorStatus(self, values):
+        self._vehicleState.ApplyEstimatorFlags(values[-1])
+
+    def Close(self):
+        self._socket.close()
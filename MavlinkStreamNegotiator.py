@@ -0,0 +1,192 @@
+import time
+import logging
+from enum import Enum
+from pymavlink import mavutil
+
+from Metrics import registry
+
+
+# Messages the negotiator needs decoded, the others it only counts.
+NEGOTIATION_MESSAGE_IDS = (mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT, mavutil.mavlink.MAVLINK_MSG_ID_COMMAND_ACK)
+
+
+class MavlinkStreamNegotiator:
+    """
+    Requests MAVLink message rates from PX4 with MAV_CMD_SET_MESSAGE_INTERVAL, optionally disables the streams
+    nobody uses, and then measures and reports the rates that actually arrive.
+
+    Everything happens from Update, called with every received message and periodically without one, so it runs in
+    whichever loop owns the MAVLink connection. Negotiation starts with the first vehicle heartbeat.
+    """
+
+    class Phase(Enum):
+        WAITING_HEARTBEAT = 0
+        REQUESTING = 1
+        MEASURING = 2
+        COMPLETED = 3
+
+    # Messages that are not periodic streams, or that must keep arriving, and are never disabled.
+    PROTECTED_MESSAGE_TYPES = frozenset({"HEARTBEAT", "COMMAND_ACK", "COMMAND_LONG", "PARAM_VALUE", "STATUSTEXT",
+                                         "TIMESYNC", "BAD_DATA"})
+    # PX4 acknowledges every SET_MESSAGE_INTERVAL, requests are sent one at a time since the ack does not name the message.
+    ACK_TIMEOUT = 0.5
+    MAX_ATTEMPTS = 3
+    # Window over which the received rates are measured after the requests are acknowledged.
+    MEASUREMENT_WINDOW = 2.0
+    # A stream arriving below this fraction of its requested rate is reported as not achieved.
+    RATE_TOLERANCE = 0.9
+
+    def __init__(self, requestedRates, suppressUnused=False, usedMessageTypes=(), vehicleId=0):
+        """
+        Args:
+            requestedRates (dict): MAVLink message name to rate in Hz, 0 disables the stream.
+            suppressUnused (bool): Disable every other stream that arrives during the first measurement.
+            usedMessageTypes (iterable): Message names that are used and never disabled.
+            vehicleId (int): Vehicle id used in the metrics and the report.
+        """
+        self._requestedRates = dict(requestedRates)
+        self._suppressUnused = suppressUnused
+        self._keptMessageTypes = self.PROTECTED_MESSAGE_TYPES | set(usedMessageTypes) | set(self._requestedRates)
+        self._vehicleId = vehicleId
+        self._mavlinkConnection = None
+        self._targetSystem = 0
+        self._targetComponent = 0
+        self._phase = self.Phase.WAITING_HEARTBEAT
+        self._pendingRequests = []
+        self._requestAttempts = 0
+        self._requestSendTime = 0.0
+        self._requestResults = {}
+        self._suppressedMessageTypes = set()
+        self._messageCounts = {}
+        self._measurementStartTime = 0.0
+        self._measuredRates = {}
+
+    def IsCompleted(self):
+        return self._phase is self.Phase.COMPLETED
+
+    def GetMeasuredRates(self):
+        """Returns the message name to received rate in Hz of the last measurement."""
+        return dict(self._measuredRates)
+
+    def Update(self, mavlinkConnection, msg=None, messageType=None):
+        """
+        Advances the negotiation.
+        Args:
+            mavlinkConnection: Connection the requests are sent on, anything with a pymavlink encoder as .mav.
+            msg: The message just received, or None when called periodically.
+            messageType (str, optional): Type of a message that was received but not decoded, counted only.
+                HEARTBEAT and COMMAND_ACK must be passed decoded.
+        """
+        now = time.monotonic()
+        if msg is not None:
+            messageType = msg.get_type()
+        if messageType is not None:
+            if self._phase is self.Phase.WAITING_HEARTBEAT:
+                if msg is not None and messageType == "HEARTBEAT" and msg.autopilot != mavutil.mavlink.MAV_AUTOPILOT_INVALID:
+                    self._mavlinkConnection = mavlinkConnection
+                    self._targetSystem = msg.get_srcSystem()
+                    self._targetComponent = msg.get_srcComponent()
+                    self._StartRequests(self._requestedRates, now)
+                return
+            self._messageCounts[messageType] = self._messageCounts.get(messageType, 0) + 1
+            if msg is not None and messageType == "COMMAND_ACK" and msg.command == mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+                self._HandleAck(msg.result, now)
+
+        match self._phase:
+            case self.Phase.REQUESTING:
+                if now - self._requestSendTime >= self.ACK_TIMEOUT:
+                    if self._requestAttempts >= self.MAX_ATTEMPTS:
+                        self._CompleteRequest(None, now)
+                    else:
+                        self._SendRequest(now)
+            case self.Phase.MEASURING:
+                if now - self._measurementStartTime >= self.MEASUREMENT_WINDOW:
+                    self._FinishMeasurement(now)
+
+    def _StartRequests(self, rates, now):
+        self._pendingRequests = list(rates.items())
+        if not self._pendingRequests:
+            self._StartMeasurement(now)
+            return
+        self._phase = self.Phase.REQUESTING
+        self._requestAttempts = 0
+        self._SendRequest(now)
+
+    def _SendRequest(self, now):
+        messageName, rate = self._pendingRequests[0]
+        messageId = getattr(mavutil.mavlink, f"MAVLINK_MSG_ID_{messageName}", None)
+        if messageId is None:
+            logging.error(f"Unknown MAVLink message {messageName}, its rate is not requested.")
+            self._CompleteRequest(None, now)
+            return
+        # -1 disables the stream, otherwise the interval is in microseconds
+        interval = -1 if rate == 0 else int(1e6 / rate)
+        try:
+            self._mavlinkConnection.mav.command_long_send(self._targetSystem, self._targetComponent,
+                                                          mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, 0,
+                                                          messageId, interval, 0, 0, 0, 0, 0)
+        except OSError as e:
+            logging.error(f"Error requesting the {messageName} rate of vehicle {self._vehicleId}: {e}")
+        self._requestAttempts += 1
+        self._requestSendTime = now
+
+    def _HandleAck(self, result, now):
+        if self._phase is self.Phase.REQUESTING:
+            self._CompleteRequest(result, now)
+
+    def _CompleteRequest(self, result, now):
+        messageName, _ = self._pendingRequests.pop(0)
+        self._requestResults[messageName] = result
+        if self._pendingRequests:
+            self._requestAttempts = 0
+            self._SendRequest(now)
+        else:
+            self._StartMeasurement(now)
+
+    def _StartMeasurement(self, now):
+        self._phase = self.Phase.MEASURING
+        self._messageCounts = {}
+        self._measurementStartTime = now
+
+    def _FinishMeasurement(self, now):
+        elapsed = now - self._measurementStartTime
+        self._measuredRates = {messageType: count / elapsed for messageType, count in self._messageCounts.items()}
+
+        unusedMessageTypes = {messageType for messageType in self._measuredRates
+                              if messageType not in self._keptMessageTypes and messageType not in self._suppressedMessageTypes}
+        if self._suppressUnused and unusedMessageTypes and not self._suppressedMessageTypes:
+            # Disable the unused streams once, then measure again
+            self._suppressedMessageTypes = unusedMessageTypes
+            self._StartRequests({messageType: 0 for messageType in sorted(unusedMessageTypes)}, now)
+            return
+
+        self._phase = self.Phase.COMPLETED
+        self._Report()
+
+    def _Report(self):
+        for messageType, rate in self._measuredRates.items():
+            registry.Gauge("avcimaster_mavlink_stream_rate_hz", "Measured MAVLink message rate after stream negotiation",
+                           vehicle=self._vehicleId, message=messageType).Set(rate)
+
+        print(f"MAVLink stream rates of vehicle {self._vehicleId}:")
+        for messageName, requestedRate in self._requestedRates.items():
+            measuredRate = self._measuredRates.get(messageName, 0.0)
+            result = self._FormatResult(self._requestResults.get(messageName))
+            achieved = measuredRate >= requestedRate * self.RATE_TOLERANCE if requestedRate > 0 else measuredRate == 0.0
+            print(f"  {messageName}: requested {requestedRate:g} Hz, measured {measuredRate:.1f} Hz, {result}"
+                  f"{'' if achieved else ', NOT ACHIEVED'}")
+        if self._suppressedMessageTypes:
+            remaining = sorted(messageType for messageType in self._suppressedMessageTypes if messageType in self._measuredRates)
+            print(f"  Disabled {len(self._suppressedMessageTypes)} unused streams"
+                  f"{', still arriving: ' + ', '.join(remaining) if remaining else ''}")
+        totalRate = sum(self._measuredRates.values())
+        print(f"  Total {totalRate:.1f} messages/s")
+
+    @staticmethod
+    def _FormatResult(result):
+        if result is None:
+            return "not acknowledged"
+        try:
+            return mavutil.mavlink.enums["MAV_RESULT"][result].name
+        except KeyError:
+            return f"result {result}"
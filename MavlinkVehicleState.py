@@ -0,0 +1,119 @@
+import math
+import time
+from pymavlink import mavutil
+
+from PoseFrame import PoseSample
+
+
+class MavlinkVehicleState:
+    """
+    Latest pose and status of a vehicle, updated in place from its MAVLink messages. Position and attitude go into
+    one reused PoseSample, the status fields are the ones the readiness policies need.
+    """
+
+    def __init__(self, vehicleId=0):
+        """
+        Args:
+            vehicleId (int): Vehicle id stored in the pose sample.
+        """
+        self.vehicleId = vehicleId
+        self.pose = PoseSample()
+        self._messageHandlers = {
+            'GLOBAL_POSITION_INT': self._HandleGlobalPositionInt,
+            'ATTITUDE': self._HandleAttitude,
+            'HEARTBEAT': self._HandleHeartbeat,
+            'EXTENDED_SYS_STATE': self._HandleExtendedSysState,
+            'ESTIMATOR_STATUS': self._HandleEstimatorStatus,
+            'EKF_STATUS_REPORT': self._HandleEstimatorStatus,
+        }
+        self.Reset()
+
+    def Reset(self):
+        self.pose.Reset()
+        self.pose.vehicleId = self.vehicleId
+        self.poseChanged = False
+        self.relativeAltitude = 0.0
+        self.armed = False
+        self.systemStatus = None
+        self.landedState = None
+        self.estimatorFlags = None
+        # Number of heartbeats and estimator reports applied, wrapping at 2^32, to tell fresh reports from old ones
+        self.heartbeatCount = 0
+        self.estimatorReportCount = 0
+
+    def GetMessageTypes(self):
+        """Returns the names of the MAVLink messages the state is built from."""
+        return tuple(self._messageHandlers)
+
+    def HandleMessage(self, msg):
+        """
+        Applies a MAVLink message.
+
+        Returns:
+            bool: True if the message type is used by the state.
+        """
+        handler = self._messageHandlers.get(msg.get_type())
+        if handler is None:
+            return False
+        handler(msg)
+        return True
+
+    def ApplyGlobalPosition(self, lat, lon, alt, relativeAlt, vx, vy, vz, timeBootMs=0):
+        """Applies GLOBAL_POSITION_INT fields in their MAVLink units: degE7, mm, cm/s and ms since PX4 boot."""
+        pose = self.pose
+        pose.timestamp = time.monotonic()
+        if timeBootMs:
+            pose.simTime = timeBootMs / 1e3
+        pose.lat = lat / 1e7
+        pose.lon = lon / 1e7
+        pose.alt = alt / 1e3
+        pose.velocityNorth = vx / 1e2
+        pose.velocityEast = vy / 1e2
+        pose.velocityDown = vz / 1e2
+        pose.hasVelocity = True
+        self.relativeAltitude = relativeAlt / 1e3
+        self.poseChanged = True
+
+    def ApplyAttitude(self, roll, pitch, yaw, rollSpeed, pitchSpeed, yawSpeed, timeBootMs=0):
+        """Applies ATTITUDE fields in their MAVLink units: rad, rad/s and ms since PX4 boot."""
+        pose = self.pose
+        pose.timestamp = time.monotonic()
+        if timeBootMs:
+            pose.simTime = timeBootMs / 1e3
+        pose.roll = math.degrees(roll)
+        pose.pitch = math.degrees(pitch)
+        pose.yaw = math.degrees(yaw)
+        pose.rollRate = math.degrees(rollSpeed)
+        pose.pitchRate = math.degrees(pitchSpeed)
+        pose.yawRate = math.degrees(yawSpeed)
+        pose.hasAngularRate = True
+        self.poseChanged = True
+
+    def ApplyHeartbeat(self, autopilot, baseMode, systemStatus):
+        if autopilot == mavutil.mavlink.MAV_AUTOPILOT_INVALID:
+            return
+        self.armed = bool(baseMode & mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED)
+        self.systemStatus = systemStatus
+        self.heartbeatCount = (self.heartbeatCount + 1) & 0xFFFFFFFF
+
+    def ApplyLandedState(self, landedState):
+        self.landedState = landedState
+
+    def ApplyEstimatorFlags(self, flags):
+        self.estimatorFlags = flags
+        self.estimatorReportCount = (self.estimatorReportCount + 1) & 0xFFFFFFFF
+
+    def _HandleGlobalPositionInt(self, msg):
+        self.ApplyGlobalPosition(msg.lat, msg.lon, msg.alt, msg.relative_alt, msg.vx, msg.vy, msg.vz, msg.time_boot_ms)
+
+    def _HandleAttitude(self, msg):
+        self.ApplyAttitude(msg.roll, msg.pitch, msg.yaw, msg.rollspeed, msg.pitchspeed, msg.yawspeed, msg.time_boot_ms)
+
+    def _HandleHeartbeat(self, msg):
+        self.ApplyHeartbeat(msg.autopilot, msg.base_mode, msg.system_status)
+
+    def _HandleExtendedSysState(self, msg):
+        self.ApplyLandedState(msg.landed_state)
+
+    def _HandleEstimatorStatus(self, msg):
+        self.ApplyEstimatorFlags(msg.flags)
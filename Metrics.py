@@ -0,0 +1,276 @@
+import bisect
+import threading
+import os
+import time
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Bucket upper bounds in seconds, from 10 us to 60 s, for latencies and durations alike.
+DEFAULT_TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+                        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _FormatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing value. Increments are not locked: every counter is meant to be incremented by a single
+    thread, and a concurrent reader at worst sees a value one update old.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def Increment(self, amount=1):
+        self.value += amount
+
+    def Render(self):
+        return [f"{self.name}{_FormatLabels(self.labels)} {self.value}"]
+
+
+class Gauge:
+    """Value that can go up and down, for example the current state."""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0.0
+
+    def Set(self, value):
+        self.value = value
+
+    def Render(self):
+        return [f"{self.name}{_FormatLabels(self.labels)} {self.value}"]
+
+
+class Histogram:
+    """
+    Distribution over fixed buckets. An observation is a binary search and two additions, with the same single
+    writer assumption as Counter.
+    """
+
+    def __init__(self, name, labels, buckets=DEFAULT_TIME_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.bucketCounts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        self.bucketCounts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def Render(self):
+        lines = []
+        cumulativeCount = 0
+        for upperBound, bucketCount in zip(self.buckets + ("+Inf",), list(self.bucketCounts)):
+            cumulativeCount += bucketCount
+            labels = self.labels + (("le", upperBound),)
+            lines.append(f"{self.name}_bucket{_FormatLabels(labels)} {cumulativeCount}")
+        lines.append(f"{self.name}_sum{_FormatLabels(self.labels)} {self.sum}")
+        lines.append(f"{self.name}_count{_FormatLabels(self.labels)} {self.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds every metric of the process. Metrics are created once, usually when a controller is constructed, and
+    updated without touching the registry, so the registry lock is never taken on the hot path.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._types = {}
+        self._mutex = threading.Lock()
+
+    def Counter(self, name, help, **labels):
+        """Returns the counter with the given name and labels, creating it on first use."""
+        return self._GetOrCreate(Counter, "counter", name, help, labels)
+
+    def Gauge(self, name, help, **labels):
+        """Returns the gauge with the given name and labels, creating it on first use."""
+        return self._GetOrCreate(Gauge, "gauge", name, help, labels)
+
+    def Histogram(self, name, help, buckets=DEFAULT_TIME_BUCKETS, **labels):
+        """Returns the histogram with the given name and labels, creating it with the given buckets on first use."""
+        return self._GetOrCreate(lambda metricName, metricLabels: Histogram(metricName, metricLabels, buckets),
+                                 "histogram", name, help, labels)
+
+    def RenderPrometheus(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition text.
+        """
+        with self._mutex:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+            helps = dict(self._help)
+            types = dict(self._types)
+        lines = []
+        previousName = None
+        for (name, _), metric in metrics:
+            if name != previousName:
+                lines.append(f"# HELP {name} {helps[name]}")
+                lines.append(f"# TYPE {name} {types[name]}")
+                previousName = name
+            lines.extend(metric.Render())
+        return "\n".join(lines) + "\n"
+
+    def _GetOrCreate(self, factory, metricType, name, help, labels):
+        labels = tuple(sorted((labelName, str(value)) for labelName, value in labels.items()))
+        key = (name, labels)
+        with self._mutex:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = factory(name, labels)
+                self._metrics[key] = metric
+                self._help.setdefault(name, help)
+                self._types.setdefault(name, metricType)
+            return metric
+
+
+# Registry the controllers report to.
+registry = MetricsRegistry()
+
+
+class MetricsHttpServer:
+    """Serves a registry in the Prometheus text format on http://<host>:<port>/metrics."""
+
+    def __init__(self, port, host="127.0.0.1", metricsRegistry=registry):
+        """
+        Args:
+            port (int): TCP port to listen on.
+            host (str): Address to listen on, local only by default.
+            metricsRegistry (MetricsRegistry): Registry to serve.
+        """
+        metricsRegistryToServe = metricsRegistry
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metricsRegistryToServe.RenderPrometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Scrapes are too frequent to print
+
+        self._server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def Terminate(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class MetricsSnapshotWriter:
+    """Periodically writes a registry in the Prometheus text format to a file, replacing it atomically."""
+
+    def __init__(self, path, period=5.0, metricsRegistry=registry):
+        """
+        Args:
+            path (str): Snapshot file, for example for the node exporter textfile collector.
+            period (float): Seconds between snapshots.
+            metricsRegistry (MetricsRegistry): Registry to write.
+        """
+        self._path = path
+        self._period = period
+        self._metricsRegistry = metricsRegistry
+        self._terminate = threading.Event()
+        self._thread = None
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def Terminate(self):
+        self._terminate.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.WriteSnapshot()
+
+    def WriteSnapshot(self):
+        temporaryPath = f"{self._path}.tmp"
+        try:
+            with open(temporaryPath, "w") as snapshotFile:
+                snapshotFile.write(self._metricsRegistry.RenderPrometheus())
+            os.replace(temporaryPath, self._path)
+        except OSError as e:
+            logging.error(f"Error writing metrics snapshot {self._path}: {e}")
+
+    def _run(self):
+        while not self._terminate.wait(self._period):
+            self.WriteSnapshot()
+
+
+class StateDwellTracker:
+    """
+    Records how long a state machine stays in each state into a histogram per state, and exposes the current
+    state as a gauge.
+    """
+
+    def __init__(self, machine, metricsRegistry=registry, **labels):
+        """
+        Args:
+            machine (str): State machine name, used as a label.
+            metricsRegistry (MetricsRegistry): Registry the metrics are created in.
+            **labels: Additional labels, for example the vehicle id.
+        """
+        self._machine = machine
+        self._labels = labels
+        self._metricsRegistry = metricsRegistry
+        self._dwellHistograms = {}
+        self._stateGauge = metricsRegistry.Gauge("avcimaster_state", "Current state value of a state machine",
+                                                 machine=machine, **labels)
+        self._state = None
+        self._enterTime = time.perf_counter()
+        self._mutex = threading.Lock()
+
+    def Transition(self, state, now=None):
+        """
+        Records the dwell time of the state being left and enters a new one.
+
+        Args:
+            state (Enum): The state entered.
+            now (float, optional): time.perf_counter() timestamp of the transition.
+        """
+        now = time.perf_counter() if now is None else now
+        with self._mutex:
+            self._Transition(state, now)
+
+    def _Transition(self, state, now):
+        if self._state is not None:
+            histogram = self._dwellHistograms.get(self._state)
+            if histogram is None:
+                histogram = self._metricsRegistry.Histogram("avcimaster_state_dwell_seconds", "Time spent in a state before leaving it",
+                                                            machine=self._machine, state=self._state.name, **self._labels)
+                self._dwellHistograms[self._state] = histogram
+            histogram.Observe(now - self._enterTime)
+        self._state = state
+        self._enterTime = now
+        self._stateGauge.Set(state.value)
@@ -0,0 +1,203 @@
+import math
+import time
+import struct
+import threading
+from pymavlink import mavutil
+
+from Metrics import registry
+from SetpointFrame import Setpoint, SetpointType
+from MavlinkFastReceiver import MAVLINK_V2_MAGIC, MAVLINK_V2_OVERHEAD
+
+# MAVLink v2 header: magic, payload size, incompatibility and compatibility flags, sequence, system id,
+# component id and the 24-bit message id as its low 16 and high 8 bits.
+MAVLINK_V2_HEADER = struct.Struct("<BBBBBBBHB")
+MAVLINK_CHECKSUM = struct.Struct("<H")
+
+# Payload layouts in MAVLink wire order, largest fields first.
+SET_POSITION_TARGET_LOCAL_NED_PAYLOAD = struct.Struct("<I11fHBBB") # time_boot_ms, x, y, z, vx, vy, vz, afx, afy, afz, yaw, yaw_rate, type_mask, target_system, target_component, coordinate_frame
+SET_ATTITUDE_TARGET_PAYLOAD = struct.Struct("<I4f4fBBB") # time_boot_ms, q, body_roll_rate, body_pitch_rate, body_yaw_rate, thrust, target_system, target_component, type_mask
+
+_POSITION_TARGET_IGNORE_ACCELERATION = (mavutil.mavlink.POSITION_TARGET_TYPEMASK_AX_IGNORE | mavutil.mavlink.POSITION_TARGET_TYPEMASK_AY_IGNORE
+                                        | mavutil.mavlink.POSITION_TARGET_TYPEMASK_AZ_IGNORE | mavutil.mavlink.POSITION_TARGET_TYPEMASK_YAW_RATE_IGNORE)
+POSITION_TYPE_MASK = (_POSITION_TARGET_IGNORE_ACCELERATION | mavutil.mavlink.POSITION_TARGET_TYPEMASK_VX_IGNORE
+                      | mavutil.mavlink.POSITION_TARGET_TYPEMASK_VY_IGNORE | mavutil.mavlink.POSITION_TARGET_TYPEMASK_VZ_IGNORE)
+VELOCITY_TYPE_MASK = (_POSITION_TARGET_IGNORE_ACCELERATION | mavutil.mavlink.POSITION_TARGET_TYPEMASK_X_IGNORE
+                      | mavutil.mavlink.POSITION_TARGET_TYPEMASK_Y_IGNORE | mavutil.mavlink.POSITION_TARGET_TYPEMASK_Z_IGNORE)
+ATTITUDE_TYPE_MASK = (mavutil.mavlink.ATTITUDE_TARGET_TYPEMASK_BODY_ROLL_RATE_IGNORE | mavutil.mavlink.ATTITUDE_TARGET_TYPEMASK_BODY_PITCH_RATE_IGNORE
+                      | mavutil.mavlink.ATTITUDE_TARGET_TYPEMASK_BODY_YAW_RATE_IGNORE)
+
+# PX4 main mode selected with MAV_CMD_DO_SET_MODE and MAV_MODE_FLAG_CUSTOM_MODE_ENABLED.
+PX4_CUSTOM_MAIN_MODE_OFFBOARD = 6
+
+
+def _BuildX25CrcTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+X25_CRC_TABLE = _BuildX25CrcTable()
+
+
+class OffboardSetpointStreamer:
+    """
+    Forwards user setpoints to PX4, position and velocity setpoints as SET_POSITION_TARGET_LOCAL_NED and attitude
+    setpoints as SET_ATTITUDE_TARGET, and switches the vehicle to offboard mode with the first one. Every setpoint is
+    sent as soon as it is submitted; between submissions the latest one is repeated at the minimum rate, because PX4
+    leaves offboard mode when setpoints stop arriving.
+
+    Frames are packed by hand into preallocated buffers, with their own source component and sequence, so the
+    forwarding path creates no message objects and can run on the submitting thread while the MAVLink thread
+    keeps using the connection's encoder.
+    """
+
+    DEFAULT_MINIMUM_RATE = 20.0
+    # A velocity setpoint is not repeated for longer than this, afterwards the vehicle is held at zero velocity.
+    VELOCITY_SETPOINT_TIMEOUT = 0.5
+    OFFBOARD_MODE_RETRY_PERIOD = 1.0
+    SOURCE_SYSTEM = 255
+    SOURCE_COMPONENT = mavutil.mavlink.MAV_COMP_ID_ONBOARD_COMPUTER
+
+    def __init__(self, mavlinkConnection, commandChannel, vehicleId=0, minimumRate=DEFAULT_MINIMUM_RATE):
+        """
+        Args:
+            mavlinkConnection: Connection the frames are written to, anything with a write method.
+            commandChannel (MavlinkCommandChannel): Provides the target ids and sends the offboard mode command.
+            vehicleId (int): Vehicle id used in the metrics.
+            minimumRate (float): Rate in Hz below which the latest setpoint is repeated.
+        """
+        self._mavlinkConnection = mavlinkConnection
+        self._commandChannel = commandChannel
+        self._period = 1.0 / minimumRate
+        self._mutex = threading.Lock()
+        self._setpoint = Setpoint()
+        self._streaming = False
+        self._setpointReceiveTime = 0.0
+        self._lastSendTime = 0.0
+        self._sequence = 0
+        self._positionFrame = bytearray(MAVLINK_V2_OVERHEAD + SET_POSITION_TARGET_LOCAL_NED_PAYLOAD.size)
+        self._attitudeFrame = bytearray(MAVLINK_V2_OVERHEAD + SET_ATTITUDE_TARGET_PAYLOAD.size)
+        self._offboardModeRequest = None
+        self._offboardModeRequestTime = 0.0
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._latencyHistogram = registry.Histogram("avcimaster_setpoint_latency_seconds",
+                                                    "Time from the creation of a user setpoint to sending it to PX4", vehicle=vehicleId)
+        self._setpointsSentCounter = registry.Counter("avcimaster_setpoints_sent_total", "User setpoints sent to PX4", vehicle=vehicleId)
+        self._keepAlivesCounter = registry.Counter("avcimaster_setpoint_keepalives_total",
+                                                   "Setpoints repeated to keep PX4 in offboard mode", vehicle=vehicleId)
+
+    def Start(self):
+        """Starts the keep-alive thread."""
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        """Stops the keep-alive thread and waits for it to finish."""
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def Submit(self, setpoint):
+        """Sends a setpoint to PX4 right away and keeps repeating it until the next one. Called from any thread."""
+        now = time.monotonic()
+        with self._mutex:
+            self._setpoint.CopyFrom(setpoint)
+            self._setpointReceiveTime = now
+            self._streaming = True
+            if not self._Send(now):
+                return
+        self._latencyHistogram.Observe(time.monotonic_ns() * 1e-9 - setpoint.timestamp * 1e-9)
+        self._setpointsSentCounter.Increment()
+        self._RequestOffboardMode(now)
+
+    def Clear(self):
+        """Stops repeating the latest setpoint. The next submitted setpoint requests offboard mode again."""
+        with self._mutex:
+            self._streaming = False
+            self._offboardModeRequest = None
+
+    def _RequestOffboardMode(self, now):
+        request = self._offboardModeRequest
+        if request is not None and (not request.IsDone() or request.accepted
+                                    or now - self._offboardModeRequestTime < self.OFFBOARD_MODE_RETRY_PERIOD):
+            return
+        self._offboardModeRequestTime = now
+        self._offboardModeRequest = self._commandChannel.SendCommand(mavutil.mavlink.MAV_CMD_DO_SET_MODE,
+                                                                     mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                                                                     PX4_CUSTOM_MAIN_MODE_OFFBOARD)
+
+    def _run(self):
+        nextSendTime = time.monotonic() + self._period
+        while not self._stopEvent.wait(max(0.0, nextSendTime - time.monotonic())):
+            now = time.monotonic()
+            with self._mutex:
+                if self._streaming and now - self._lastSendTime >= self._period * 0.99:
+                    setpoint = self._setpoint
+                    if (setpoint.setpointType is SetpointType.VELOCITY
+                            and now - self._setpointReceiveTime > self.VELOCITY_SETPOINT_TIMEOUT):
+                        # The user went silent, hold position instead of flying on
+                        setpoint.values[0] = setpoint.values[1] = setpoint.values[2] = 0.0
+                    if self._Send(now):
+                        self._keepAlivesCounter.Increment()
+                nextSendTime = self._lastSendTime + self._period
+                if nextSendTime <= now:
+                    nextSendTime = now + self._period
+
+    def _Send(self, now):
+        """Packs and writes the current setpoint, with the mutex held. Returns False before the target is known."""
+        target = self._commandChannel.GetTarget()
+        if target is None:
+            return False
+        targetSystem, targetComponent = target
+        setpoint = self._setpoint
+        values = setpoint.values
+        timeBootMs = (setpoint.timestamp // 1000000) & 0xFFFFFFFF # Carries the creation time for log correlation
+        if setpoint.setpointType is SetpointType.ATTITUDE:
+            frame = self._attitudeFrame
+            roll, pitch, yaw = math.radians(values[0]) * 0.5, math.radians(values[1]) * 0.5, math.radians(values[2]) * 0.5
+            cr, sr, cp, sp, cy, sy = math.cos(roll), math.sin(roll), math.cos(pitch), math.sin(pitch), math.cos(yaw), math.sin(yaw)
+            SET_ATTITUDE_TARGET_PAYLOAD.pack_into(frame, 10, timeBootMs,
+                                                  cr * cp * cy + sr * sp * sy, sr * cp * cy - cr * sp * sy,
+                                                  cr * sp * cy + sr * cp * sy, cr * cp * sy - sr * sp * cy,
+                                                  0.0, 0.0, 0.0, values[3], targetSystem, targetComponent, ATTITUDE_TYPE_MASK)
+            self._FinishFrame(frame, mavutil.mavlink.MAVLINK_MSG_ID_SET_ATTITUDE_TARGET,
+                              mavutil.mavlink.MAVLink_set_attitude_target_message.crc_extra)
+        else:
+            frame = self._positionFrame
+            yaw = math.radians(values[3])
+            if setpoint.setpointType is SetpointType.POSITION:
+                SET_POSITION_TARGET_LOCAL_NED_PAYLOAD.pack_into(frame, 10, timeBootMs, values[0], values[1], values[2],
+                                                                0.0, 0.0, 0.0, 0.0, 0.0, 0.0, yaw, 0.0, POSITION_TYPE_MASK,
+                                                                targetSystem, targetComponent, mavutil.mavlink.MAV_FRAME_LOCAL_NED)
+            else:
+                SET_POSITION_TARGET_LOCAL_NED_PAYLOAD.pack_into(frame, 10, timeBootMs, 0.0, 0.0, 0.0, values[0], values[1],
+                                                                values[2], 0.0, 0.0, 0.0, yaw, 0.0, VELOCITY_TYPE_MASK,
+                                                                targetSystem, targetComponent, mavutil.mavlink.MAV_FRAME_LOCAL_NED)
+            self._FinishFrame(frame, mavutil.mavlink.MAVLINK_MSG_ID_SET_POSITION_TARGET_LOCAL_NED,
+                              mavutil.mavlink.MAVLink_set_position_target_local_ned_message.crc_extra)
+        try:
+            self._mavlinkConnection.write(frame)
+        except OSError:
+            return False
+        self._lastSendTime = now
+        return True
+
+    def _FinishFrame(self, frame, messageId, crcExtra):
+        """Writes the header and checksum around a packed payload."""
+        payloadSize = len(frame) - MAVLINK_V2_OVERHEAD
+        MAVLINK_V2_HEADER.pack_into(frame, 0, MAVLINK_V2_MAGIC, payloadSize, 0, 0, self._sequence, self.SOURCE_SYSTEM,
+                                    self.SOURCE_COMPONENT, messageId & 0xFFFF, messageId >> 16)
+        self._sequence = (self._sequence + 1) & 0xFF
+        crc = 0xFFFF
+        table = X25_CRC_TABLE
+        for index in range(1, 10 + payloadSize):
+            crc = (crc >> 8) ^ table[(crc ^ frame[index]) & 0xFF]
+        crc = (crc >> 8) ^ table[(crc ^ crcExtra) & 0xFF]
+        MAVLINK_CHECKSUM.pack_into(frame, 10 + payloadSize, crc)
@@ -0,0 +1,363 @@
+import subprocess
+import shutil
+import os
+import re
+import time
+import logging
+import shlex
+from enum import Enum
+
+from SitlInstance import SitlInstance, TerminateProcessGroups, SIMULATOR_BASE_PORT, GAZEBO_MASTER_BASE_PORT
+
+
+class SitlLaunchMode(Enum):
+    MAKE = 0
+    DIRECT = 1
+    EXTERNAL = 2
+
+
+def SpreadCpuCores(groupCount):
+    """
+    Splits the CPU cores available to this process into groupCount contiguous groups of nearly equal size, so
+    every simulation instance gets its own cores. With fewer cores than groups, cores are shared round-robin.
+
+    Returns:
+        list: One set of core indices per group.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if len(cores) < groupCount:
+        return [{cores[group % len(cores)]} for group in range(groupCount)]
+    groups = []
+    start = 0
+    for group in range(groupCount):
+        size = len(cores) // groupCount + (1 if group < len(cores) % groupCount else 0)
+        groups.append(set(cores[start:start + size]))
+        start += size
+    return groups
+
+
+class PX4SITLLauncher:
+    """
+    Starts PX4 SITL and Gazebo classic simulations.
+
+    MAKE runs "make px4_sitl gazebo-classic" through a shell, exactly like a developer would. DIRECT starts the
+    prebuilt px4 binary and gzserver without make, replicating what PX4's sitl_run.sh does, which skips the build
+    graph and CMake checks. DIRECT falls back to MAKE whenever the build output is missing or out of date.
+    EXTERNAL starts nothing and attaches to a simulation, or a MAVLink stand-in, already serving the instance ports.
+
+    Instances other than 0 are always started directly, each with its own gzserver, Gazebo master port,
+    working directory and PX4 port set, so several simulations can run side by side.
+    A PX4_SIM_SPEED_FACTOR in the environment changes the simulation speed: DIRECT scales the real-time update
+    rate of the world to match it, MAKE passes it on to PX4's scripts unchanged.
+    The duration of every startup phase is recorded on the returned SitlInstance.
+    Every process is started in its own session, so its process group holds everything it spawns and the
+    instance can stop all of it with one signal, see SitlInstance.Terminate.
+    Given CPU cores are set before the processes exec, so none of their threads or children escape the pinning.
+    """
+
+    MAKE_COMMAND = "HEADLESS=1 make px4_sitl gazebo-classic"
+    BUILD_COMMAND = "make px4_sitl_default sitl_gazebo-classic"
+    MODEL_SPAWN_TIMEOUT = 30.0
+    MODEL_SPAWN_RETRY_PERIOD = 0.2
+    # Spawn position used by PX4's sitl_run.sh for a single vehicle.
+    MODEL_SPAWN_POSITION = (1.01, 0.98, 0.83)
+    # Distance in m between the spawn positions of consecutive vehicles along the Gazebo y axis, like PX4's
+    # sitl_multiple_run.sh. Gazebo adds the spawn position to the PX4_HOME_* world origin, so vehicles also get
+    # distinct geodetic poses and homes.
+    MODEL_SPAWN_SPACING = 3.0
+    # Physics step of Gazebo classic when the world does not set one.
+    GAZEBO_DEFAULT_MAX_STEP_SIZE = 0.001
+
+    def __init__(self, px4Directory=os.path.join("..", "avcipilot"), model="iris", world="empty"):
+        """
+        Args:
+            px4Directory (str): Root of the PX4-Autopilot source tree.
+            model (str): Gazebo classic vehicle model.
+            world (str): Gazebo classic world name, without the .world extension.
+        """
+        self._px4Directory = px4Directory
+        self._model = model
+        self._world = world
+        self._buildDirectory = os.path.join(px4Directory, "build", "px4_sitl_default")
+        self._gazeboDirectory = os.path.join(px4Directory, "Tools", "simulation", "gazebo-classic", "sitl_gazebo-classic")
+        self._gazeboSystemPaths = None
+
+    def Launch(self, launchMode, environment, instanceIndex=0, cpuCores=None, spawnSlot=0):
+        """
+        Starts a simulation. The output pump of the returned instance is not started yet.
+
+        Args:
+            launchMode (SitlLaunchMode): Requested launch mode.
+            environment (dict): Environment of the started processes.
+            instanceIndex (int): PX4 instance index.
+            cpuCores (set, optional): CPU core indices the started processes are pinned to.
+            spawnSlot (int): Vehicle N spawns MODEL_SPAWN_SPACING * N further along y. Only applied to direct
+                launches, make spawns where sitl_run.sh puts a single vehicle.
+
+        Returns:
+            SitlInstance: The launched instance. Its processes have text-mode stdout and stderr pipes that
+                never fail to decode.
+        """
+        launchTime = time.perf_counter()
+        phaseDurations = {}
+        affinityCommand = self._GetAffinityCommand(cpuCores)
+        if launchMode is SitlLaunchMode.EXTERNAL:
+            print(f"Attaching to external simulation instance {instanceIndex}.")
+            instance = self._CreateInstance(instanceIndex, None, None, launchTime, phaseDurations)
+        elif launchMode is SitlLaunchMode.DIRECT or instanceIndex != 0:
+            phaseStartTime = time.perf_counter()
+            buildUpToDate = self.IsBuildUpToDate()
+            phaseDurations["build check"] = time.perf_counter() - phaseStartTime
+            if not buildUpToDate and instanceIndex != 0:
+                phaseStartTime = time.perf_counter()
+                self.Build(environment)
+                phaseDurations["build"] = time.perf_counter() - phaseStartTime
+                buildUpToDate = True
+            if buildUpToDate:
+                instance = self._LaunchDirect(environment, instanceIndex, spawnSlot, launchTime, phaseDurations, affinityCommand)
+            else:
+                print("PX4 build output is missing or out of date, falling back to make.")
+                instance = self._LaunchMake(environment, launchTime, phaseDurations, affinityCommand)
+        else:
+            instance = self._LaunchMake(environment, launchTime, phaseDurations, affinityCommand)
+        return instance
+
+    def IsBuildUpToDate(self):
+        """
+        Checks with a ninja dry run that neither PX4 nor the Gazebo plugins need rebuilding.
+
+        Returns:
+            bool: False if ninja is missing, the build output does not exist, or any target is stale.
+        """
+        ninja = shutil.which("ninja")
+        if ninja is None or not os.path.isfile(self._GetPx4Binary()):
+            return False
+        for buildDirectory in (self._buildDirectory, os.path.join(self._buildDirectory, "build_gazebo-classic")):
+            if not os.path.isfile(os.path.join(buildDirectory, "build.ninja")):
+                return False
+            try:
+                result = subprocess.run([ninja, "-C", buildDirectory, "-n"],
+                                        capture_output=True, text=True, timeout=30)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                logging.error(f"Error checking PX4 build: {e}")
+                return False
+            if result.returncode != 0 or "no work to do" not in result.stdout:
+                return False
+        return True
+
+    def Build(self, environment):
+        """Builds PX4 and the Gazebo plugins without starting a simulation."""
+        print(f"Building PX4 with command: {self.BUILD_COMMAND}")
+        subprocess.run(self.BUILD_COMMAND, cwd=self._px4Directory, shell=True, env=environment,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+    def _LaunchMake(self, environment, launchTime, phaseDurations, affinityCommand):
+        makeCommand = self.MAKE_COMMAND
+        if affinityCommand:
+            makeCommand = shlex.join(affinityCommand + ["sh", "-c", makeCommand])
+        print(f"Creating SITL process with command: {makeCommand}")
+        phaseStartTime = time.perf_counter()
+        process = subprocess.Popen(
+                        makeCommand,
+                        cwd=self._px4Directory,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        stdin=subprocess.PIPE,
+                        shell=True,
+                        text=True,
+                        errors="backslashreplace",
+                        env=environment,
+                        start_new_session=True
+                    )
+        phaseDurations["make and px4 start"] = time.perf_counter() - phaseStartTime
+        return self._CreateInstance(0, process, None, launchTime, phaseDurations)
+
+    def _LaunchDirect(self, environment, instanceIndex, spawnSlot, launchTime, phaseDurations, affinityCommand):
+        environment = self._CreateGazeboEnvironment(environment, instanceIndex)
+
+        phaseStartTime = time.perf_counter()
+        worldPath = self._CreateWorldFile(environment, instanceIndex)
+        print(f"Starting gzserver for instance {instanceIndex} with world: {worldPath}")
+        gazeboProcess = subprocess.Popen(
+                        affinityCommand + ["gzserver", "--verbose", worldPath],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        stdin=subprocess.DEVNULL,
+                        text=True,
+                        errors="backslashreplace",
+                        env=environment,
+                        start_new_session=True
+                    )
+        phaseDurations["gzserver start"] = time.perf_counter() - phaseStartTime
+
+        phaseStartTime = time.perf_counter()
+        modelSpawned = self._SpawnModel(gazeboProcess, environment, instanceIndex, spawnSlot)
+        phaseDurations["model spawn"] = time.perf_counter() - phaseStartTime
+        if not modelSpawned:
+            TerminateProcessGroups([gazeboProcess])
+            raise RuntimeError(f"Could not spawn model {self._model} in gzserver.")
+
+        phaseStartTime = time.perf_counter()
+        workingDirectory = os.path.join(self._buildDirectory, "rootfs" if instanceIndex == 0 else f"instance_{instanceIndex}")
+        os.makedirs(workingDirectory, exist_ok=True)
+        px4Command = affinityCommand + [self._GetPx4Binary(), "-i", str(instanceIndex), os.path.join(os.path.abspath(self._buildDirectory), "etc")]
+        print(f"Starting PX4 with command: {' '.join(px4Command)}")
+        px4Process = subprocess.Popen(
+                        px4Command,
+                        cwd=workingDirectory,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        stdin=subprocess.PIPE,
+                        text=True,
+                        errors="backslashreplace",
+                        env=environment,
+                        start_new_session=True
+                    )
+        phaseDurations["px4 start"] = time.perf_counter() - phaseStartTime
+        return self._CreateInstance(instanceIndex, px4Process, gazeboProcess, launchTime, phaseDurations)
+
+    @staticmethod
+    def _GetAffinityCommand(cpuCores):
+        """
+        Builds the taskset prefix pinning a started program to cpuCores. taskset sets the affinity before it execs
+        the program, so every thread and child the program creates inherits the cores.
+
+        Returns:
+            list: Command prefix, empty to leave the program to the scheduler.
+        """
+        if cpuCores is None:
+            return []
+        taskset = shutil.which("taskset")
+        if taskset is None:
+            logging.error("taskset is not installed, SITL processes are not pinned to CPU cores.")
+            return []
+        return [taskset, "-c", ",".join(str(core) for core in sorted(cpuCores))]
+
+    @staticmethod
+    def _CreateInstance(instanceIndex, px4Process, gazeboProcess, launchTime, phaseDurations):
+        instance = SitlInstance(instanceIndex, px4Process, gazeboProcess, launchTime)
+        for name, duration in phaseDurations.items():
+            instance.AddPhaseDuration(name, duration)
+        return instance
+
+    def _SpawnModel(self, gazeboProcess, environment, instanceIndex, spawnSlot):
+        """Spawns the vehicle model in its spawn slot, retrying until gzserver accepts connections."""
+        modelFile = self._CreateModelFile(instanceIndex)
+        x, y, z = self.MODEL_SPAWN_POSITION
+        y += self.MODEL_SPAWN_SPACING * spawnSlot
+        spawnCommand = ["gz", "model", f"--spawn-file={modelFile}", f"--model-name={self._model}",
+                        "-x", str(x), "-y", str(y), "-z", str(z)]
+        deadline = time.monotonic() + self.MODEL_SPAWN_TIMEOUT
+        while time.monotonic() < deadline and gazeboProcess.poll() is None:
+            try:
+                result = subprocess.run(spawnCommand, capture_output=True, text=True, env=environment,
+                                        timeout=deadline - time.monotonic())
+            except subprocess.TimeoutExpired:
+                logging.error(f"gz model did not finish within {self.MODEL_SPAWN_TIMEOUT} s.")
+                return False
+            if result.returncode == 0:
+                return True
+            time.sleep(self.MODEL_SPAWN_RETRY_PERIOD)
+        return False
+
+    def _CreateModelFile(self, instanceIndex):
+        """
+        Returns the model SDF for an instance. Instance 0 uses the generated model as is, other instances get a
+        copy whose simulator TCP port matches "px4 -i <index>".
+        """
+        modelFile = os.path.join(self._gazeboDirectory, "models", self._model, f"{self._model}.sdf")
+        if instanceIndex == 0:
+            return modelFile
+        with open(modelFile) as sdfFile:
+            sdf = sdfFile.read()
+        sdf = re.sub(r"<mavlink_tcp_port>\d+</mavlink_tcp_port>",
+                     f"<mavlink_tcp_port>{SIMULATOR_BASE_PORT + instanceIndex}</mavlink_tcp_port>", sdf)
+        instanceModelFile = os.path.join(self._buildDirectory, f"instance_{instanceIndex}", f"{self._model}.sdf")
+        os.makedirs(os.path.dirname(instanceModelFile), exist_ok=True)
+        with open(instanceModelFile, "w") as sdfFile:
+            sdfFile.write(sdf)
+        return instanceModelFile
+
+    def _CreateWorldFile(self, environment, instanceIndex):
+        """
+        Returns the world file for an instance. With a PX4_SIM_SPEED_FACTOR other than 1 the instance gets a copy
+        whose real-time update rate makes Gazebo step that many times faster than real time.
+        """
+        worldFile = os.path.join(self._gazeboDirectory, "worlds", f"{self._world}.world")
+        speedFactor = float(environment.get("PX4_SIM_SPEED_FACTOR", 1.0))
+        if speedFactor == 1.0:
+            return worldFile
+        with open(worldFile) as sdfFile:
+            sdf = sdfFile.read()
+        stepSizeMatch = re.search(r"<max_step_size>\s*([^<\s]+)\s*</max_step_size>", sdf)
+        stepSize = float(stepSizeMatch.group(1)) if stepSizeMatch else self.GAZEBO_DEFAULT_MAX_STEP_SIZE
+        updateRate = f"<real_time_update_rate>{speedFactor / stepSize:g}</real_time_update_rate>"
+        sdf, count = re.subn(r"<real_time_update_rate>[^<]*</real_time_update_rate>", updateRate, sdf)
+        if count == 0:
+            sdf, count = re.subn(r"(<physics[^>]*>)", lambda match: match.group(1) + updateRate, sdf, count=1)
+        if count == 0:
+            logging.error(f"World {worldFile} has no physics settings, it runs at its default speed.")
+            return worldFile
+        print(f"Running instance {instanceIndex} at {speedFactor:g}x real time with {updateRate}.")
+        instanceWorldFile = os.path.join(self._buildDirectory, f"instance_{instanceIndex}", f"{self._world}.world")
+        os.makedirs(os.path.dirname(instanceWorldFile), exist_ok=True)
+        with open(instanceWorldFile, "w") as sdfFile:
+            sdfFile.write(sdf)
+        return instanceWorldFile
+
+    def _CreateGazeboEnvironment(self, environment, instanceIndex):
+        """
+        Adds the paths set by PX4's setup_gazebo.bash, the variables set by sitl_run.sh and the instance master port.
+        The Gazebo system paths come from the environment when Gazebo's setup.sh was sourced, otherwise from
+        pkg-config, see _GetGazeboSystemPaths.
+        """
+        environment = dict(environment)
+        resourcePath, pluginPath = self._GetGazeboSystemPaths()
+        if environment.get("GAZEBO_RESOURCE_PATH"):
+            resourcePath = None
+        if environment.get("GAZEBO_PLUGIN_PATH"):
+            pluginPath = None
+        gazeboBuildDirectory = os.path.abspath(os.path.join(self._buildDirectory, "build_gazebo-classic"))
+        self._AppendPath(environment, "GAZEBO_PLUGIN_PATH", gazeboBuildDirectory)
+        self._AppendPath(environment, "GAZEBO_MODEL_PATH", os.path.abspath(os.path.join(self._gazeboDirectory, "models")))
+        self._AppendPath(environment, "LD_LIBRARY_PATH", gazeboBuildDirectory)
+        if resourcePath is not None:
+            self._AppendPath(environment, "GAZEBO_RESOURCE_PATH", resourcePath)
+        if pluginPath is not None:
+            self._AppendPath(environment, "GAZEBO_PLUGIN_PATH", pluginPath)
+        environment["GAZEBO_MASTER_URI"] = f"http://localhost:{GAZEBO_MASTER_BASE_PORT + instanceIndex}"
+        environment["PX4_SIM_MODEL"] = f"gazebo-classic_{self._model}"
+        return environment
+
+    def _GetGazeboSystemPaths(self):
+        """
+        Returns the resource and plugin directories of the installed Gazebo classic, as Gazebo's setup.sh sets
+        them, derived from its pkg-config file. Either is None when it cannot be determined.
+        """
+        if self._gazeboSystemPaths is None:
+            output = []
+            for query in ("--modversion", "--variable=prefix", "--variable=libdir"):
+                try:
+                    result = subprocess.run(["pkg-config", query, "gazebo"], capture_output=True, text=True, timeout=10)
+                except (OSError, subprocess.TimeoutExpired):
+                    break
+                if result.returncode != 0 or not result.stdout.strip():
+                    break
+                output.append(result.stdout.strip())
+            if len(output) == 3:
+                version, prefix, libraryDirectory = output
+                gazeboDirectory = f"gazebo-{version.split('.')[0]}"
+                self._gazeboSystemPaths = (os.path.join(prefix, "share", gazeboDirectory),
+                                           os.path.join(libraryDirectory, gazeboDirectory, "plugins"))
+            else:
+                logging.error("Gazebo was not found with pkg-config, source Gazebo's setup.sh to set its paths.")
+                self._gazeboSystemPaths = (None, None)
+        return self._gazeboSystemPaths
+
+    def _GetPx4Binary(self):
+        return os.path.abspath(os.path.join(self._buildDirectory, "bin", "px4"))
+
+    @staticmethod
+    def _AppendPath(environment, name, path):
+        currentValue = environment.get(name)
+        environment[name] = f"{currentValue}:{path}" if currentValue else path
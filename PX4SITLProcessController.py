@@ -1,14 +1,28 @@
-import subprocess
 import threading
 import socket
-import struct
+import signal
 import os
+import math
 import time
 import logging
 from enum import Enum
 from pymavlink import mavutil
 
 from SharedData import SharedData
+from Metrics import registry, StateDwellTracker
+from TelemetryRecorder import TelemetryRecorder
+from PoseFrame import PoseFrameEncoder, PoseWireFormat, GetPosePort
+from PoseMappedFile import PoseTransport, PoseMappedFileWriter, GetPoseMappedFilePath, POSE_MAPPED_FILE_PATH_PREFIX
+from MavlinkVehicleState import MavlinkVehicleState
+from MavlinkDecoderProcess import MavlinkDecoderProcess
+from MavlinkStreamNegotiator import MavlinkStreamNegotiator, NEGOTIATION_MESSAGE_IDS
+from MavlinkFastReceiver import MavlinkFastReceiver
+from MavlinkCommandChannel import MavlinkCommandChannel, COMMAND_CHANNEL_MESSAGE_IDS, FORCE_DISARM_MAGIC
+from OffboardSetpointStreamer import OffboardSetpointStreamer
+from PoseOutputStage import PoseOutputStage
+from PX4SITLLauncher import PX4SITLLauncher, SitlLaunchMode
+from SitlInstancePool import SitlInstancePool
+from SitlInstance import STOP_SIGNAL_DEADLINES
 
 logging.basicConfig(level=logging.INFO)
 
@@ -24,48 +38,433 @@ class PX4SITLProcessController:
         STARTED = 4
         STOPPED = 5
 
-    def __init__(self):
-        """Initialize controller state and threads."""
+    class ReadinessPolicy(Enum):
+        """Condition after which the simulation is reported as STARTED."""
+        HEARTBEAT_EKF_HEALTHY = 0
+        ARMED = 1
+        ALTITUDE = 2
+        IN_AIR = 3
+        # As soon as PX4 accepts the takeoff, or once it is written to the shell when commands cannot go over MAVLink
+        TAKEOFF_ACCEPTED = 4
+
+    # Estimator flags that must all be set for HEARTBEAT_EKF_HEALTHY: attitude, horizontal and vertical velocity,
+    # relative and absolute horizontal position and absolute vertical position.
+    EKF_HEALTHY_FLAGS = 0b00111111
+
+    # Receive timeout used when poses are emitted on change, so the loop still notices termination.
+    MAVLINK_RECEIVE_TIMEOUT = 0.1
+    # How long the SITL thread waits for readiness before checking the process and the terminate flag again.
+    READY_FOR_TAKEOFF_WAIT_TIMEOUT = 0.1
+    # Wait before trying again when PX4 rejects the takeoff.
+    TAKEOFF_RETRY_PERIOD = 1.0
+    # A soft restart falls back to stopping the simulation when the vehicle does not report disarmed within this time.
+    SESSION_RESET_DISARM_TIMEOUT = 3.0
+    # A soft restart falls back to stopping the simulation when the restarted estimator does not report within this time.
+    SESSION_RESET_ESTIMATOR_TIMEOUT = 5.0
+    SESSION_RESET_POLL_PERIOD = 0.05
+    # Default maximum number of records per telemetry recording file, a little over 4 hours of 250 Hz poses. The files
+    # grow in chunks up to it, see MappedRecordFile.
+    TELEMETRY_RECORD_CAPACITY = 4_000_000
+
+    def __init__(self, vehicleId=0):
+        """
+        Initialize controller state and threads.
+        Args:
+            vehicleId (int): Vehicle controlled by this controller. It is the PX4 instance index of the cold-started
+                simulation, selects the MAVLink and pose ports and is sent in every pose frame.
+        """
+        self.vehicleId = vehicleId
         self.state = SharedData(self.State.IDLE)
+        self._InitializeMetrics()
         self._sitlThread = None
-        self._sitlProcess = None
+        self._sitlInstance = None
+        self._sitlInstancePool = None
+        self._sitlLauncher = PX4SITLLauncher()
+        self._sitlLaunchMode = SitlLaunchMode.MAKE
+        self._sitlOutputLogFilePath = None
+        self._sitlOutputTriggers = []
+        self._cpuAffinity = None
+        self._simSpeedFactor = 1.0
+        self._sitlStopSignalDeadlines = STOP_SIGNAL_DEADLINES
         self._sitlRunning = False
         self._initializationCompleted = False
+        self._readinessPolicy = self.ReadinessPolicy.ALTITUDE
+        self._takeoffAltitude = 50.0
+        self._takeoffSpeed = 5.0
+        self._readyAltitude = 48.0
         self._sitlTerminate = False
+        self._softRestartEnabled = False
+        self._softRestartLandTimeout = 10.0
+        self._sessionActive = SharedData(False)
+        self._sessionResetThread = None
+        self._sessionResetSucceeded = False
+        self._sessionRestarted = False
         self._mavlinkThread = None
         self._mavlinkRunning = False
-        self._takeOffCommandSendToSitl = False
+        self._mavlinkConnected = False
+        self._mavlinkCommandChannel = None
+        self._setpointStreamer = None
+        self._setpointMinimumRate = OffboardSetpointStreamer.DEFAULT_MINIMUM_RATE
+        self._setpointsUnsupportedLogged = False
+        self._takeOffCommandSendToSitl = SharedData(False)
+        self._sitlInstanceCreated = SharedData(False)
         self._processErrorCallback = None
+        self._updateEvent = None
         self._Socket10004 = None
+        self._posePort = GetPosePort(vehicleId)
+        self._poseEmitPeriod = None
+        self._poseWireFormat = PoseWireFormat.LEGACY
+        self._poseFrameEncoder = None
+        self._poseTransport = PoseTransport.UDP
+        self._poseMappedFilePathPrefix = POSE_MAPPED_FILE_PATH_PREFIX
+        self._poseMappedFileWriter = None
+        self._poseOutputStage = None
+        self._vehicleState = MavlinkVehicleState(vehicleId)
+        self._mavlinkDecoderProcessEnabled = False
+        self._mavlinkFastIngestEnabled = False
+        self._mavlinkStreamRates = {}
+        self._suppressUnusedMavlinkStreams = False
+        self._telemetryRecordPathPrefix = None
+        self._telemetryRecordMavlink = False
+        self._telemetryRecordCapacity = self.TELEMETRY_RECORD_CAPACITY
+        self._telemetryRecorder = None
         
     def Terminate(self):
         self._sitlTerminate = True
-        self._sitlThread.join()
-        self._mavlinkThread.join()
-        self._Socket10004.close()
+        if self._sessionResetThread is not None:
+            self._sessionResetThread.join()
+        if self._sitlThread is not None:
+            self._sitlThread.join()
+        if self._mavlinkThread is not None:
+            self._mavlinkThread.join()
+        self._Close10004TransmitSocket()
+        if self._sitlInstancePool is not None:
+            self._sitlInstancePool.Terminate()
 
     def StartSITL(self):
-        if not self._sitlRunning:
+        if self._IsSessionRestartPossible():
+            print("Starting a new session on the running PX4 SITL simulation")
+            self._StartSession()
+        elif not self._sitlRunning:
             print("Starting PX4 SITL simulation")
+            if self._sitlThread is not None:
+                self._StopPX4Simulation() # The previous simulation exited on its own
             self._StartPX4Simulation()
 
+    def RequestStopSITL(self):
+        """
+        Starts stopping the simulation without waiting for it, so several controllers can stop in parallel.
+        StopSITL or Terminate waits for the stop to finish. With soft restart, the session is reset instead.
+        """
+        if self._sessionResetThread is not None:
+            return
+        if self._IsSessionResetPossible():
+            self._sessionResetThread = threading.Thread(target=self._ResetSession, daemon=True)
+            self._sessionResetThread.start()
+        else:
+            self._sitlTerminate = True
+
     def StopSITL(self):
-        if self._sitlRunning:
+        self.RequestStopSITL()
+        if self._sessionResetThread is not None:
+            self._sessionResetThread.join()
+            self._sessionResetThread = None
+            if self._sessionResetSucceeded:
+                self.SetState(self.State.STOPPED)
+                return
+            print("Session reset failed, stopping the PX4 SITL simulation.")
+            self._sitlTerminate = True
+        # The SITL thread may already have finished after the stop request, its threads are joined regardless
+        if self._sitlThread is not None:
             self._StopPX4Simulation()
 
     def GetState(self)->State:
         return self.state.Get()
     
     def SetState(self, value):
-        return self.state.Set(value)
+        previousValue = self.state.GetAndSet(value)
+        if previousValue is not value:
+            self._stateDwellTracker.Transition(value)
+            if self._updateEvent is not None:
+                self._updateEvent.Set()
 
     def SetProcessErrorCallback(self, processErrorCallback):
         self._processErrorCallback = processErrorCallback
 
+    def SetUpdateEvent(self, updateEvent):
+        """Sets the SharedEvent signalled on every state change."""
+        self._updateEvent = updateEvent
+
+    def SetSitlLaunchMode(self, launchMode):
+        """
+        Selects how the simulation processes are started.
+        Args:
+            launchMode (SitlLaunchMode): SitlLaunchMode.MAKE (default) runs make. SitlLaunchMode.DIRECT starts the
+                prebuilt px4 binary and gzserver directly when the build is up to date, and falls back to make otherwise.
+                SitlLaunchMode.EXTERNAL starts nothing and attaches to the MAVLink port of an already running simulation.
+        """
+        self._sitlLaunchMode = launchMode
+
+    def GetStartupPhaseDurations(self):
+        """Returns the startup phase durations of the last simulation start, in seconds."""
+        if self._sitlInstance is None:
+            return {}
+        return self._sitlInstance.GetPhaseDurations()
+
+    def SetReadinessPolicy(self, readinessPolicy, readyAltitude=None):
+        """
+        Selects when the simulation is reported as STARTED, applied when the next simulation starts.
+        Args:
+            readinessPolicy (ReadinessPolicy): HEARTBEAT_EKF_HEALTHY as soon as the estimator is healthy, ARMED once the
+                vehicle is armed, IN_AIR once PX4 reports the vehicle left the ground, or ALTITUDE (default) once the
+                altitude above home exceeds readyAltitude.
+            readyAltitude (float, optional): Altitude for the ALTITUDE policy in meters, defaults to 2 m below the
+                takeoff altitude.
+        """
+        self._readinessPolicy = readinessPolicy
+        self._readyAltitude = readyAltitude if readyAltitude is not None else self._takeoffAltitude - 2.0
+
+    def SetTakeoffParameters(self, takeoffAltitude, takeoffSpeed):
+        """
+        Sets the takeoff altitude (MIS_TAKEOFF_ALT) in meters and climb speed (MPC_TKO_SPEED) in m/s.
+        The ALTITUDE readiness threshold follows the takeoff altitude unless it was set explicitly afterwards.
+        """
+        self._takeoffAltitude = takeoffAltitude
+        self._takeoffSpeed = takeoffSpeed
+        self._readyAltitude = takeoffAltitude - 2.0
+
+    def SetCpuAffinity(self, cores):
+        """
+        Pins the processes of every SITL instance launched afterwards to a set of CPU cores.
+        Args:
+            cores (set): CPU core indices, None leaves the placement to the scheduler.
+        """
+        self._cpuAffinity = cores
+
+    def SetSimulationSpeedFactor(self, speedFactor):
+        """
+        Runs PX4 and Gazebo faster or slower than real time, applied to the SITL instances launched afterwards.
+        PX4 gets PX4_SIM_SPEED_FACTOR and Gazebo the matching real-time update rate, and as they run in lockstep
+        the simulation time advances speedFactor times as fast as the wall clock when the host keeps up. The
+        vehicle timeouts of the soft restart are in simulation time.
+        Args:
+            speedFactor (float): Simulation seconds per wall-clock second, 1 for real time.
+        """
+        self._simSpeedFactor = speedFactor
+        if self._poseOutputStage is not None:
+            self._poseOutputStage.SetSpeedFactor(speedFactor)
+
+    def SetSitlStopDeadlines(self, interruptDeadline, terminateDeadline, killDeadline):
+        """
+        Sets how long a SITL instance launched afterwards gets to exit after SIGINT and then SIGTERM before the next
+        signal is sent, and how long to wait after SIGKILL. Their sum bounds the time a stop takes.
+        Args:
+            interruptDeadline (float): Seconds to wait after SIGINT, 0 skips straight to SIGTERM.
+            terminateDeadline (float): Seconds to wait after SIGTERM.
+            killDeadline (float): Seconds to wait after SIGKILL.
+        """
+        self._sitlStopSignalDeadlines = ((signal.SIGINT, interruptDeadline), (signal.SIGTERM, terminateDeadline),
+                                         (signal.SIGKILL, killDeadline))
+
+    def SetSoftRestart(self, enabled, landTimeout=10.0):
+        """
+        Keeps PX4 and Gazebo running between simulations. StopSITL then lands and disarms the vehicle, moves it back
+        to its spawn pose and restarts its estimator, and the next StartSITL takes off again over the MAVLink
+        connection that was kept open. Falls back to stopping the simulation when the reset fails.
+        Args:
+            enabled (bool): Reset the session instead of stopping the simulation.
+            landTimeout (float): Seconds of simulation time the vehicle gets to land before it is disarmed in the air.
+        """
+        self._softRestartEnabled = enabled
+        self._softRestartLandTimeout = landTimeout
+
+    def SetSetpointMinimumRate(self, rate):
+        """
+        Sets the rate at which the latest user setpoint is repeated to PX4 while no new one arrives, applied when the
+        next simulation starts. PX4 leaves offboard mode when setpoints arrive slower than 2 Hz.
+        Args:
+            rate (float): Minimum setpoint rate in Hz.
+        """
+        self._setpointMinimumRate = rate
+
+    def SubmitSetpoint(self, setpoint):
+        """
+        Forwards a user setpoint to PX4 without waiting for the MAVLink thread, switching the vehicle to offboard mode
+        with the first one. Setpoints received before the vehicle is ready are dropped.
+        Args:
+            setpoint (Setpoint): The setpoint, copied before this returns.
+        """
+        setpointStreamer = self._setpointStreamer
+        if setpointStreamer is None or not self._initializationCompleted:
+            if self._mavlinkDecoderProcessEnabled and not self._setpointsUnsupportedLogged:
+                self._setpointsUnsupportedLogged = True
+                logging.error("User setpoints need the MAVLink connection and are not forwarded with the MAVLink decoder process.")
+            self._setpointsDroppedCounter.Increment()
+            return
+        setpointStreamer.Submit(setpoint)
+
+    def SetSitlInstancePoolSize(self, poolSize, firstInstanceIndex=1):
+        """
+        Keeps poolSize SITL instances pre-spawned and parked at "Ready for takeoff!", each on its own PX4 instance
+        index and port set. StartSITL claims a warm instance when one is available and the pool replenishes itself
+        in the background. Warm instances are always started directly, see SitlLaunchMode.DIRECT.
+        Args:
+            poolSize (int): Number of warm instances, 0 disables the pool.
+            firstInstanceIndex (int): Lowest PX4 instance index used by the pool. The pool uses
+                SitlInstancePool.GetInstanceIndexCount(poolSize) indices from there on, which must not collide with
+                other vehicles.
+        """
+        if self._sitlInstancePool is not None:
+            self._sitlInstancePool.Terminate()
+            self._sitlInstancePool = None
+        if poolSize > 0:
+            self._sitlInstancePool = SitlInstancePool(poolSize, self._LaunchSitlInstance, firstInstanceIndex)
+            self._sitlInstancePool.Start()
+
+    def SetSitlOutputLogFile(self, logFilePath):
+        """
+        Spills the SITL stdout and stderr lines to a log file, applied when the next simulation starts.
+        Args:
+            logFilePath (str): Path of the file lines are appended to. None keeps them in memory only.
+        """
+        self._sitlOutputLogFilePath = logFilePath
+
+    def AddSitlOutputTrigger(self, pattern, callback, once=True):
+        """
+        Registers a callback for SITL output lines matching a pattern, for example an error signature.
+        Triggers are installed on every SITL process started after the call and run on the output pump threads.
+        Args:
+            pattern (str or re.Pattern): Regular expression searched in every stdout and stderr line.
+            callback (callable): Called with the re.Match object of the matching line.
+            once (bool): Only fire on the first matching line of each SITL process.
+        """
+        self._sitlOutputTriggers.append((pattern, callback, once))
+
+    def GetSitlOutputLines(self):
+        """Returns the (stream name, line) tuples held in the SITL output ring buffer, oldest first."""
+        if self._sitlInstance is None:
+            return []
+        return self._sitlInstance.GetOutputLines()
+
+    def SetPoseEmitPeriod(self, poseEmitPeriod):
+        """
+        Sets how poses are emitted to Unity.
+        Args:
+            poseEmitPeriod (float): Emit the latest pose every poseEmitPeriod seconds. None emits as soon as
+                either the position or the attitude changes.
+        """
+        self._poseEmitPeriod = poseEmitPeriod
+
+    def SetPoseWireFormat(self, poseWireFormat):
+        """
+        Selects the binary layout of the pose datagrams sent to Unity, applied when the next simulation starts.
+        Args:
+            poseWireFormat (PoseWireFormat): PoseWireFormat.LEGACY (default) for the original !6f frame,
+                PoseWireFormat.V1 for the versioned float64 frame, or PoseWireFormat.V2 to add the simulation time.
+        """
+        self._poseWireFormat = poseWireFormat
+
+    def SetPoseTransport(self, poseTransport, pathPrefix=POSE_MAPPED_FILE_PATH_PREFIX):
+        """
+        Selects how poses reach Unity, applied when the next simulation starts.
+        Args:
+            poseTransport (PoseTransport): UDP datagrams, a memory-mapped pose file for a Unity on the same host, or both.
+            pathPrefix (str): Path prefix of the pose files, vehicle N writes "<pathPrefix>-vehicle<N>".
+        """
+        self._poseTransport = poseTransport
+        self._poseMappedFilePathPrefix = pathPrefix
+
+    def SetPoseOutputRate(self, rate, interpolationDelay=0.0):
+        """
+        Sends poses to Unity at a fixed rate, interpolated between or dead-reckoned past the received samples,
+        instead of forwarding each received sample. Applied when the next simulation starts.
+        Args:
+            rate (float): Output rate in Hz, for example 120 or 250. None forwards received samples directly.
+            interpolationDelay (float): How far in the past poses are rendered, in seconds.
+        """
+        if rate is None:
+            self._poseOutputStage = None
+        else:
+            self._poseOutputStage = PoseOutputStage(rate, self._SendMessageFrom10004TransmitSocket, interpolationDelay,
+                                                    speedFactor=self._simSpeedFactor)
+
+    def SetMavlinkDecoderProcess(self, enabled):
+        """
+        Selects where MAVLink is received and decoded, applied when the next simulation starts.
+        Args:
+            enabled (bool): Decode in a separate process that publishes the vehicle state through a shared-memory
+                ring, instead of in the MAVLink thread. Raw MAVLink frames are not recorded in that mode.
+        """
+        self._mavlinkDecoderProcessEnabled = enabled
+
+    def SetMavlinkFastIngest(self, enabled):
+        """
+        Selects how MAVLink is parsed, applied when the next simulation starts.
+        Args:
+            enabled (bool): Parse only the packet headers and unpack the pose and readiness messages with
+                precompiled layouts, skipping every other message undecoded, instead of decoding everything with
+                pymavlink. Also used by the decoder process.
+        """
+        self._mavlinkFastIngestEnabled = enabled
+
+    def SetMavlinkStreamRates(self, streamRates, suppressUnused=False):
+        """
+        Requests MAVLink message rates from PX4 after its first heartbeat and reports the rates actually received,
+        applied when the next simulation starts.
+        Args:
+            streamRates (dict): MAVLink message name to rate in Hz, for example {"GLOBAL_POSITION_INT": 100}. A rate
+                of 0 disables the stream.
+            suppressUnused (bool): Also disable every stream that arrives but is not used for the pose or readiness.
+        """
+        self._mavlinkStreamRates = dict(streamRates)
+        self._suppressUnusedMavlinkStreams = suppressUnused
+
+    def SetTelemetryRecording(self, pathPrefix, recordMavlink=False, capacity=None):
+        """
+        Records every pose sent to Unity, and optionally every received MAVLink message, to memory-mapped files
+        readable with TelemetryRecorder.LoadRecords. Each simulation run gets its own
+        "<pathPrefix>-vehicle<id>-<start time>.pose" and ".mavlink" files. Applied when the next simulation starts.
+        Args:
+            pathPrefix (str): Path prefix of the recordings. None disables recording.
+            recordMavlink (bool): Also record the raw MAVLink frames.
+            capacity (int, optional): Maximum number of records per file, later records are dropped and counted.
+        """
+        self._telemetryRecordPathPrefix = pathPrefix
+        self._telemetryRecordMavlink = recordMavlink
+        self._telemetryRecordCapacity = capacity if capacity is not None else self.TELEMETRY_RECORD_CAPACITY
+
+    def _InitializeMetrics(self):
+        """Creates the metrics of this vehicle."""
+        vehicle = self.vehicleId
+        self._stateDwellTracker = StateDwellTracker("px4_sitl", vehicle=vehicle)
+        self._stateDwellTracker.Transition(self.State.IDLE)
+        self._mavlinkMessagesCounter = registry.Counter("avcimaster_mavlink_messages_total", "MAVLink messages received", vehicle=vehicle)
+        self._mavlinkDecodeHistogram = registry.Histogram("avcimaster_mavlink_decode_seconds", "Time to read and decode one MAVLink message",
+                                                          vehicle=vehicle)
+        self._posesSentCounter = registry.Counter("avcimaster_poses_sent_total", "Pose frames sent to Unity", vehicle=vehicle)
+        self._poseAgeHistogram = registry.Histogram("avcimaster_pose_age_seconds", "Age of the pose sample when its frame is sent",
+                                                    vehicle=vehicle)
+        self._poseSendErrorsCounter = registry.Counter("avcimaster_pose_send_errors_total", "Pose frames that could not be sent",
+                                                       vehicle=vehicle)
+        self._mavlinkDecoderOverrunsCounter = registry.Counter("avcimaster_mavlink_decoder_overruns_total",
+                                                               "Decoded states overwritten in the decoder ring before they were read",
+                                                               vehicle=vehicle)
+        self._sitlProcessErrorsCounter = registry.Counter("avcimaster_sitl_process_errors_total", "SITL processes that exited unexpectedly",
+                                                          vehicle=vehicle)
+        self._mavlinkConnectionErrorsCounter = registry.Counter("avcimaster_mavlink_connection_errors_total",
+                                                                "MAVLink connections that could not be created", vehicle=vehicle)
+        self._sitlStopHistogram = registry.Histogram("avcimaster_sitl_stop_seconds", "Time to stop the SITL processes",
+                                                     vehicle=vehicle)
+        self._setpointsDroppedCounter = registry.Counter("avcimaster_setpoints_dropped_total",
+                                                         "User setpoints dropped because the vehicle was not ready for them", vehicle=vehicle)
+
     def _StartPX4Simulation(self):
         self._sitlRunning = True
         self._sitlTerminate = False
         self._initializationCompleted = False
+        self._sessionRestarted = False
+        self._sitlInstanceCreated.Set(False)
+        self._sessionActive.Set(True)
         self.SetState(self.State.START_REQUESTED)
         self._sitlThread = threading.Thread(target=self._RunPX4Simulation, daemon=True)
         self._mavlinkThread = threading.Thread(target=self._RunMavlink, daemon=True)
@@ -84,164 +483,562 @@ class PX4SITLProcessController:
         self.SetState(self.State.STOPPED)
 
     def _RunPX4Simulation(self):
-        self._takeOffCommandSendToSitl = False
+        self._takeOffCommandSendToSitl.Set(False)
         
         processStartedWithoutError = self._TryToCreateSitlProcess()
+        self._sitlInstanceCreated.Set(processStartedWithoutError)
             
         print("SITL process created successfully." if processStartedWithoutError else "Failed to create SITL process.")
+        sitlProcessRunning = False
         if processStartedWithoutError:
-            self._SitlProcessRunControl()
+            sitlProcessRunning = self._SitlProcessRunControl()
 
         while not self._sitlTerminate:
-            if not self._takeOffCommandSendToSitl:
+            if not self._takeOffCommandSendToSitl.Get() and self._sessionActive.Get():
                 self.SetState(self.State.INITIALIZING_SITL_PROCESS)
                 self._SitlPreTakeoffInitialization()
+                if not self._takeOffCommandSendToSitl.Get():
+                    sitlProcessRunning = self._SitlProcessRunControl()
+                    if not sitlProcessRunning:
+                        break
             else:
                 sitlProcessRunning = self._SitlProcessRunControl()
                 if not sitlProcessRunning:
                     break
-                time.sleep(0.1)
+                if self._takeOffCommandSendToSitl.Get():
+                    time.sleep(0.1)
+                else:
+                    self._sessionActive.Wait(0.1) # Between soft restarted sessions, woken by the next start
 
-        if processStartedWithoutError and sitlProcessRunning:
+        if processStartedWithoutError:
+            # Also after an unexpected exit, whatever the dead process left behind in its group is stopped
             self._SitlProcessTerminateAndWait()
 
         self._sitlRunning = False
         
     def _Initialize10004TransmitSocket(self):
         self._Socket10004 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._poseFrameEncoder = PoseFrameEncoder(self._poseWireFormat)
+        if self._poseTransport is not PoseTransport.UDP:
+            self._CreatePoseMappedFileWriter()
         
-    def _SendMessageFrom10004TransmitSocket(self, lat, lon, alt, roll, pitch, yaw):
-        data = struct.pack("!6f", lat, lon, alt, roll, pitch, yaw)
-        self._Socket10004.sendto(data, ("127.0.0.1", 10004))
+    def _Close10004TransmitSocket(self):
+        if self._Socket10004 is not None:
+            self._Socket10004.close()
+            self._Socket10004 = None
+
+    def _SendMessageFrom10004TransmitSocket(self, pose):
+        pose.sequence = self._poseFrameEncoder.GetNextSequence()
+        data = self._poseFrameEncoder.Encode(pose)
+        if self._poseMappedFileWriter is not None:
+            self._poseMappedFileWriter.Write(data)
+        if self._poseTransport is not PoseTransport.SHM:
+            try:
+                self._Socket10004.sendto(data, ("127.0.0.1", self._posePort))
+            except OSError as e:
+                self._poseSendErrorsCounter.Increment()
+                logging.error(f"Error sending pose of vehicle {self.vehicleId}: {e}")
+                return
+        self._posesSentCounter.Increment()
+        self._poseAgeHistogram.Observe(time.monotonic() - pose.timestamp)
+        if self._telemetryRecorder is not None:
+            self._telemetryRecorder.RecordPose(pose)
+
+    def _CreatePoseMappedFileWriter(self):
+        path = GetPoseMappedFilePath(self._poseMappedFilePathPrefix, self.vehicleId)
+        try:
+            self._poseMappedFileWriter = PoseMappedFileWriter(path, self._poseFrameEncoder.GetFrameSize(), self._poseWireFormat)
+            print(f"Writing poses to {path}")
+        except OSError as e:
+            logging.error(f"Error creating pose file {path}: {e}")
+
+    def _ClosePoseMappedFileWriter(self):
+        if self._poseMappedFileWriter is not None:
+            self._poseMappedFileWriter.Close()
+            self._poseMappedFileWriter = None
+
+    def _CreateTelemetryRecorder(self):
+        if self._telemetryRecordPathPrefix is None:
+            return
+        pathPrefix = f"{self._telemetryRecordPathPrefix}-vehicle{self.vehicleId}-{time.strftime('%Y%m%d-%H%M%S')}"
+        try:
+            self._telemetryRecorder = TelemetryRecorder(pathPrefix, self._telemetryRecordCapacity, self._telemetryRecordMavlink)
+            print(f"Recording telemetry to {self._telemetryRecorder.posePath}")
+        except OSError as e:
+            logging.error(f"Error creating telemetry recording {pathPrefix}: {e}")
+
+    def _CloseTelemetryRecorder(self):
+        if self._telemetryRecorder is not None:
+            self._telemetryRecorder.Close()
+            self._telemetryRecorder = None
 
     def _RunMavlink(self):
         self._mavlinkRunning = True
 
-        # Wait until takeoff command
-        print("Waiting for takeoff command to be sent to SITL to start mavlink.")
-        while not self._takeOffCommandSendToSitl and not self._sitlTerminate:
-            time.sleep(0.1)
+        if self._UsesMavlinkCommands():
+            # The takeoff is sent over MAVLink, so the connection comes up as soon as the SITL instance exists and
+            # the SITL thread reports INITIALIZING_MAVLINK once PX4 accepted it
+            print("Connecting MAVLink for the takeoff commands.")
+            while not self._sitlTerminate:
+                if self._sitlInstanceCreated.Wait(self.READY_FOR_TAKEOFF_WAIT_TIMEOUT):
+                    break
+        else:
+            # Wait until takeoff command
+            print("Waiting for takeoff command to be sent to SITL to start mavlink.")
+            while not self._sitlTerminate:
+                if self._takeOffCommandSendToSitl.Wait(self.READY_FOR_TAKEOFF_WAIT_TIMEOUT):
+                    break
+            self.SetState(self.State.INITIALIZING_MAVLINK)
 
         mavlinkConnection = None
+        mavlinkDecoder = None
+        streamNegotiator = None
+        commandChannel = None
+        setpointStreamer = None
+        connectionFailed = False
+        fastIngest = self._mavlinkFastIngestEnabled
 
-        self.SetState(self.State.INITIALIZING_MAVLINK)
+        # The decoder process may deliver a ready state with its first message, so the output side comes first
+        self._Initialize10004TransmitSocket()
+        self._CreateTelemetryRecorder()
 
         if not self._sitlTerminate:
-            print("Creating MAVLink connection.")
-            while True:
-                try:
-                    mavlinkConnection = mavutil.mavlink_connection('udp:localhost:14540')
-                    break
-                except Exception:
-                    pass
-            
-            print("Waiting for MAVLink heartbeat.")
-            while True:
-                try:
-                    mavlinkConnection.wait_heartbeat()
-                    break
-                except:
-                    pass
+            if self._mavlinkDecoderProcessEnabled:
+                if self._telemetryRecorder is not None and self._telemetryRecordMavlink:
+                    print("Raw MAVLink frames are decoded in the decoder process and are not recorded.")
+                mavlinkDecoder = self._StartMavlinkDecoderProcess()
+                connectionFailed = mavlinkDecoder is None
+            else:
+                streamNegotiator = self._CreateMavlinkStreamNegotiator()
+                if fastIngest:
+                    decodedMessageIds = set(COMMAND_CHANNEL_MESSAGE_IDS)
+                    if streamNegotiator is not None:
+                        decodedMessageIds.update(NEGOTIATION_MESSAGE_IDS)
+                    mavlinkConnection = self._CreateMavlinkFastReceiver(decodedMessageIds)
+                else:
+                    mavlinkConnection = self._CreateMavlinkConnection()
+                connectionFailed = mavlinkConnection is None
+                if mavlinkConnection is not None:
+                    commandChannel = MavlinkCommandChannel(self.vehicleId)
+                    setpointStreamer = OffboardSetpointStreamer(mavlinkConnection, commandChannel, self.vehicleId,
+                                                                self._setpointMinimumRate)
+                    setpointStreamer.Start()
 
-        print("MAVLink connection established.")
+        if connectionFailed:
+            self._ReportMavlinkConnectionError()
+        elif not self._sitlTerminate:
+            print("MAVLink connection established.")
+        self._mavlinkCommandChannel = commandChannel
+        self._setpointStreamer = setpointStreamer
+        self._mavlinkConnected = mavlinkConnection is not None or mavlinkDecoder is not None
 
-        self._Initialize10004TransmitSocket()
-                     
-        lat = 0
-        lon = 0
-        alt = 0
-        roll = 0
-        pitch = 0
-        yaw = 0
-        while not self._sitlTerminate:
-            msg = mavlinkConnection.recv_match(type='GLOBAL_POSITION_INT', blocking=True)
-            if msg:
-                lat = msg.lat / 1e7
-                lon = msg.lon / 1e7
-                alt = msg.alt / 1e3
-                
-            msg = mavlinkConnection.recv_match(type='ATTITUDE', blocking=True)
-            if msg:
-                roll = msg.roll * (180 / 3.14159)
-                pitch = msg.pitch * (180 / 3.14159)
-                yaw = msg.yaw * (180 / 3.14159)
-                
-            if not self._initializationCompleted:
-                self._CheckInitializationByAltitude(alt)
+        def OnFastIngestMessage(messageType, msg):
+            if streamNegotiator is not None:
+                streamNegotiator.Update(mavlinkConnection, msg, messageType)
+            if msg is not None:
+                commandChannel.Update(mavlinkConnection, msg)
+
+        nextPoseEmitTime = time.monotonic()
+        while not self._sitlTerminate and (mavlinkConnection is not None or mavlinkDecoder is not None):
+            if self._poseEmitPeriod is None:
+                receiveTimeout = self.MAVLINK_RECEIVE_TIMEOUT
             else:
-                self._SendMessageFrom10004TransmitSocket(lat, lon, alt, roll, pitch, yaw)
+                receiveTimeout = max(0.0, nextPoseEmitTime - time.monotonic())
+
+            if mavlinkDecoder is not None:
+                mavlinkDecoder.Receive(self._vehicleState, receiveTimeout, self._OnDecodedVehicleState)
+            elif fastIngest:
+                messageCount = mavlinkConnection.Receive(receiveTimeout, self._OnVehicleStateUpdated, OnFastIngestMessage)
+                self._mavlinkMessagesCounter.Increment(messageCount)
+                if streamNegotiator is not None:
+                    streamNegotiator.Update(mavlinkConnection)
+                commandChannel.Update(mavlinkConnection)
+            else:
+                msg = self._ReceiveMavlinkMessage(mavlinkConnection, receiveTimeout)
+                if msg is not None:
+                    if self._telemetryRecorder is not None:
+                        self._telemetryRecorder.RecordMavlinkMessage(msg)
+                    self._vehicleState.HandleMessage(msg)
+                    self._OnVehicleStateUpdated()
+                if streamNegotiator is not None:
+                    streamNegotiator.Update(mavlinkConnection, msg)
+                commandChannel.Update(mavlinkConnection, msg)
+            if streamNegotiator is not None and streamNegotiator.IsCompleted():
+                streamNegotiator = None
+                if fastIngest:
+                    mavlinkConnection.SetDecodedMessageIds(COMMAND_CHANNEL_MESSAGE_IDS)
+
+            if self._poseEmitPeriod is not None and time.monotonic() >= nextPoseEmitTime:
+                self._EmitPose()
+                nextPoseEmitTime += self._poseEmitPeriod
+                if nextPoseEmitTime < time.monotonic():
+                    # Fell behind by more than a tick, resynchronize instead of bursting
+                    nextPoseEmitTime = time.monotonic() + self._poseEmitPeriod
+
+        self._setpointStreamer = None
+        if setpointStreamer is not None:
+            setpointStreamer.Stop()
+        self._mavlinkCommandChannel = None
+        if commandChannel is not None:
+            commandChannel.Close()
+
+        if mavlinkConnection is not None:
+            if fastIngest:
+                mavlinkConnection.Close()
+            else:
+                mavlinkConnection.close()
+
+        if mavlinkDecoder is not None:
+            self._StopMavlinkDecoderProcess(mavlinkDecoder)
+
+        if self._poseOutputStage is not None:
+            self._poseOutputStage.Stop()
 
-        mavlinkConnection.close()
+        self._Close10004TransmitSocket()
+        self._ClosePoseMappedFileWriter()
+        self._CloseTelemetryRecorder()
         
+        self._mavlinkConnected = False
         self._mavlinkRunning = False
 
+    def _ReportMavlinkConnectionError(self):
+        """Stops the simulation like a SITL process error, without MAVLink the vehicle neither takes off nor sends poses."""
+        logging.error(f"MAVLink connection of vehicle {self.vehicleId} could not be created.")
+        self._mavlinkConnectionErrorsCounter.Increment()
+        self._processErrorCallback()
+        self._sitlTerminate = True
+
+    def _CreateMavlinkConnection(self):
+        """Connects to the MAVLink port of the SITL instance and waits for its first heartbeat."""
+        print("Creating MAVLink connection.")
+        while True:
+            try:
+                mavlinkConnection = mavutil.mavlink_connection(f'udp:localhost:{self._sitlInstance.mavlinkPort}')
+                break
+            except Exception:
+                pass
+        
+        print("Waiting for MAVLink heartbeat.")
+        while not self._sitlTerminate:
+            try:
+                if mavlinkConnection.wait_heartbeat(timeout=self.MAVLINK_RECEIVE_TIMEOUT) is not None:
+                    break
+            except:
+                pass
+        self._vehicleState.Reset()
+        return mavlinkConnection
+
+    def _CreateMavlinkFastReceiver(self, decodedMessageIds):
+        """Binds the fast MAVLink receiver to the MAVLink port of the SITL instance and waits for its first heartbeat."""
+        print("Creating MAVLink fast receiver.")
+        try:
+            mavlinkFastReceiver = MavlinkFastReceiver(self._sitlInstance.mavlinkPort, self._vehicleState)
+        except OSError as e:
+            logging.error(f"Error binding MAVLink port {self._sitlInstance.mavlinkPort}: {e}")
+            return None
+        mavlinkFastReceiver.SetDecodedMessageIds(decodedMessageIds)
+        if self._telemetryRecordMavlink:
+            mavlinkFastReceiver.SetTelemetryRecorder(self._telemetryRecorder)
+
+        print("Waiting for MAVLink heartbeat.")
+        self._vehicleState.Reset()
+        while not self._sitlTerminate and self._vehicleState.systemStatus is None:
+            mavlinkFastReceiver.Receive(self.MAVLINK_RECEIVE_TIMEOUT, lambda: None)
+        self._vehicleState.Reset()
+        return mavlinkFastReceiver
+
+    def _CreateMavlinkStreamNegotiator(self):
+        if not self._mavlinkStreamRates and not self._suppressUnusedMavlinkStreams:
+            return None
+        return MavlinkStreamNegotiator(self._mavlinkStreamRates, self._suppressUnusedMavlinkStreams,
+                                       self._vehicleState.GetMessageTypes(), self.vehicleId)
+
+    def _StartMavlinkDecoderProcess(self):
+        """
+        Starts the MAVLink decoder process of the SITL instance and waits until it decodes the first message.
+        Returns None if the process or its ring could not be created, or the process exited before publishing.
+        """
+        print("Starting MAVLink decoder process.")
+        self._vehicleState.Reset()
+        try:
+            mavlinkDecoder = MavlinkDecoderProcess(self._sitlInstance.mavlinkPort, self.vehicleId, streamRates=self._mavlinkStreamRates,
+                                                   suppressUnusedStreams=self._suppressUnusedMavlinkStreams,
+                                                   fastIngest=self._mavlinkFastIngestEnabled)
+        except OSError as e:
+            logging.error(f"Error creating the MAVLink decoder process of vehicle {self.vehicleId}: {e}")
+            return None
+        try:
+            mavlinkDecoder.Start()
+        except OSError as e:
+            logging.error(f"Error starting the MAVLink decoder process of vehicle {self.vehicleId}: {e}")
+            self._StopMavlinkDecoderProcess(mavlinkDecoder)
+            return None
+        print("Waiting for MAVLink messages.")
+        while not self._sitlTerminate:
+            if mavlinkDecoder.Receive(self._vehicleState, self.MAVLINK_RECEIVE_TIMEOUT, self._OnDecodedVehicleState) > 0:
+                break
+            if not mavlinkDecoder.IsRunning():
+                logging.error(f"MAVLink decoder process of vehicle {self.vehicleId} exited.")
+                self._StopMavlinkDecoderProcess(mavlinkDecoder)
+                return None
+        return mavlinkDecoder
+
+    def _StopMavlinkDecoderProcess(self, mavlinkDecoder):
+        self._mavlinkDecoderOverrunsCounter.Increment(mavlinkDecoder.GetOverrunCount())
+        mavlinkDecoder.Stop()
+
+    def _OnDecodedVehicleState(self, decodeTime):
+        """Called for every state snapshot read from the decoder process."""
+        self._mavlinkDecodeHistogram.Observe(decodeTime)
+        self._mavlinkMessagesCounter.Increment()
+        self._OnVehicleStateUpdated()
+
+    def _OnVehicleStateUpdated(self):
+        if not self._initializationCompleted and self._takeOffCommandSendToSitl.Get():
+            self._CheckInitialization()
+        if self._poseEmitPeriod is None and self._vehicleState.poseChanged:
+            self._EmitPose()
+
+    def _ReceiveMavlinkMessage(self, mavlinkConnection, timeout):
+        """
+        Returns the next MAVLink message, waiting up to timeout seconds for one, or None.
+        Unlike recv_match, which polls at half the timeout, this wakes as soon as a datagram arrives, and it times
+        the decoding of each message separately from the wait.
+        """
+        decodeStartTime = time.perf_counter()
+        msg = mavlinkConnection.recv_msg()
+        if msg is None:
+            if not mavlinkConnection.select(timeout):
+                return None
+            decodeStartTime = time.perf_counter()
+            msg = mavlinkConnection.recv_msg()
+            if msg is None:
+                return None
+        self._mavlinkDecodeHistogram.Observe(time.perf_counter() - decodeStartTime)
+        self._mavlinkMessagesCounter.Increment()
+        return msg
+
+    def _EmitPose(self):
+        """Sends the latest pose to Unity once initialized, combining the most recent position and attitude."""
+        self._vehicleState.poseChanged = False
+        if not self._initializationCompleted:
+            return
+        if self._poseOutputStage is not None:
+            self._poseOutputStage.PushSample(self._vehicleState.pose)
+        else:
+            self._SendMessageFrom10004TransmitSocket(self._vehicleState.pose)
+
     def _CreateSitlProcess(self):
-        """Creates the SITL process with the appropriate environment."""
-        sitlProcessCommand = "HEADLESS=1 make px4_sitl gazebo-classic"
-        sitlProcessDirectory = os.path.join("..", "avcipilot")
+        """Claims a warm SITL instance from the pool, or launches a new one when none is available."""
+        if self._sitlInstancePool is not None:
+            self._sitlInstance = self._sitlInstancePool.Claim()
+            if self._sitlInstance is not None:
+                print(f"Claimed warm SITL instance {self._sitlInstance.instanceIndex}.")
+                return
+            print("No warm SITL instance available, launching a new one.")
+        self._sitlInstance = self._LaunchSitlInstance(self.vehicleId)
 
+    def _LaunchSitlInstance(self, instanceIndex):
+        """Launches a SITL instance with the appropriate environment and starts draining its output."""
         systemEnvironment = os.environ.copy()
         sitlEnvironment = systemEnvironment
+        # The Gazebo world origin, shared by every vehicle. Each vehicle spawns in its own slot off the origin, so
+        # the vehicles report distinct geodetic poses and homes.
         sitlEnvironment["PX4_HOME_LAT"] = "1.0"
         sitlEnvironment["PX4_HOME_LON"] = "1.0"
         sitlEnvironment["PX4_HOME_ALT"] = "0.0"
+        if self._simSpeedFactor != 1.0:
+            sitlEnvironment["PX4_SIM_SPEED_FACTOR"] = f"{self._simSpeedFactor:g}"
 
-        print(f"Creating SITL process with command: {sitlProcessCommand}")
-        self._sitlProcess = subprocess.Popen(
-                        sitlProcessCommand,
-                        cwd=sitlProcessDirectory,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        stdin=subprocess.PIPE,
-                        shell=True,
-                        text=True,
-                        env=sitlEnvironment
-                    )
+        launchMode = self._sitlLaunchMode
+        if instanceIndex != 0 and launchMode is not SitlLaunchMode.EXTERNAL:
+            launchMode = SitlLaunchMode.DIRECT
+        # Spawned by vehicle rather than instance index, warm instances of a vehicle take any index of its pool
+        sitlInstance = self._sitlLauncher.Launch(launchMode, sitlEnvironment, instanceIndex, self._cpuAffinity, self.vehicleId)
+
+        sitlInstance.SetStopSignalDeadlines(self._sitlStopSignalDeadlines)
+
+        logFilePath = self._sitlOutputLogFilePath
+        if logFilePath is not None and instanceIndex != 0:
+            logFilePath = f"{logFilePath}.{instanceIndex}"
+        sitlInstance.StartOutputPump(logFilePath, self._sitlOutputTriggers)
+        return sitlInstance
 
     def _SendCommandToSitlProcess(self, command):
         """Sends a command to the SITL process."""
-        try:
-            self._sitlProcess.stdin.write(command + "\n")
-            self._sitlProcess.stdin.flush()
-        except Exception as e:
-            logging.error(f"Error sending command: {e}")
+        self._sitlInstance.SendCommand(command)
 
     def _IsSitlReadyToTakeoff(self):
-        for line in self._sitlProcess.stdout:
-            if line.__contains__("Ready for takeoff!"):
-                return True
-        return False
+        if not self._sitlInstance.WaitReadyForTakeoff(self.READY_FOR_TAKEOFF_WAIT_TIMEOUT):
+            return False
+        if self._UsesMavlinkCommands() and self._mavlinkCommandChannel is None:
+            ready = False # The connection the takeoff is sent on is not up yet
+        elif self._sessionRestarted and not self._sitlInstance.IsExternal():
+            # PX4 does not announce readiness again after a session reset, it is read from the restarted estimator
+            ready = not self._vehicleState.armed and self._IsEstimatorHealthy()
+        else:
+            return True
+        if not ready:
+            time.sleep(self.READY_FOR_TAKEOFF_WAIT_TIMEOUT)
+        return ready
     
     def _IsSitlProcessRunning(self):
-        exitCode = self._sitlProcess.poll()
-        if exitCode is not None:
-            return False
-        return True
+        return self._sitlInstance.IsRunning()
     
     def _SitlProcessRunControl(self):
         sitlProcessRunning = self._IsSitlProcessRunning()
         if not sitlProcessRunning:
+            self._sitlProcessErrorsCounter.Increment()
             self._processErrorCallback()
             self._sitlTerminate = True
         return sitlProcessRunning
     
+    def _UsesMavlinkCommands(self):
+        """Commands go over MAVLink unless the decoder process owns the MAVLink socket, then the NSH shell is used."""
+        return not self._mavlinkDecoderProcessEnabled
+
+    def _RunVehicleCommand(self, shellCommand, command, *params):
+        """
+        Sends a MAVLink command and waits for PX4 to accept it, or writes the equivalent NSH command line when
+        commands cannot go over MAVLink.
+        Returns:
+            bool: False if PX4 rejected or did not acknowledge the command.
+        """
+        commandChannel = self._mavlinkCommandChannel
+        if commandChannel is None:
+            self._SendCommandToSitlProcess(shellCommand)
+            return True
+        return commandChannel.SendCommand(command, *params).Wait()
+
     def _InitializeAndTakeOff(self):
-        self._SendCommandToSitlProcess("param set MPC_TKO_SPEED 5")
-        self._SendCommandToSitlProcess("param set MIS_TAKEOFF_ALT 50")
-        self._SendCommandToSitlProcess("commander takeoff")
-        
+        """
+        Sets the takeoff parameters and takes off, each step once the previous one is acknowledged.
+        Returns:
+            bool: False if PX4 rejected or did not acknowledge a step.
+        """
+        commandChannel = self._mavlinkCommandChannel
+        if commandChannel is None:
+            self._SendCommandToSitlProcess(f"param set MPC_TKO_SPEED {self._takeoffSpeed}")
+            self._SendCommandToSitlProcess(f"param set MIS_TAKEOFF_ALT {self._takeoffAltitude}")
+            self._SendCommandToSitlProcess("commander takeoff")
+            return True
+        # The parameters are independent and sent together
+        parameterRequests = [commandChannel.SetParameter("MPC_TKO_SPEED", self._takeoffSpeed),
+                             commandChannel.SetParameter("MIS_TAKEOFF_ALT", self._takeoffAltitude)]
+        if not all([request.Wait() for request in parameterRequests]):
+            return False
+        # Like "commander takeoff": switch to the takeoff mode, then arm. NaN yaw, position and altitude take off in
+        # place to MIS_TAKEOFF_ALT.
+        if not commandChannel.SendCommand(mavutil.mavlink.MAV_CMD_NAV_TAKEOFF, 0, 0, 0, math.nan, math.nan, math.nan, math.nan).Wait():
+            return False
+        return commandChannel.SendCommand(mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, 1).Wait()
+
     def _SitlPreTakeoffInitialization(self):
         takeoffReady = self._IsSitlReadyToTakeoff()
         if takeoffReady:
             print("SITL is ready for takeoff.")
-            self._InitializeAndTakeOff()
+            if not self._sessionRestarted:
+                self._PrintStartupPhaseDurations()
+            if not self._InitializeAndTakeOff():
+                logging.error(f"Takeoff of vehicle {self.vehicleId} failed, trying again.")
+                time.sleep(self.TAKEOFF_RETRY_PERIOD)
+                return
             print("Takeoff command sent to SITL.")
-            self._takeOffCommandSendToSitl = True
+            self._takeOffCommandSendToSitl.Set(True)
+            if self._mavlinkConnected:
+                # The MAVLink thread is already connected and only waits for the readiness policy
+                self.SetState(self.State.INITIALIZING_MAVLINK)
             
+    def _PrintStartupPhaseDurations(self):
+        phases = ", ".join(f"{name} {duration:.2f} s" for name, duration in self.GetStartupPhaseDurations().items())
+        print(f"SITL startup phases: {phases}")
+
     def _SitlProcessTerminateAndWait(self):
-        self._sitlProcess.terminate()
-        self._sitlProcess.wait()
+        self._sitlInstance.Terminate()
+        self._sitlStopHistogram.Observe(self._sitlInstance.stopDuration)
+        stopSignal = self._sitlInstance.stopSignal
+        if stopSignal is not None:
+            registry.Counter("avcimaster_sitl_stop_signals_total", "Stop signals that had to be sent to the SITL processes",
+                             vehicle=self.vehicleId, signal=stopSignal.name).Increment()
+        print(f"SITL instance {self._sitlInstance.instanceIndex} stopped in {self._sitlInstance.stopDuration:.2f} s"
+              f"{', after ' + stopSignal.name if stopSignal is not None else ''}.")
         
+    def _IsSessionResetPossible(self):
+        return (self._softRestartEnabled and self._sitlRunning and not self._sitlTerminate and self._mavlinkConnected
+                and self._sessionActive.Get())
+
+    def _IsSessionRestartPossible(self):
+        return (self._softRestartEnabled and self._sitlRunning and not self._sitlTerminate and self._mavlinkConnected
+                and not self._sessionActive.Get())
+
+    def _StartSession(self):
+        self._initializationCompleted = False
+        self._sessionRestarted = True
+        self.SetState(self.State.START_REQUESTED)
+        self._sessionActive.Set(True)
+
+    def _ResetSession(self):
+        """Ends the session and brings the vehicle back to its initial state, runs on its own thread."""
+        resetStartTime = time.perf_counter()
+        self._sessionActive.Set(False)
+        self._takeOffCommandSendToSitl.Set(False)
+        self._initializationCompleted = False
+        if self._setpointStreamer is not None:
+            self._setpointStreamer.Clear()
+        if self._poseOutputStage is not None:
+            self._poseOutputStage.Stop()
+        self._sessionResetSucceeded = self._sitlInstance.IsExternal() or self._ResetVehicle()
+        if self._sessionResetSucceeded:
+            print(f"SITL session reset in {time.perf_counter() - resetStartTime:.2f} s.")
+
+    def _ResetVehicle(self):
+        """Lands and disarms the vehicle, puts it back at its spawn pose and restarts its estimator."""
+        vehicleState = self._vehicleState
+        if vehicleState.armed:
+            self._RunVehicleCommand("commander land", mavutil.mavlink.MAV_CMD_NAV_LAND, 0, 0, 0, math.nan, math.nan, math.nan, math.nan)
+            self._WaitForVehicle(lambda: vehicleState.landedState == mavutil.mavlink.MAV_LANDED_STATE_ON_GROUND or not vehicleState.armed,
+                                 self._softRestartLandTimeout)
+            self._RunVehicleCommand("commander disarm -f", mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, 0, FORCE_DISARM_MAGIC)
+            if not self._WaitForVehicle(lambda: not vehicleState.armed, self.SESSION_RESET_DISARM_TIMEOUT):
+                logging.error(f"Vehicle {self.vehicleId} did not disarm.")
+                return False
+        if not self._sitlInstance.ResetModels():
+            return False
+        # The estimator would otherwise reject the teleported vehicle
+        estimatorReported = vehicleState.estimatorFlags is not None
+        estimatorReportCount = vehicleState.estimatorReportCount
+        heartbeatCount = vehicleState.heartbeatCount
+        self._SendCommandToSitlProcess("ekf2 stop")
+        self._SendCommandToSitlProcess("ekf2 start")
+        # The health reported before the restart must not pass the readiness checks of the next session. With the
+        # decoder process the next record restores the old values, so only a report counted afterwards is trusted.
+        vehicleState.estimatorFlags = None
+        vehicleState.systemStatus = None
+        if estimatorReported:
+            freshReport = lambda: vehicleState.estimatorReportCount != estimatorReportCount
+        else:
+            # PX4 does not stream the estimator status, readiness falls back to the heartbeat
+            freshReport = lambda: vehicleState.heartbeatCount != heartbeatCount
+        if not self._WaitForVehicle(freshReport, self.SESSION_RESET_ESTIMATOR_TIMEOUT):
+            logging.error(f"Restarted estimator of vehicle {self.vehicleId} did not report.")
+            return False
+        return True
+
+    def _WaitForVehicle(self, condition, timeout):
+        """
+        Waits until condition() holds, for at most timeout seconds of simulation time. Returns whether it did.
+        The wait is also bounded in wall-clock time, by timeout at the slowest, in case the simulation stalls or
+        its messages carry no time.
+        """
+        pose = self._vehicleState.pose
+        endSimTime = pose.simTime + timeout if pose.simTime else math.inf
+        endTime = time.monotonic() + timeout / min(self._simSpeedFactor, 1.0)
+        while not condition():
+            if self._sitlTerminate or time.monotonic() >= endTime or pose.simTime >= endSimTime:
+                return False
+            time.sleep(self.SESSION_RESET_POLL_PERIOD / max(self._simSpeedFactor, 1.0))
+        return True
+
     def _TryToCreateSitlProcess(self):
         try:
             self._CreateSitlProcess()
@@ -251,11 +1048,37 @@ class PX4SITLProcessController:
             self._sitlTerminate = True
             return False
         
-    def _CheckInitializationByAltitude(self, alt):
-        if alt > 48.0:
+    def _IsEstimatorHealthy(self):
+        if self._vehicleState.estimatorFlags is not None:
+            return (self._vehicleState.estimatorFlags & self.EKF_HEALTHY_FLAGS) == self.EKF_HEALTHY_FLAGS
+        # Without estimator status, PX4 only reports standby or active once its preflight checks pass
+        return self._vehicleState.systemStatus in (mavutil.mavlink.MAV_STATE_STANDBY, mavutil.mavlink.MAV_STATE_ACTIVE)
+
+    def _CheckInitialization(self):
+        """Completes initialization once the configured readiness policy is satisfied."""
+        match self._readinessPolicy:
+            case self.ReadinessPolicy.HEARTBEAT_EKF_HEALTHY:
+                ready = self._IsEstimatorHealthy()
+            case self.ReadinessPolicy.ARMED:
+                ready = self._vehicleState.armed
+            case self.ReadinessPolicy.IN_AIR:
+                ready = self._vehicleState.landedState == mavutil.mavlink.MAV_LANDED_STATE_IN_AIR
+            case self.ReadinessPolicy.TAKEOFF_ACCEPTED:
+                ready = True # Only checked once the takeoff went through
+            case _:
+                ready = self._CheckInitializationByAltitude(self._vehicleState.relativeAltitude)
+
+        if ready:
             self._initializationCompleted = True
             self.SetState(self.State.STARTED)
-            print("SITL initialization completed successfully.")
-        else:
+            print(f"SITL initialization completed successfully ({self._readinessPolicy.name}).")
+            if self._poseOutputStage is not None:
+                self._poseOutputStage.Start()
+
+    def _CheckInitializationByAltitude(self, alt):
+        if alt > self._readyAltitude:
+            return True
+        if self._vehicleState.poseChanged:
             print(f"Current altitude: {alt} m")
-            print('\033[F\033[K', end='')
\ No newline at end of file
+            print('\033[F\033[K', end='')
+        return False
@@ -0,0 +1,206 @@
+import struct
+from enum import Enum
+
+
+class PoseWireFormat(Enum):
+    """Binary layouts of the pose datagrams sent to Unity on port 10004."""
+    LEGACY = 0
+    V1 = 1
+    V2 = 2
+
+
+POSE_FRAME_MAGIC = 0xA7
+
+# Vehicle 0 sends its poses to POSE_PORT, vehicle N > 0 to MULTI_VEHICLE_POSE_BASE_PORT + N.
+POSE_PORT = 10004
+MULTI_VEHICLE_POSE_BASE_PORT = 10100
+
+POSE_FRAME_FLAG_VELOCITY = 0b00000001
+POSE_FRAME_FLAG_ANGULAR_RATE = 0b00000010
+POSE_FRAME_FLAG_EXTRAPOLATED = 0b00000100
+
+# Legacy frame: lat, lon, alt, roll, pitch, yaw as big-endian float32.
+LEGACY_POSE_FRAME = struct.Struct("!6f")
+
+# V1 frame, big-endian, 76 bytes:
+#   magic (u8), version (u8), flags (u8), vehicle id (u8), sequence (u32), monotonic timestamp in ns (u64),
+#   lat, lon (deg, float64), alt (m AMSL, float64), roll, pitch, yaw (deg, float32),
+#   velocity north, east, down (m/s, float32), roll, pitch, yaw rate (deg/s, float32).
+# Velocity and angular rate are only meaningful when the matching flag bit is set. The extrapolated flag marks
+# frames that were dead-reckoned past the latest received sample.
+POSE_FRAME_V1 = struct.Struct("!BBBBIQ3d3f3f3f")
+
+# V2 frame, big-endian, 84 bytes: the V1 frame followed by the simulation time in ns (u64), the PX4 boot time of
+# the pose. PX4 runs in lockstep with the simulator, so it advances with the simulation speed factor rather than
+# the wall clock.
+POSE_FRAME_V2 = struct.Struct("!BBBBIQ3d3f3f3fQ")
+
+POSE_FRAME_STRUCTS = {PoseWireFormat.LEGACY: LEGACY_POSE_FRAME, PoseWireFormat.V1: POSE_FRAME_V1, PoseWireFormat.V2: POSE_FRAME_V2}
+
+
+def GetPosePort(vehicleId):
+    """Returns the UDP port Unity receives the poses of a vehicle on."""
+    if vehicleId == 0:
+        return POSE_PORT
+    return MULTI_VEHICLE_POSE_BASE_PORT + vehicleId
+
+
+class PoseSample:
+    """
+    Mutable pose sample. A single instance is updated in place for every MAVLink message so the
+    telemetry hot path does not allocate a new object per sample.
+    """
+    __slots__ = ("timestamp", "lat", "lon", "alt", "roll", "pitch", "yaw",
+                 "velocityNorth", "velocityEast", "velocityDown",
+                 "rollRate", "pitchRate", "yawRate",
+                 "hasVelocity", "hasAngularRate", "extrapolated", "vehicleId", "sequence", "simTime")
+
+    def __init__(self):
+        self.Reset()
+
+    def Reset(self):
+        """Reset every field to zero and mark the optional components as missing."""
+        self.timestamp = 0.0
+        self.lat = 0.0
+        self.lon = 0.0
+        self.alt = 0.0
+        self.roll = 0.0
+        self.pitch = 0.0
+        self.yaw = 0.0
+        self.velocityNorth = 0.0
+        self.velocityEast = 0.0
+        self.velocityDown = 0.0
+        self.rollRate = 0.0
+        self.pitchRate = 0.0
+        self.yawRate = 0.0
+        self.hasVelocity = False
+        self.hasAngularRate = False
+        self.extrapolated = False
+        self.vehicleId = 0
+        self.sequence = 0
+        # Simulation time in seconds, 0 when unknown
+        self.simTime = 0.0
+
+    def CopyFrom(self, other):
+        """Copy every field of another sample into this one."""
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+
+
+class PoseFrameEncoder:
+    """
+    Packs pose samples into a reused buffer with a precompiled struct layout.
+    The returned buffer is overwritten by the next Encode call.
+    """
+
+    def __init__(self, wireFormat=PoseWireFormat.V1):
+        """
+        Args:
+            wireFormat (PoseWireFormat): Layout of the encoded frames.
+        """
+        self._wireFormat = wireFormat
+        self._frameStruct = POSE_FRAME_STRUCTS[wireFormat]
+        self._buffer = bytearray(self._frameStruct.size)
+        self._sequence = 0
+
+    def GetWireFormat(self):
+        return self._wireFormat
+
+    def GetFrameSize(self):
+        """Returns the size of the encoded frames in bytes."""
+        return self._frameStruct.size
+
+    def GetNextSequence(self):
+        """Returns the sequence number the next encoded V1 or V2 frame will carry."""
+        return self._sequence
+
+    def Encode(self, pose):
+        """
+        Encodes a pose sample.
+
+        Args:
+            pose (PoseSample): The sample to encode.
+
+        Returns:
+            bytearray: The encoded frame, valid until the next call.
+        """
+        if self._wireFormat is PoseWireFormat.LEGACY:
+            self._frameStruct.pack_into(self._buffer, 0, pose.lat, pose.lon, pose.alt, pose.roll, pose.pitch, pose.yaw)
+            return self._buffer
+
+        flags = 0
+        if pose.hasVelocity:
+            flags |= POSE_FRAME_FLAG_VELOCITY
+        if pose.hasAngularRate:
+            flags |= POSE_FRAME_FLAG_ANGULAR_RATE
+        if pose.extrapolated:
+            flags |= POSE_FRAME_FLAG_EXTRAPOLATED
+
+        if self._wireFormat is PoseWireFormat.V1:
+            self._frameStruct.pack_into(
+                self._buffer, 0,
+                POSE_FRAME_MAGIC, PoseWireFormat.V1.value, flags, pose.vehicleId,
+                self._sequence, int(pose.timestamp * 1e9),
+                pose.lat, pose.lon, pose.alt,
+                pose.roll, pose.pitch, pose.yaw,
+                pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+                pose.rollRate, pose.pitchRate, pose.yawRate)
+        else:
+            self._frameStruct.pack_into(
+                self._buffer, 0,
+                POSE_FRAME_MAGIC, PoseWireFormat.V2.value, flags, pose.vehicleId,
+                self._sequence, int(pose.timestamp * 1e9),
+                pose.lat, pose.lon, pose.alt,
+                pose.roll, pose.pitch, pose.yaw,
+                pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+                pose.rollRate, pose.pitchRate, pose.yawRate, int(pose.simTime * 1e9))
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+        return self._buffer
+
+
+class PoseFrameDecoder:
+    """Unpacks pose frames of any supported version into a reused pose sample."""
+
+    def __init__(self):
+        self._pose = PoseSample()
+
+    def Decode(self, data):
+        """
+        Decodes a pose frame. Frames of the legacy size are decoded as legacy frames.
+
+        Args:
+            data (bytes-like): The received datagram.
+
+        Returns:
+            PoseSample: The decoded sample, overwritten by the next call, or None if the frame is not recognized.
+        """
+        pose = self._pose
+        if len(data) == LEGACY_POSE_FRAME.size:
+            pose.Reset()
+            pose.lat, pose.lon, pose.alt, pose.roll, pose.pitch, pose.yaw = LEGACY_POSE_FRAME.unpack_from(data)
+            return pose
+
+        if len(data) < POSE_FRAME_V1.size or data[0] != POSE_FRAME_MAGIC:
+            return None
+
+        if data[1] == PoseWireFormat.V1.value:
+            (_, _, flags, pose.vehicleId, pose.sequence, timestampNs,
+             pose.lat, pose.lon, pose.alt,
+             pose.roll, pose.pitch, pose.yaw,
+             pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+             pose.rollRate, pose.pitchRate, pose.yawRate) = POSE_FRAME_V1.unpack_from(data)
+            pose.simTime = 0.0
+        elif data[1] == PoseWireFormat.V2.value and len(data) >= POSE_FRAME_V2.size:
+            (_, _, flags, pose.vehicleId, pose.sequence, timestampNs,
+             pose.lat, pose.lon, pose.alt,
+             pose.roll, pose.pitch, pose.yaw,
+             pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+             pose.rollRate, pose.pitchRate, pose.yawRate, simTimeNs) = POSE_FRAME_V2.unpack_from(data)
+            pose.simTime = simTimeNs / 1e9
+        else:
+            return None
+        pose.timestamp = timestampNs / 1e9
+        pose.hasVelocity = bool(flags & POSE_FRAME_FLAG_VELOCITY)
+        pose.hasAngularRate = bool(flags & POSE_FRAME_FLAG_ANGULAR_RATE)
+        pose.extrapolated = bool(flags & POSE_FRAME_FLAG_EXTRAPOLATED)
+        return pose
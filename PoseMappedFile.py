@@ -0,0 +1,148 @@
+import os
+import mmap
+import struct
+from enum import Enum
+
+from PoseFrame import PoseWireFormat
+
+
+class PoseTransport(Enum):
+    """How pose frames reach Unity."""
+    UDP = 0
+    SHM = 1
+    BOTH = 2
+
+
+POSE_MAPPED_FILE_MAGIC = 0x4D505641 # "AVPM"
+POSE_MAPPED_FILE_VERSION = 1
+# Default path prefix of the pose files, on tmpfs so that writing a pose never touches a disk.
+POSE_MAPPED_FILE_PATH_PREFIX = "/dev/shm/avcimaster-pose"
+
+# Header, little-endian, 64 bytes: magic (u32), layout version (u16), pose wire format (u8), reserved (u8),
+# frame size (u32), slot count (u32), write sequence (u64), slot size (u32), reserved up to the first slot.
+POSE_MAPPED_FILE_HEADER = struct.Struct("<IHBBIIQI")
+POSE_MAPPED_FILE_HEADER_SIZE = 64
+WRITE_SEQUENCE_OFFSET = 16
+WRITE_SEQUENCE = struct.Struct("<Q")
+# Every slot starts with its sequence, 2n + 1 while frame n is being written and 2n + 2 once it is complete, followed
+# by the encoded pose frame exactly as it would be sent over UDP.
+SLOT_SEQUENCE = struct.Struct("<Q")
+
+
+def GetPoseMappedFilePath(pathPrefix, vehicleId):
+    """Returns the pose file of a vehicle."""
+    return f"{pathPrefix}-vehicle{vehicleId}"
+
+
+class PoseMappedFileWriter:
+    """
+    Publishes pose frames to Unity through a memory-mapped file instead of a socket. The file holds the last slotCount
+    frames in a ring; slot (writeSequence - 1) % slotCount is the latest. Writing a frame is a memory copy without a
+    system call, and a reader that only wants the latest pose never has a backlog to drain.
+
+    Readers use the per-slot sequence as a seqlock: read the slot sequence, copy the frame, read the slot sequence
+    again and accept the copy only if both reads are equal to 2n + 2. Readers in other languages need acquire loads
+    for the sequences. The write sequence restarts at 0 with every simulation run.
+    """
+
+    def __init__(self, path, frameSize, wireFormat=PoseWireFormat.V1, slotCount=64):
+        """
+        Args:
+            path (str): Pose file, created or reused.
+            frameSize (int): Size of the stored frames in bytes.
+            wireFormat (PoseWireFormat): Layout of the stored frames, recorded in the header.
+            slotCount (int): Number of frames of history kept.
+        """
+        self.path = path
+        self._frameSize = frameSize
+        self._slotCount = slotCount
+        # Slots are 8-byte aligned so the sequences can be read atomically
+        self._slotSize = (SLOT_SEQUENCE.size + frameSize + 7) & ~7
+        fileSize = POSE_MAPPED_FILE_HEADER_SIZE + slotCount * self._slotSize
+        fileDescriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fileDescriptor, fileSize)
+            self._mmap = mmap.mmap(fileDescriptor, fileSize)
+        finally:
+            os.close(fileDescriptor)
+        self._writeSequence = 0
+        # The header goes first, a reader of the previous run sees an empty file rather than cleared slots
+        POSE_MAPPED_FILE_HEADER.pack_into(self._mmap, 0, POSE_MAPPED_FILE_MAGIC, POSE_MAPPED_FILE_VERSION, wireFormat.value, 0,
+                                          frameSize, slotCount, 0, self._slotSize)
+        self._mmap[POSE_MAPPED_FILE_HEADER_SIZE:] = bytes(fileSize - POSE_MAPPED_FILE_HEADER_SIZE)
+
+    def Write(self, frame):
+        """Publishes an encoded pose frame as the latest one."""
+        sequence = self._writeSequence
+        offset = POSE_MAPPED_FILE_HEADER_SIZE + (sequence % self._slotCount) * self._slotSize
+        frameOffset = offset + SLOT_SEQUENCE.size
+        SLOT_SEQUENCE.pack_into(self._mmap, offset, 2 * sequence + 1)
+        self._mmap[frameOffset:frameOffset + self._frameSize] = frame
+        SLOT_SEQUENCE.pack_into(self._mmap, offset, 2 * sequence + 2)
+        self._writeSequence = sequence + 1
+        WRITE_SEQUENCE.pack_into(self._mmap, WRITE_SEQUENCE_OFFSET, self._writeSequence)
+
+    def Close(self):
+        """Unmaps the file. It is left in place for readers that still map it."""
+        self._mmap.close()
+
+
+class PoseMappedFileReader:
+    """Reads the pose frames of a PoseMappedFileWriter, the reference for the Unity side of the layout."""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Pose file written by a PoseMappedFileWriter.
+        """
+        self.path = path
+        with open(path, "rb") as mappedFile:
+            self._mmap = mmap.mmap(mappedFile.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, wireFormat, _, self._frameSize, self._slotCount, _,
+         self._slotSize) = POSE_MAPPED_FILE_HEADER.unpack_from(self._mmap, 0)
+        if magic != POSE_MAPPED_FILE_MAGIC or version != POSE_MAPPED_FILE_VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a version {POSE_MAPPED_FILE_VERSION} pose file.")
+        self.wireFormat = PoseWireFormat(wireFormat)
+
+    def GetWriteSequence(self):
+        """Returns the number of frames written in the current run."""
+        return WRITE_SEQUENCE.unpack_from(self._mmap, WRITE_SEQUENCE_OFFSET)[0]
+
+    def ReadFrame(self, sequence):
+        """
+        Reads frame number sequence.
+
+        Returns:
+            bytes: The frame, or None if it is not written yet, was overwritten or was being written.
+        """
+        offset = POSE_MAPPED_FILE_HEADER_SIZE + (sequence % self._slotCount) * self._slotSize
+        frameOffset = offset + SLOT_SEQUENCE.size
+        slotSequence = SLOT_SEQUENCE.unpack_from(self._mmap, offset)[0]
+        if slotSequence != 2 * sequence + 2:
+            return None
+        frame = self._mmap[frameOffset:frameOffset + self._frameSize]
+        if SLOT_SEQUENCE.unpack_from(self._mmap, offset)[0] != slotSequence:
+            return None
+        return frame
+
+    def ReadLatest(self):
+        """
+        Reads the latest frame, retrying while the writer overtakes the read.
+
+        Returns:
+            tuple: The frame sequence and the frame, or (None, None) if no complete frame is available.
+        """
+        writeSequence = self.GetWriteSequence()
+        while writeSequence != 0:
+            frame = self.ReadFrame(writeSequence - 1)
+            if frame is not None:
+                return writeSequence - 1, frame
+            previousWriteSequence = writeSequence
+            writeSequence = self.GetWriteSequence()
+            if writeSequence == previousWriteSequence:
+                break # Not overtaken, the writer stopped in the middle of a frame
+        return None, None
+
+    def Close(self):
+        self._mmap.close()
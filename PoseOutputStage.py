@@ -0,0 +1,162 @@
+import math
+import threading
+import time
+
+from PoseFrame import PoseSample
+
+EARTH_RADIUS = 6378137.0
+
+
+def _WrapAngle(angle):
+    """Wraps an angle in degrees to [-180, 180)."""
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+def _InterpolateAngle(start, end, fraction):
+    """Interpolates between two angles in degrees along the shortest arc."""
+    return _WrapAngle(start + _WrapAngle(end - start) * fraction)
+
+
+class PoseOutputStage:
+    """
+    Fixed-rate output stage between the MAVLink reader and the pose sender.
+
+    The reader pushes every updated sample. A dedicated thread emits one pose per tick, rendered
+    interpolationDelay seconds in the past: between two received samples the pose is interpolated,
+    past the latest sample it is dead-reckoned from velocity and angular rate and marked as extrapolated.
+    Ticks are in wall-clock time, dead reckoning advances the vehicle by the simulation time that passed meanwhile.
+    """
+
+    def __init__(self, rate, sendCallback, interpolationDelay=0.0, maxExtrapolationTime=0.5, speedFactor=1.0):
+        """
+        Args:
+            rate (float): Output rate in Hz, for example 120 or 250.
+            sendCallback (callable): Called with the rendered PoseSample on every tick. The sample is reused.
+            interpolationDelay (float): How far in the past poses are rendered, in seconds. A delay of about one
+                telemetry period lets most frames be interpolated instead of extrapolated.
+            maxExtrapolationTime (float): Dead reckoning is clamped to this many seconds past the latest sample.
+            speedFactor (float): Simulation seconds per wall-clock second.
+        """
+        self._period = 1.0 / rate
+        self._sendCallback = sendCallback
+        self._interpolationDelay = interpolationDelay
+        self._maxExtrapolationTime = maxExtrapolationTime
+        self._speedFactor = speedFactor
+        self._mutex = threading.Lock()
+        self._previousSample = PoseSample()
+        self._latestSample = PoseSample()
+        self._sampleCount = 0
+        self._output = PoseSample()
+        self._thread = None
+        self._running = False
+
+    def SetSpeedFactor(self, speedFactor):
+        """Sets the simulation seconds per wall-clock second used for dead reckoning."""
+        self._speedFactor = speedFactor
+
+    def Start(self):
+        """Starts the output thread."""
+        if self._running:
+            return
+        with self._mutex:
+            self._sampleCount = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        """Stops the output thread and waits for it to finish."""
+        if not self._running:
+            return
+        self._running = False
+        self._thread.join()
+        self._thread = None
+
+    def PushSample(self, pose):
+        """
+        Stores a newly received sample. Samples must be pushed in timestamp order.
+
+        Args:
+            pose (PoseSample): The sample, copied so the caller may keep updating it.
+        """
+        with self._mutex:
+            if self._sampleCount > 0 and pose.timestamp <= self._latestSample.timestamp:
+                self._latestSample.CopyFrom(pose)
+                return
+            self._previousSample, self._latestSample = self._latestSample, self._previousSample
+            self._latestSample.CopyFrom(pose)
+            self._sampleCount += 1
+
+    def _run(self):
+        deadline = time.monotonic()
+        while self._running:
+            deadline += self._period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind by more than a tick, resynchronize instead of bursting
+                deadline = time.monotonic()
+
+            if self._Render(time.monotonic() - self._interpolationDelay):
+                self._sendCallback(self._output)
+
+    def _Render(self, renderTime):
+        """
+        Renders the pose at renderTime into the output sample.
+
+        Returns:
+            bool: False if no sample has been received yet.
+        """
+        output = self._output
+        with self._mutex:
+            if self._sampleCount == 0:
+                return False
+            latest = self._latestSample
+            previous = self._previousSample
+            if renderTime >= latest.timestamp:
+                output.CopyFrom(latest)
+            elif self._sampleCount > 1 and renderTime > previous.timestamp:
+                fraction = (renderTime - previous.timestamp) / (latest.timestamp - previous.timestamp)
+                self._Interpolate(previous, latest, fraction)
+            elif self._sampleCount > 1:
+                output.CopyFrom(previous)
+            else:
+                output.CopyFrom(latest)
+
+        if renderTime > output.timestamp:
+            self._Extrapolate(min(renderTime - output.timestamp, self._maxExtrapolationTime))
+        output.timestamp = renderTime
+        return True
+
+    def _Interpolate(self, start, end, fraction):
+        output = self._output
+        output.CopyFrom(end)
+        output.lat = start.lat + (end.lat - start.lat) * fraction
+        output.lon = start.lon + (end.lon - start.lon) * fraction
+        output.alt = start.alt + (end.alt - start.alt) * fraction
+        output.roll = _InterpolateAngle(start.roll, end.roll, fraction)
+        output.pitch = _InterpolateAngle(start.pitch, end.pitch, fraction)
+        output.yaw = _InterpolateAngle(start.yaw, end.yaw, fraction)
+        output.velocityNorth = start.velocityNorth + (end.velocityNorth - start.velocityNorth) * fraction
+        output.velocityEast = start.velocityEast + (end.velocityEast - start.velocityEast) * fraction
+        output.velocityDown = start.velocityDown + (end.velocityDown - start.velocityDown) * fraction
+        if start.simTime:
+            output.simTime = start.simTime + (end.simTime - start.simTime) * fraction
+        output.extrapolated = False
+
+    def _Extrapolate(self, elapsed):
+        """Dead-reckons the output sample forward by elapsed wall-clock seconds."""
+        output = self._output
+        output.extrapolated = True
+        elapsed *= self._speedFactor
+        if output.simTime:
+            output.simTime += elapsed
+        if output.hasVelocity:
+            output.lat += math.degrees(output.velocityNorth * elapsed / EARTH_RADIUS)
+            output.lon += math.degrees(output.velocityEast * elapsed / (EARTH_RADIUS * math.cos(math.radians(output.lat))))
+            output.alt -= output.velocityDown * elapsed
+        if output.hasAngularRate:
+            output.roll = _WrapAngle(output.roll + output.rollRate * elapsed)
+            output.pitch = _WrapAngle(output.pitch + output.pitchRate * elapsed)
+            output.yaw = _WrapAngle(output.yaw + output.yawRate * elapsed)
@@ -0,0 +1,195 @@
+import threading
+import socket
+import time
+import logging
+
+from SharedData import SharedData
+from Metrics import registry, StateDwellTracker
+from PoseFrame import PoseFrameEncoder, PoseSample, PoseWireFormat, GetPosePort
+from PX4SITLProcessController import PX4SITLProcessController
+from TelemetryRecorder import PoseRecordReader
+from PoseMappedFile import PoseTransport, PoseMappedFileWriter, GetPoseMappedFilePath, POSE_MAPPED_FILE_PATH_PREFIX
+
+
+class PoseReplayController:
+    """
+    Feeds Unity from a pose recording made with TelemetryRecorder instead of a PX4 SITL simulation.
+    It has the interface and the State transitions of PX4SITLProcessController, so AvciMaster, Unity and the user
+    see the same protocol without PX4 or Gazebo running.
+    """
+    State = PX4SITLProcessController.State
+
+    # Waits longer than this are split, so a stop request is never delayed by a gap in the recording.
+    MAX_WAIT = 0.1
+
+    def __init__(self, recordingPath, vehicleId=0):
+        """
+        Args:
+            recordingPath (str): Pose recording to replay.
+            vehicleId (int): Vehicle the poses are sent as, selects the pose port and is sent in every pose frame.
+        """
+        self.vehicleId = vehicleId
+        self.state = SharedData(self.State.IDLE)
+        self._stateDwellTracker = StateDwellTracker("pose_replay", vehicle=vehicleId)
+        self._stateDwellTracker.Transition(self.State.IDLE)
+        self._posesSentCounter = registry.Counter("avcimaster_poses_sent_total", "Pose frames sent to Unity", vehicle=vehicleId)
+        self._reader = PoseRecordReader(recordingPath)
+        self._replaySpeed = 1.0
+        self._startOffset = 0.0
+        self._replayIndex = SharedData(0)
+        self._replayThread = None
+        self._replayTerminate = threading.Event()
+        self._processErrorCallback = None
+        self._updateEvent = None
+        self._posePort = GetPosePort(vehicleId)
+        self._poseWireFormat = PoseWireFormat.LEGACY
+        self._poseTransport = PoseTransport.UDP
+        self._poseMappedFilePathPrefix = POSE_MAPPED_FILE_PATH_PREFIX
+        self._pose = PoseSample()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def Terminate(self):
+        self.StopSITL()
+        self._socket.close()
+        self._reader.Close()
+
+    def StartSITL(self):
+        if self._replayThread is None:
+            print(f"Starting pose replay of {self._reader.path}")
+            self._StartReplay()
+
+    def RequestStopSITL(self):
+        """Starts stopping the replay without waiting for it, StopSITL waits."""
+        self._replayTerminate.set()
+
+    def SubmitSetpoint(self, setpoint):
+        """Ignores user setpoints, a replay cannot be steered."""
+        pass
+
+    def StopSITL(self):
+        if self._replayThread is not None:
+            self._StopReplay()
+
+    def GetState(self):
+        return self.state.Get()
+
+    def SetState(self, value):
+        previousValue = self.state.GetAndSet(value)
+        if previousValue is not value:
+            self._stateDwellTracker.Transition(value)
+            if self._updateEvent is not None:
+                self._updateEvent.Set()
+
+    def SetProcessErrorCallback(self, processErrorCallback):
+        self._processErrorCallback = processErrorCallback
+
+    def SetUpdateEvent(self, updateEvent):
+        """Sets the SharedEvent signalled on every state change."""
+        self._updateEvent = updateEvent
+
+    def SetPoseWireFormat(self, poseWireFormat):
+        """Selects the binary layout of the pose datagrams, applied when the next replay starts."""
+        self._poseWireFormat = poseWireFormat
+
+    def SetPoseTransport(self, poseTransport, pathPrefix=POSE_MAPPED_FILE_PATH_PREFIX):
+        """Selects how poses reach Unity, applied when the next replay starts. See PX4SITLProcessController.SetPoseTransport."""
+        self._poseTransport = poseTransport
+        self._poseMappedFilePathPrefix = pathPrefix
+
+    def SetReplaySpeed(self, replaySpeed):
+        """
+        Sets the replay speed as a multiple of real time, applied when the next replay starts.
+        Args:
+            replaySpeed (float): 1.0 replays in real time, 10.0 ten times faster. 0 or None sends the poses as fast
+                as possible.
+        """
+        self._replaySpeed = replaySpeed if replaySpeed else None
+
+    def Seek(self, startOffset):
+        """
+        Sets where the next replay starts.
+        Args:
+            startOffset (float): Seconds from the first pose of the recording.
+        """
+        self._startOffset = startOffset
+
+    def GetReplayPosition(self):
+        """Returns the number of poses sent and the number of poses in the recording."""
+        return self._replayIndex.Get(), len(self._reader)
+
+    def _StartReplay(self):
+        self._replayTerminate.clear()
+        self.SetState(self.State.START_REQUESTED)
+        self._replayThread = threading.Thread(target=self._RunReplay, daemon=True)
+        self._replayThread.start()
+
+    def _StopReplay(self):
+        self._replayTerminate.set()
+        self._replayThread.join()
+        self._replayThread = None
+        self.SetState(self.State.STOPPED)
+
+    def _RunReplay(self):
+        # There is no process to start, the intermediate states are only passed through for protocol parity
+        self.SetState(self.State.INITIALIZING_SITL_PROCESS)
+        if len(self._reader) == 0:
+            logging.error(f"Pose recording {self._reader.path} is empty.")
+            if self._processErrorCallback is not None:
+                self._processErrorCallback()
+            return
+        self.SetState(self.State.INITIALIZING_MAVLINK)
+
+        encoder = PoseFrameEncoder(self._poseWireFormat)
+        firstTimestamp = self._reader.GetTimestamp(0)
+        index = self._reader.FindIndex(firstTimestamp + self._startOffset)
+        self._replayIndex.Set(index)
+        self.SetState(self.State.STARTED)
+        if index >= len(self._reader):
+            return
+
+        poseMappedFileWriter = None
+        if self._poseTransport is not PoseTransport.UDP:
+            path = GetPoseMappedFilePath(self._poseMappedFilePathPrefix, self.vehicleId)
+            try:
+                poseMappedFileWriter = PoseMappedFileWriter(path, encoder.GetFrameSize(), self._poseWireFormat)
+            except OSError as e:
+                logging.error(f"Error creating pose file {path}: {e}")
+        sendUdp = self._poseTransport is not PoseTransport.SHM
+
+        replaySpeed = self._replaySpeed
+        recordStartTime = self._reader.GetTimestamp(index)
+        replayStartTime = time.monotonic()
+        pose = self._pose
+        destination = ("127.0.0.1", self._posePort)
+        while index < len(self._reader) and not self._replayTerminate.is_set():
+            self._reader.ReadPose(index, pose)
+            recordOffset = pose.timestamp - recordStartTime
+            if replaySpeed is not None:
+                recordOffset /= replaySpeed
+                if not self._WaitUntil(replayStartTime + recordOffset):
+                    break
+            # Timestamps keep the recorded spacing, scaled by the replay speed
+            pose.timestamp = replayStartTime + recordOffset
+            pose.vehicleId = self.vehicleId
+            frame = encoder.Encode(pose)
+            if poseMappedFileWriter is not None:
+                poseMappedFileWriter.Write(frame)
+            if sendUdp:
+                self._socket.sendto(frame, destination)
+            self._posesSentCounter.Increment()
+            index += 1
+            self._replayIndex.Set(index)
+
+        if poseMappedFileWriter is not None:
+            poseMappedFileWriter.Close()
+        if index >= len(self._reader):
+            print(f"Pose replay of vehicle {self.vehicleId} reached the end of the recording.")
+
+    def _WaitUntil(self, deadline):
+        """Waits until a time.monotonic() deadline. Returns False if the replay was stopped meanwhile."""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            if self._replayTerminate.wait(min(remaining, self.MAX_WAIT)):
+                return False
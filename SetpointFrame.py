@@ -0,0 +1,105 @@
+import time
+import struct
+from enum import Enum
+
+
+class SetpointType(Enum):
+    """What a setpoint frame commands, each is forwarded to PX4 as its own MAVLink message."""
+    POSITION = 0
+    VELOCITY = 1
+    ATTITUDE = 2
+
+
+# Setpoint types by wire value, looked up without constructing the enum.
+SETPOINT_TYPES = tuple(SetpointType)
+
+# The two low bits are clear, so the magic byte never reads as start or stop message bits.
+SETPOINT_FRAME_MAGIC = 0xA4
+SETPOINT_FRAME_VERSION = 1
+
+# Setpoint frame sent by the user to port 10002, big-endian, 32 bytes:
+#   magic (u8), version (u8), setpoint type (u8), vehicle id (u8), sequence (u32), timestamp in ns (u64),
+#   four float32 values:
+#     POSITION: north, east, down in m in the local frame, yaw in deg
+#     VELOCITY: north, east, down in m/s, yaw in deg
+#     ATTITUDE: roll, pitch, yaw in deg, thrust from 0 to 1
+# The timestamp is time.monotonic_ns() of the sender when the setpoint was created. Senders on the AvciMaster
+# host share its clock, which makes the forwarding latency measurable.
+SETPOINT_FRAME = struct.Struct("!BBBBIQ4f")
+
+
+class Setpoint:
+    """
+    Mutable setpoint. A single instance is decoded into for every received frame so the command path does not
+    allocate a new object per setpoint.
+    """
+    __slots__ = ("setpointType", "vehicleId", "sequence", "timestamp", "values")
+
+    def __init__(self):
+        self.setpointType = SetpointType.POSITION
+        self.vehicleId = 0
+        self.sequence = 0
+        self.timestamp = 0
+        self.values = [0.0, 0.0, 0.0, 0.0]
+
+    def CopyFrom(self, other):
+        """Copy every field of another setpoint into this one."""
+        self.setpointType = other.setpointType
+        self.vehicleId = other.vehicleId
+        self.sequence = other.sequence
+        self.timestamp = other.timestamp
+        self.values[:] = other.values
+
+
+class SetpointFrameEncoder:
+    """Encodes setpoints into a reused buffer, the reference for the user side of the layout."""
+
+    def __init__(self):
+        self._buffer = bytearray(SETPOINT_FRAME.size)
+        self._sequence = 0
+
+    def Encode(self, setpointType, vehicleId, values, timestamp=None):
+        """
+        Encodes a setpoint. The returned buffer is overwritten by the next call.
+        Args:
+            setpointType (SetpointType): What the values command.
+            vehicleId (int): Vehicle the setpoint is for.
+            values (sequence): The four values of the setpoint type.
+            timestamp (int, optional): Creation time in time.monotonic_ns(), now if omitted.
+
+        Returns:
+            bytearray: The encoded frame.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        SETPOINT_FRAME.pack_into(self._buffer, 0, SETPOINT_FRAME_MAGIC, SETPOINT_FRAME_VERSION, setpointType.value,
+                                 vehicleId, self._sequence, timestamp, *values)
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+        return self._buffer
+
+
+def IsSetpointFrame(buffer, size):
+    """Returns whether a received datagram is a setpoint frame rather than message bits."""
+    return size == SETPOINT_FRAME.size and buffer[0] == SETPOINT_FRAME_MAGIC
+
+
+def DecodeSetpointFrame(buffer, setpoint):
+    """
+    Decodes a setpoint frame into setpoint.
+
+    Returns:
+        bool: False if the frame has an unknown version or setpoint type.
+    """
+    fields = SETPOINT_FRAME.unpack_from(buffer, 0)
+    if fields[1] != SETPOINT_FRAME_VERSION or fields[2] >= len(SETPOINT_TYPES):
+        return False
+    setpoint.setpointType = SETPOINT_TYPES[fields[2]]
+    setpoint.vehicleId = fields[3]
+    setpoint.sequence = fields[4]
+    setpoint.timestamp = fields[5]
+    values = setpoint.values
+    values[0] = fields[6]
+    values[1] = fields[7]
+    values[2] = fields[8]
+    values[3] = fields[9]
+    return True
@@ -1,24 +1,200 @@
 import threading
+import time
+from collections import deque
 
 class SharedData:
-    """Thread-safe shared data container."""
+    """Thread-safe shared data container. Waiters block on a condition variable instead of polling."""
     def __init__(self, initialData=None):
         self.data = initialData
-        self._mutex = threading.Lock()
+        self._condition = threading.Condition(threading.Lock())
 
     def Set(self, newValue):
-        """Set the shared data to a new value."""
-        with self._mutex:
+        """Set the shared data to a new value and wake the waiting threads."""
+        with self._condition:
             self.data = newValue
+            self._condition.notify_all()
 
     def Get(self):
         """Get a copy of the shared data."""
-        with self._mutex:
+        with self._condition:
             return self.data
 
     def GetAndSet(self, newValue):
         """Get the current value and set a new value atomically."""
-        with self._mutex:
+        with self._condition:
             copy = self.data
             self.data = newValue
-            return copy
\ No newline at end of file
+            self._condition.notify_all()
+            return copy
+
+    def Wait(self, timeout=None, predicate=bool):
+        """
+        Block until the data satisfies a predicate or the timeout expires.
+        Args:
+            timeout (float, optional): Maximum wait in seconds, None waits indefinitely.
+            predicate (callable): Called with the data, truthiness by default.
+        Returns:
+            The data at the time the wait ended.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: predicate(self.data), timeout)
+            return self.data
+
+    def WaitAndReset(self, resetValue=False, timeout=None, predicate=bool):
+        """
+        Block until the data satisfies a predicate, then replace it with resetValue in the same lock acquisition.
+        Returns:
+            The data that satisfied the predicate, or resetValue if the timeout expired first.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: predicate(self.data), timeout):
+                return resetValue
+            copy = self.data
+            self.data = resetValue
+            return copy
+
+class SharedFlags:
+    """
+    Thread-safe set of boolean flags kept as the bits of one integer, so several flags are set, read or cleared
+    under a single lock acquisition. Waiters block until any of the flags they wait for is set.
+    """
+    def __init__(self):
+        self._flags = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def Set(self, mask):
+        """Set every flag in mask and wake the waiting threads."""
+        if not mask:
+            return
+        with self._condition:
+            self._flags |= mask
+            self._condition.notify_all()
+
+    def Take(self, mask):
+        """Clear the flags in mask. Returns True if any of them was set."""
+        with self._condition:
+            taken = self._flags & mask
+            self._flags &= ~mask
+            return bool(taken)
+
+    def TakeAll(self):
+        """Snapshot and clear every flag at once. Returns the bits that were set."""
+        with self._condition:
+            flags = self._flags
+            self._flags = 0
+            return flags
+
+    def Peek(self):
+        """Returns the bits currently set without clearing them."""
+        with self._condition:
+            return self._flags
+
+    def Wait(self, mask=~0, timeout=None):
+        """Block until any flag in mask is set or the timeout expires. Returns the bits of mask that are set."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._flags & mask, timeout)
+            return self._flags & mask
+
+    def WaitAndTake(self, mask=~0, timeout=None):
+        """Block until any flag in mask is set, then clear and return the set bits of mask, 0 on timeout."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._flags & mask, timeout)
+            taken = self._flags & mask
+            self._flags &= ~mask
+            return taken
+
+class SharedEvent:
+    """Thread-safe waitable event that remembers when it was last set."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._mutex = threading.Lock()
+        self._setTime = None
+
+    def Set(self):
+        """Set the event, waking every waiting thread, and record the time it was set."""
+        with self._mutex:
+            self._setTime = time.perf_counter()
+            self._event.set()
+
+    def Clear(self):
+        """Clear the event so the next Wait blocks until it is set again."""
+        self._event.clear()
+
+    def Wait(self, timeout=None):
+        """Block until the event is set or the timeout expires. Returns True if the event is set."""
+        return self._event.wait(timeout)
+
+    def GetSetTime(self):
+        """Get the time.perf_counter() timestamp of the last Set, or None if it was never set."""
+        with self._mutex:
+            return self._setTime
+
+class SharedQueue:
+    """
+    Thread-safe bounded FIFO. When it is full, new items are rejected and counted instead of replacing queued
+    ones, so the order of accepted items is never disturbed and losses are visible.
+    """
+    def __init__(self, capacity):
+        self._items = deque()
+        self._capacity = capacity
+        self._overflowCount = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def Put(self, item):
+        """Append an item. Returns False if the queue was full and the item was dropped."""
+        return self.PutMany((item,)) == 1
+
+    def PutMany(self, items):
+        """Append several items in one lock acquisition. Returns the number of items accepted, the rest are dropped."""
+        with self._condition:
+            accepted = min(len(items), self._capacity - len(self._items))
+            self._items.extend(items[:accepted])
+            self._overflowCount += len(items) - accepted
+            if accepted:
+                self._condition.notify_all()
+            return accepted
+
+    def Get(self, timeout=0):
+        """Remove and return the oldest item, waiting up to timeout seconds for one (None waits indefinitely). Returns None if empty."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items, timeout):
+                return None
+            return self._items.popleft()
+
+    def TakeMatching(self, predicate):
+        """
+        Remove and return the oldest item satisfying a predicate, discarding every item queued before it. Without
+        such an item the whole queue is discarded.
+
+        Returns:
+            tuple: The item, None if there was none, and the number of discarded items.
+        """
+        with self._condition:
+            discardedCount = 0
+            while self._items:
+                item = self._items.popleft()
+                if predicate(item):
+                    return item, discardedCount
+                discardedCount += 1
+            return None, discardedCount
+
+    def TakeAll(self):
+        """Remove and return every queued item, oldest first."""
+        with self._condition:
+            items = list(self._items)
+            self._items.clear()
+            return items
+
+    def Wait(self, timeout=None):
+        """Block until the queue is not empty or the timeout expires. Returns True if it is not empty."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._items, timeout)
+
+    def GetOverflowCount(self):
+        """Returns the number of items dropped because the queue was full."""
+        with self._condition:
+            return self._overflowCount
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
@@ -0,0 +1,250 @@
+import threading
+import subprocess
+import signal
+import time
+import os
+import logging
+
+from SitlOutputPump import SitlOutputPump
+
+# PX4 adds the instance index to each of these ports when started with "-i <index>".
+MAVLINK_BASE_PORT = 14540
+SIMULATOR_BASE_PORT = 4560
+GAZEBO_MASTER_BASE_PORT = 11345
+
+# Default stop escalation: each signal is sent to the process groups, and the next one follows if they are not
+# gone within its deadline in seconds. PX4 and gzserver shut down cleanly on SIGINT.
+STOP_SIGNAL_DEADLINES = ((signal.SIGINT, 3.0), (signal.SIGTERM, 2.0), (signal.SIGKILL, 1.0))
+# How often the process groups are checked while waiting for them to exit.
+STOP_POLL_PERIOD = 0.01
+
+
+def IsProcessGroupAlive(processGroupId):
+    """
+    Returns whether a process group still has a running member. Zombies do not count, orphans in a container
+    whose init reaps them late would otherwise keep a killed group alive. Without /proc any member counts.
+    """
+    try:
+        processIds = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        processIds = None
+    if processIds is None:
+        try:
+            os.killpg(processGroupId, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+    for processId in processIds:
+        try:
+            with open(f"/proc/{processId}/stat", "rb") as statFile:
+                stat = statFile.read()
+        except OSError:
+            continue # Exited while scanning
+        # The command name may contain spaces, the fields after it are state, parent pid and process group
+        fields = stat[stat.rfind(b")") + 2:].split()
+        if int(fields[2]) == processGroupId and fields[0] != b"Z":
+            return True
+    return False
+
+
+def TerminateProcessGroups(processes, signalDeadlines=STOP_SIGNAL_DEADLINES):
+    """
+    Stops processes started in their own session together with every process they spawned, escalating through
+    the signals until the process groups are gone. Never blocks longer than the sum of the deadlines.
+
+    Args:
+        processes (list): subprocess.Popen objects started with start_new_session=True.
+        signalDeadlines (tuple): (signal, deadline in seconds) pairs, in escalation order.
+
+    Returns:
+        signal.Signals: The last signal that had to be sent, or None if the groups were already gone.
+    """
+    processGroupIds = [process.pid for process in processes]
+
+    def GetAliveProcessGroupIds():
+        for process in processes:
+            process.poll() # Reaps the group leader
+        return [processGroupId for processGroupId in processGroupIds if IsProcessGroupAlive(processGroupId)]
+
+    lastSignal = None
+    aliveGroupIds = GetAliveProcessGroupIds()
+    for stopSignal, deadline in signalDeadlines:
+        if not aliveGroupIds:
+            return lastSignal
+        lastSignal = stopSignal
+        for processGroupId in aliveGroupIds:
+            try:
+                os.killpg(processGroupId, stopSignal)
+            except ProcessLookupError:
+                pass
+        endTime = time.monotonic() + deadline
+        aliveGroupIds = GetAliveProcessGroupIds()
+        while aliveGroupIds and time.monotonic() < endTime:
+            time.sleep(STOP_POLL_PERIOD)
+            aliveGroupIds = GetAliveProcessGroupIds()
+
+    if aliveGroupIds:
+        logging.error(f"Process groups {aliveGroupIds} survived {lastSignal.name}.")
+    return lastSignal
+
+
+def TerminateInstances(instances):
+    """Terminates SITL instances in parallel, so the stop takes as long as the slowest one instead of their sum."""
+    threads = [threading.Thread(target=instance.Terminate, daemon=True) for instance in instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class SitlInstance:
+    """
+    A launched PX4 SITL simulation: its px4 (or make) process, the optional gzserver process, the output pump
+    draining both, readiness tracking and the port set derived from its instance index.
+    An instance without a px4 process stands for a simulation started outside of avcimaster, which is assumed to
+    be running and ready for takeoff for as long as it is attached.
+    """
+
+    READY_FOR_TAKEOFF_PATTERN = "Ready for takeoff!"
+    # Orphaned children may keep the output pipes open, so the pump is not waited on indefinitely.
+    OUTPUT_PUMP_JOIN_TIMEOUT = 2.0
+    # Resets only the model poses, resetting the simulation time as well would move the lockstep clock of PX4 backwards.
+    RESET_MODELS_COMMAND = ["gz", "world", "-o"]
+    RESET_MODELS_TIMEOUT = 5.0
+
+    def __init__(self, instanceIndex, px4Process, gazeboProcess=None, launchTime=None):
+        """
+        Args:
+            instanceIndex (int): PX4 instance index, determines the port set.
+            px4Process (subprocess.Popen): The px4 process, or the shell running make. None for an external simulation.
+            gazeboProcess (subprocess.Popen, optional): The gzserver process when started directly.
+            launchTime (float, optional): time.perf_counter() timestamp at which the launch began.
+        """
+        self.instanceIndex = instanceIndex
+        self.mavlinkPort = MAVLINK_BASE_PORT + instanceIndex
+        self._px4Process = px4Process
+        self._gazeboProcess = gazeboProcess
+        self._launchTime = time.perf_counter() if launchTime is None else launchTime
+        self._phaseDurations = {}
+        self._readyForTakeoff = threading.Event()
+        self._outputPump = None
+        self._stopSignalDeadlines = STOP_SIGNAL_DEADLINES
+        self.stopDuration = None
+        self.stopSignal = None
+        if px4Process is None:
+            self._readyForTakeoff.set()
+
+    def StartOutputPump(self, logFilePath=None, outputTriggers=()):
+        """
+        Starts draining the process output and installs the readiness trigger and the given triggers.
+
+        Args:
+            logFilePath (str, optional): File the output lines are appended to.
+            outputTriggers (iterable): (pattern, callback, once) tuples, see SitlOutputPump.AddTrigger.
+        """
+        if self._px4Process is None:
+            return
+        self._outputPump = SitlOutputPump(logFilePath=logFilePath)
+        self._outputPump.AddTrigger(self.READY_FOR_TAKEOFF_PATTERN, self._OnReadyForTakeoff)
+        for pattern, callback, once in outputTriggers:
+            self._outputPump.AddTrigger(pattern, callback, once)
+        self._outputPump.Start(self._px4Process, "px4")
+        if self._gazeboProcess is not None:
+            self._outputPump.Start(self._gazeboProcess, "gzserver")
+
+    def SetStopSignalDeadlines(self, signalDeadlines):
+        """
+        Sets the stop escalation.
+        Args:
+            signalDeadlines (tuple): (signal, deadline in seconds) pairs, in escalation order.
+        """
+        self._stopSignalDeadlines = tuple(signalDeadlines)
+
+    def AddPhaseDuration(self, name, duration):
+        """Records the duration of a startup phase in seconds."""
+        self._phaseDurations[name] = duration
+
+    def GetPhaseDurations(self):
+        """
+        Returns:
+            dict: Startup phase name to duration in seconds, in the order the phases ran.
+        """
+        return dict(self._phaseDurations)
+
+    def GetOutputLines(self):
+        """Returns the (stream name, line) tuples held in the output ring buffer, oldest first."""
+        if self._outputPump is None:
+            return []
+        return self._outputPump.GetLines()
+
+    def IsReadyForTakeoff(self):
+        return self._readyForTakeoff.is_set()
+
+    def WaitReadyForTakeoff(self, timeout=None):
+        """Blocks until PX4 reports it is ready for takeoff or the timeout expires. Returns True when ready."""
+        return self._readyForTakeoff.wait(timeout)
+
+    def IsExternal(self):
+        """Returns whether the simulation was started outside of avcimaster and cannot be controlled."""
+        return self._px4Process is None
+
+    def IsRunning(self):
+        if self._px4Process is None:
+            return True
+        if self._px4Process.poll() is not None:
+            return False
+        if self._gazeboProcess is not None and self._gazeboProcess.poll() is not None:
+            return False
+        return True
+
+    def SendCommand(self, command):
+        """Sends an NSH command line to the px4 shell. Commands to an external simulation are dropped."""
+        if self._px4Process is None:
+            return
+        try:
+            self._px4Process.stdin.write(command + "\n")
+            self._px4Process.stdin.flush()
+        except Exception as e:
+            logging.error(f"Error sending command: {e}")
+
+    def ResetModels(self):
+        """
+        Moves every model of the Gazebo world back to its spawn pose. Nothing is reset for an external simulation.
+
+        Returns:
+            bool: True on success.
+        """
+        if self._px4Process is None:
+            return True
+        environment = os.environ.copy()
+        environment["GAZEBO_MASTER_URI"] = f"http://localhost:{GAZEBO_MASTER_BASE_PORT + self.instanceIndex}"
+        try:
+            result = subprocess.run(self.RESET_MODELS_COMMAND, env=environment, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, text=True, timeout=self.RESET_MODELS_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.error(f"Error resetting the Gazebo world of instance {self.instanceIndex}: {e}")
+            return False
+        if result.returncode != 0:
+            logging.error(f"Error resetting the Gazebo world of instance {self.instanceIndex}: {result.stderr.strip()}")
+            return False
+        return True
+
+    def Terminate(self):
+        """
+        Stops the process groups of px4 and gzserver, including make, the shell and anything else they started,
+        and waits for them and the output pump to finish. The time it took and the last signal needed are kept in
+        stopDuration and stopSignal.
+        """
+        stopStartTime = time.perf_counter()
+        processes = [process for process in (self._px4Process, self._gazeboProcess) if process is not None]
+        if processes:
+            self.stopSignal = TerminateProcessGroups(processes, self._stopSignalDeadlines)
+        if self._outputPump is not None:
+            self._outputPump.Join(self.OUTPUT_PUMP_JOIN_TIMEOUT)
+        self.stopDuration = time.perf_counter() - stopStartTime
+
+    def _OnReadyForTakeoff(self, match):
+        self.AddPhaseDuration("ready for takeoff", time.perf_counter() - self._launchTime)
+        self._readyForTakeoff.set()
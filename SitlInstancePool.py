@@ -0,0 +1,129 @@
+import threading
+import logging
+
+from SitlInstance import TerminateInstances
+
+
+class SitlInstancePool:
+    """
+    Keeps SITL instances pre-spawned and parked at "Ready for takeoff!" so a simulation start only has to claim
+    one and send the takeoff command. Each pooled instance gets its own PX4 instance index, and therefore its own
+    port set. Claimed instances are replaced in the background.
+
+    A pool only uses the GetInstanceIndexCount(size) indices from its first instance index on, so pools of
+    different vehicles given disjoint ranges never launch two instances on the same ports.
+    """
+
+    # Period at which the replenish thread checks for instances that died while parked.
+    REPLENISH_CHECK_PERIOD = 1.0
+    # Instance indices a pool needs besides its warm instances, for the instance the running simulation claimed.
+    CLAIMED_INSTANCE_INDEX_COUNT = 1
+
+    def __init__(self, size, launchInstance, firstInstanceIndex=1):
+        """
+        Args:
+            size (int): Number of warm instances to keep.
+            launchInstance (callable): Called with an instance index, returns a launched SitlInstance whose output
+                pump is running.
+            firstInstanceIndex (int): Lowest instance index used by the pool. Lower indices are left to cold starts.
+        """
+        self._size = size
+        self._launchInstance = launchInstance
+        self._firstInstanceIndex = firstInstanceIndex
+        self._instanceIndexCount = self.GetInstanceIndexCount(size)
+        self._warmInstances = []
+        self._claimedInstances = []
+        self._mutex = threading.Lock()
+        self._replenishRequested = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def Start(self):
+        """Starts the background thread that spawns and replenishes the warm instances."""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def Terminate(self):
+        """Stops replenishing and terminates every warm instance. Claimed instances belong to their claimer."""
+        self._running = False
+        self._replenishRequested.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._mutex:
+            warmInstances = self._warmInstances
+            self._warmInstances = []
+        TerminateInstances(warmInstances)
+
+    def Claim(self):
+        """
+        Takes a warm instance out of the pool, preferring instances that are already ready for takeoff.
+
+        Returns:
+            SitlInstance: A running instance, possibly still booting, or None if the pool is empty.
+        """
+        with self._mutex:
+            runningInstances = [instance for instance in self._warmInstances if instance.IsRunning()]
+            if not runningInstances:
+                return None
+            readyInstances = [instance for instance in runningInstances if instance.IsReadyForTakeoff()]
+            instance = readyInstances[0] if readyInstances else runningInstances[0]
+            self._warmInstances.remove(instance)
+            self._claimedInstances.append(instance)
+        self._replenishRequested.set()
+        return instance
+
+    @classmethod
+    def GetInstanceIndexCount(cls, size):
+        """Returns the number of consecutive instance indices a pool of the given size uses."""
+        return size + cls.CLAIMED_INSTANCE_INDEX_COUNT
+
+    def GetWarmInstanceCount(self):
+        with self._mutex:
+            return len(self._warmInstances)
+
+    def _run(self):
+        while self._running:
+            self._replenishRequested.clear()
+            self._RemoveStoppedInstances()
+            while self._running and self.GetWarmInstanceCount() < self._size:
+                if not self._LaunchWarmInstance():
+                    break
+            self._replenishRequested.wait(self.REPLENISH_CHECK_PERIOD)
+
+    def _RemoveStoppedInstances(self):
+        with self._mutex:
+            stoppedInstances = [instance for instance in self._warmInstances if not instance.IsRunning()]
+            self._warmInstances = [instance for instance in self._warmInstances if instance.IsRunning()]
+            self._claimedInstances = [instance for instance in self._claimedInstances if instance.IsRunning()]
+        for instance in stoppedInstances:
+            print(f"Warm SITL instance {instance.instanceIndex} stopped unexpectedly, replacing it.")
+            instance.Terminate()
+
+    def _LaunchWarmInstance(self):
+        """
+        Launches one warm instance on the lowest free index of the pool. Returns False if the launch failed or every
+        index is still in use, which happens while a claimed instance is being stopped.
+        """
+        with self._mutex:
+            usedIndices = {instance.instanceIndex for instance in self._warmInstances + self._claimedInstances}
+        freeIndices = [instanceIndex for instanceIndex in range(self._firstInstanceIndex, self._firstInstanceIndex + self._instanceIndexCount)
+                       if instanceIndex not in usedIndices]
+        if not freeIndices:
+            return False
+        instanceIndex = freeIndices[0]
+
+        try:
+            instance = self._launchInstance(instanceIndex)
+        except Exception as e:
+            logging.error(f"Error launching warm SITL instance {instanceIndex}: {e}")
+            return False
+
+        if not self._running:
+            instance.Terminate()
+            return True
+        with self._mutex:
+            self._warmInstances.append(instance)
+        print(f"Warm SITL instance {instanceIndex} launched.")
+        return True
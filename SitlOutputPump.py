@@ -0,0 +1,118 @@
+import re
+import threading
+import logging
+from collections import deque
+
+
+class SitlOutputPump:
+    """
+    Continuously drains the stdout and stderr pipes of the SITL process so PX4 and Gazebo never block on a
+    full pipe. Lines are kept in a bounded in-memory ring buffer, optionally spilled to a log file, and
+    matched against registered pattern triggers.
+    """
+
+    def __init__(self, capacity=10000, logFilePath=None):
+        """
+        Args:
+            capacity (int): Maximum number of lines kept in memory, older lines are discarded.
+            logFilePath (str, optional): If set, every line is also appended to this file.
+        """
+        self._lines = deque(maxlen=capacity)
+        self._triggers = []
+        self._mutex = threading.Lock()
+        self._logFilePath = logFilePath
+        self._logFile = None
+        self._threads = []
+
+    def AddTrigger(self, pattern, callback, once=True):
+        """
+        Registers a callback for output lines matching a pattern. Callbacks run on the pump threads.
+
+        Args:
+            pattern (str or re.Pattern): Regular expression searched in every line.
+            callback (callable): Called with the re.Match object of the matching line.
+            once (bool): Remove the trigger after its first match.
+
+        Returns:
+            object: Handle that can be passed to RemoveTrigger.
+        """
+        compiledPattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        trigger = [compiledPattern, callback, once]
+        with self._mutex:
+            self._triggers.append(trigger)
+        return trigger
+
+    def RemoveTrigger(self, trigger):
+        """Removes a trigger returned by AddTrigger."""
+        with self._mutex:
+            if trigger in self._triggers:
+                self._triggers.remove(trigger)
+
+    def Start(self, process, processName=None):
+        """
+        Starts draining the stdout and stderr pipes of a process. May be called for several processes.
+
+        Args:
+            process (subprocess.Popen): Process created with text-mode stdout and stderr pipes, decoded with a
+                lenient error handler such as errors="backslashreplace" so binary output cannot stop the pump.
+            processName (str, optional): Prefix of the stream names, used to tell the lines of several processes apart.
+        """
+        if self._logFilePath is not None and self._logFile is None:
+            self._logFile = open(self._logFilePath, "a", buffering=1)
+        prefix = f"{processName} " if processName else ""
+        for stream, streamName in ((process.stdout, f"{prefix}stdout"), (process.stderr, f"{prefix}stderr")):
+            if stream is None:
+                continue
+            thread = threading.Thread(target=self._Pump, args=(stream, streamName), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def Join(self, timeout=None):
+        """Waits until both pipes are closed and drained, then closes the log file."""
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        if not self._threads and self._logFile is not None:
+            self._logFile.close()
+            self._logFile = None
+
+    def GetLines(self):
+        """
+        Returns:
+            list: (stream name, line) tuples currently held in the ring buffer, oldest first.
+        """
+        with self._mutex:
+            return list(self._lines)
+
+    def _Pump(self, stream, streamName):
+        # Stops only at the end of the stream, anything else would leave the process blocked on a full pipe
+        while True:
+            try:
+                line = stream.readline()
+                if not line:
+                    return
+                self._HandleLine(streamName, line.rstrip("\n"))
+            except UnicodeDecodeError as e:
+                # Only raised by pipes opened with strict decoding, the undecodable line is skipped
+                logging.error(f"Undecodable output line in SitlOutputPump {streamName}: {e}")
+            except (ValueError, OSError):
+                return # Pipe closed while reading
+            except Exception as e:
+                logging.error(f"Error in SitlOutputPump {streamName}: {e}")
+
+    def _HandleLine(self, streamName, line):
+        matches = []
+        with self._mutex:
+            self._lines.append((streamName, line))
+            if self._logFile is not None:
+                self._logFile.write(f"[{streamName}] {line}\n")
+            for trigger in list(self._triggers):
+                match = trigger[0].search(line)
+                if match is None:
+                    continue
+                matches.append((trigger[1], match))
+                if trigger[2]:
+                    self._triggers.remove(trigger)
+
+        for callback, match in matches:
+            callback(match)
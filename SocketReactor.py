@@ -0,0 +1,67 @@
+import os
+import selectors
+
+
+class SocketReactor:
+    """
+    Readiness-based I/O reactor shared by the communication controllers.
+
+    Registered file objects are watched with the platform selector (epoll on Linux). A wakeup pipe
+    lets other threads interrupt a blocking Poll, so outgoing message flags are handled immediately
+    without the controller thread ever spinning.
+    """
+
+    def __init__(self):
+        """Creates the selector and registers the wakeup pipe."""
+        self._selector = selectors.DefaultSelector()
+        self._wakeupReadFd, self._wakeupWriteFd = os.pipe()
+        os.set_blocking(self._wakeupReadFd, False)
+        os.set_blocking(self._wakeupWriteFd, False)
+        self._selector.register(self._wakeupReadFd, selectors.EVENT_READ, self._DrainWakeupPipe)
+
+    def Register(self, fileObject, readCallback):
+        """
+        Registers a file object for read readiness.
+
+        Args:
+            fileObject: Socket or file descriptor to watch.
+            readCallback (callable): Called without arguments from Poll when the object is readable.
+        """
+        self._selector.register(fileObject, selectors.EVENT_READ, readCallback)
+
+    def Unregister(self, fileObject):
+        """Stops watching a previously registered file object."""
+        self._selector.unregister(fileObject)
+
+    def Wakeup(self):
+        """Interrupts a blocking Poll from any thread."""
+        try:
+            os.write(self._wakeupWriteFd, b"\x00")
+        except BlockingIOError:
+            pass # Pipe already full, a wakeup is pending anyway
+        except OSError:
+            pass # Reactor already closed
+
+    def Poll(self, timeout=None):
+        """
+        Blocks until a registered object is readable or Wakeup is called, then runs the read callbacks.
+
+        Args:
+            timeout (float, optional): Maximum time to block in seconds. None blocks indefinitely.
+        """
+        for key, _ in self._selector.select(timeout):
+            key.data()
+
+    def Close(self):
+        """Closes the selector and the wakeup pipe."""
+        self._selector.close()
+        os.close(self._wakeupReadFd)
+        os.close(self._wakeupWriteFd)
+
+    def _DrainWakeupPipe(self):
+        """Empties the wakeup pipe so the next Poll blocks again."""
+        try:
+            while os.read(self._wakeupReadFd, 4096):
+                pass
+        except BlockingIOError:
+            pass
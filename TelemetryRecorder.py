@@ -0,0 +1,301 @@
+import bisect
+import mmap
+import os
+import struct
+import time
+
+from PoseFrame import POSE_FRAME_FLAG_VELOCITY, POSE_FRAME_FLAG_ANGULAR_RATE, POSE_FRAME_FLAG_EXTRAPOLATED
+
+RECORD_FILE_MAGIC = b"AVCITLM\x00"
+# Version 2 stores the simulation time in what was padding in version 1, version 1 files read as simulation time 0.
+RECORD_FILE_VERSION = 2
+
+RECORD_KIND_POSE = 1
+RECORD_KIND_MAVLINK = 2
+
+# Header, little-endian, padded to HEADER_SIZE bytes:
+#   magic (8s), version (u32), record kind (u32), record size (u32), reserved (u32), capacity (u64),
+#   record count (u64), dropped record count (u64), first and last record timestamp (f64).
+# The record count is updated after every append, so a file is readable even if the recorder was killed.
+RECORD_FILE_HEADER = struct.Struct("<8sIIIIQQQdd")
+RECORD_COUNT_OFFSET = 32
+HEADER_SIZE = 64
+
+# Pose record, 80 bytes: timestamp (s, monotonic), lat, lon (deg), alt (m AMSL), roll, pitch, yaw (deg),
+# velocity north, east, down (m/s), roll, pitch, yaw rate (deg/s), sequence, vehicle id, pose frame flags,
+# simulation time (ms).
+POSE_RECORD = struct.Struct("<4d9fIBBI2x")
+POSE_RECORD_DTYPE = [
+    ("timestamp", "<f8"), ("lat", "<f8"), ("lon", "<f8"), ("alt", "<f8"),
+    ("roll", "<f4"), ("pitch", "<f4"), ("yaw", "<f4"),
+    ("velocityNorth", "<f4"), ("velocityEast", "<f4"), ("velocityDown", "<f4"),
+    ("rollRate", "<f4"), ("pitchRate", "<f4"), ("yawRate", "<f4"),
+    ("sequence", "<u4"), ("vehicleId", "u1"), ("flags", "u1"), ("simTimeMs", "<u4"), ("padding", "V2"),
+]
+
+# Raw MAVLink record, 296 bytes: receive timestamp (s, monotonic), message id, frame length and the raw frame
+# zero-padded to the maximum MAVLink v2 frame size.
+MAVLINK_FRAME_MAX_SIZE = 280
+MAVLINK_RECORD = struct.Struct(f"<dIH2x{MAVLINK_FRAME_MAX_SIZE}s")
+MAVLINK_RECORD_DTYPE = [
+    ("timestamp", "<f8"), ("msgId", "<u4"), ("length", "<u2"), ("padding", "V2"), ("frame", f"V{MAVLINK_FRAME_MAX_SIZE}"),
+]
+
+RECORD_STRUCTS = {RECORD_KIND_POSE: POSE_RECORD, RECORD_KIND_MAVLINK: MAVLINK_RECORD}
+RECORD_DTYPES = {RECORD_KIND_POSE: POSE_RECORD_DTYPE, RECORD_KIND_MAVLINK: MAVLINK_RECORD_DTYPE}
+
+
+class MappedRecordFile:
+    """
+    Append-only file of fixed-size records, memory-mapped so appending is a pack_into the mapping: no allocation,
+    no system call and no disk wait on the hot path. The file is preallocated in chunks of GROWTH_RECORD_COUNT
+    records, so a short run does not reserve the space of the longest one. Only the append that fills a chunk
+    grows the file. Records beyond the capacity are dropped and counted.
+
+    A record is appended in two steps, so the caller packs it with fixed positional arguments and no argument
+    tuple is built:
+
+        offset = recordFile.BeginAppend()
+        if offset >= 0:
+            RECORD.pack_into(recordFile.buffer, offset, timestamp, ...)
+            recordFile.CommitAppend(timestamp)
+    """
+
+    # Records the file is extended by whenever it is full, 5 MiB of pose or 18.5 MiB of MAVLink records.
+    GROWTH_RECORD_COUNT = 1 << 16
+
+    def __init__(self, path, recordKind, capacity):
+        """
+        Args:
+            path (str): File to create, an existing file is overwritten.
+            recordKind (int): RECORD_KIND_POSE or RECORD_KIND_MAVLINK.
+            capacity (int): Maximum number of records.
+        """
+        self._recordStruct = RECORD_STRUCTS[recordKind]
+        self._recordKind = recordKind
+        self._recordSize = self._recordStruct.size
+        self._capacity = capacity
+        self._count = 0
+        self._dropped = 0
+        self._firstTimestamp = 0.0
+        self._lastTimestamp = 0.0
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._allocatedCount = min(capacity, self.GROWTH_RECORD_COUNT)
+        fileSize = HEADER_SIZE + self._allocatedCount * self._recordSize
+        self._Allocate(fileSize)
+        self._mmap = mmap.mmap(self._fd, fileSize)
+        # The mapping records are packed into, the same object across growths
+        self.buffer = self._mmap
+        self._WriteHeader()
+
+    def BeginAppend(self):
+        """
+        Makes room for the next record.
+
+        Returns:
+            int: Offset in buffer to pack the record at, or -1 if the file is full and the record was dropped.
+        """
+        count = self._count
+        if count >= self._allocatedCount:
+            if count >= self._capacity:
+                self._dropped += 1
+                return -1
+            self._Grow()
+        return HEADER_SIZE + count * self._recordSize
+
+    def CommitAppend(self, timestamp):
+        """Publishes the record packed at the offset BeginAppend returned."""
+        if self._count == 0:
+            self._firstTimestamp = timestamp
+        self._lastTimestamp = timestamp
+        self._count += 1
+        struct.pack_into("<Q", self._mmap, RECORD_COUNT_OFFSET, self._count)
+
+    def GetCount(self):
+        return self._count
+
+    def Close(self):
+        """Writes the final header, flushes the mapping and trims the unused preallocated space."""
+        if self._mmap is None:
+            return
+        self._WriteHeader()
+        self._mmap.flush()
+        self._mmap.close()
+        self._mmap = None
+        os.ftruncate(self._fd, HEADER_SIZE + self._count * self._recordSize)
+        os.close(self._fd)
+
+    def _Grow(self):
+        self._allocatedCount = min(self._capacity, self._allocatedCount + self.GROWTH_RECORD_COUNT)
+        fileSize = HEADER_SIZE + self._allocatedCount * self._recordSize
+        self._Allocate(fileSize)
+        self._mmap.resize(fileSize)
+
+    def _Allocate(self, fileSize):
+        try:
+            # Reserve the blocks up front so page faults never wait for the file system to allocate space
+            os.posix_fallocate(self._fd, 0, fileSize)
+        except (AttributeError, OSError):
+            os.ftruncate(self._fd, fileSize)
+
+    def _WriteHeader(self):
+        RECORD_FILE_HEADER.pack_into(self._mmap, 0, RECORD_FILE_MAGIC, RECORD_FILE_VERSION, self._recordKind,
+                                     self._recordSize, 0, self._capacity, self._count, self._dropped,
+                                     self._firstTimestamp, self._lastTimestamp)
+
+
+class TelemetryRecorder:
+    """
+    Flight recorder for the pose stream sent to Unity and, optionally, the raw MAVLink messages it was built from.
+    Poses go to "<prefix>.pose" and MAVLink frames to "<prefix>.mavlink".
+    """
+
+    def __init__(self, pathPrefix, capacity, recordMavlink=False):
+        """
+        Args:
+            pathPrefix (str): Path of the recording without extension.
+            capacity (int): Maximum number of records per file.
+            recordMavlink (bool): Also record every received MAVLink frame.
+        """
+        self.posePath = f"{pathPrefix}.pose"
+        self.mavlinkPath = f"{pathPrefix}.mavlink" if recordMavlink else None
+        self._poseFile = MappedRecordFile(self.posePath, RECORD_KIND_POSE, capacity)
+        self._mavlinkFile = MappedRecordFile(self.mavlinkPath, RECORD_KIND_MAVLINK, capacity) if recordMavlink else None
+
+    def RecordPose(self, pose):
+        """Records a pose sample as sent to Unity."""
+        flags = 0
+        if pose.hasVelocity:
+            flags |= POSE_FRAME_FLAG_VELOCITY
+        if pose.hasAngularRate:
+            flags |= POSE_FRAME_FLAG_ANGULAR_RATE
+        if pose.extrapolated:
+            flags |= POSE_FRAME_FLAG_EXTRAPOLATED
+        poseFile = self._poseFile
+        offset = poseFile.BeginAppend()
+        if offset < 0:
+            return
+        POSE_RECORD.pack_into(poseFile.buffer, offset, pose.timestamp, pose.lat, pose.lon, pose.alt,
+                              pose.roll, pose.pitch, pose.yaw,
+                              pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+                              pose.rollRate, pose.pitchRate, pose.yawRate,
+                              pose.sequence, pose.vehicleId, flags, round(pose.simTime * 1e3) & 0xFFFFFFFF)
+        poseFile.CommitAppend(pose.timestamp)
+
+    def RecordMavlinkMessage(self, msg, timestamp=None):
+        """Records the raw frame of a received pymavlink message, if MAVLink recording is enabled."""
+        if self._mavlinkFile is None:
+            return
+        self.RecordMavlinkFrame(msg.get_msgId(), msg.get_msgbuf(), timestamp)
+
+    def RecordMavlinkFrame(self, messageId, frame, timestamp=None):
+        """Records a raw MAVLink frame, if MAVLink recording is enabled."""
+        mavlinkFile = self._mavlinkFile
+        if mavlinkFile is None:
+            return
+        offset = mavlinkFile.BeginAppend()
+        if offset < 0:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        MAVLINK_RECORD.pack_into(mavlinkFile.buffer, offset, timestamp, messageId, len(frame), frame)
+        mavlinkFile.CommitAppend(timestamp)
+
+    def Close(self):
+        self._poseFile.Close()
+        if self._mavlinkFile is not None:
+            self._mavlinkFile.Close()
+
+
+def ReadRecordFileHeader(path):
+    """
+    Reads the header of a record file.
+
+    Returns:
+        dict: version, recordKind, recordSize, capacity, count, dropped, firstTimestamp and lastTimestamp.
+    """
+    with open(path, "rb") as recordFile:
+        header = recordFile.read(RECORD_FILE_HEADER.size)
+    (magic, version, recordKind, recordSize, _, capacity,
+     count, dropped, firstTimestamp, lastTimestamp) = RECORD_FILE_HEADER.unpack(header)
+    if magic != RECORD_FILE_MAGIC:
+        raise ValueError(f"{path} is not a telemetry record file")
+    return {"version": version, "recordKind": recordKind, "recordSize": recordSize, "capacity": capacity,
+            "count": count, "dropped": dropped, "firstTimestamp": firstTimestamp, "lastTimestamp": lastTimestamp}
+
+
+def LoadRecords(path):
+    """
+    Maps the records of a record file as a read-only NumPy structured array, without reading the file.
+
+    Returns:
+        numpy.memmap: One element per record, with the fields of POSE_RECORD_DTYPE or MAVLINK_RECORD_DTYPE.
+    """
+    import numpy as np
+
+    header = ReadRecordFileHeader(path)
+    dtype = np.dtype(RECORD_DTYPES[header["recordKind"]])
+    if header["count"] == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(header["count"],))
+
+
+class PoseRecordReader:
+    """
+    Random access to the records of a pose recording without NumPy. The records are fixed-size and in timestamp
+    order, so the mapped file is its own timestamp index and seeking is a binary search over it.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Pose recording written by TelemetryRecorder.
+        """
+        header = ReadRecordFileHeader(path)
+        if header["recordKind"] != RECORD_KIND_POSE:
+            raise ValueError(f"{path} is not a pose recording")
+        self.path = path
+        self._count = header["count"]
+        self._recordFile = open(path, "rb")
+        self._mmap = mmap.mmap(self._recordFile.fileno(), 0, access=mmap.ACCESS_READ) if self._count > 0 else None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """Returns the timestamp of a record, which makes the reader a sorted sequence usable with bisect."""
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return struct.unpack_from("<d", self._mmap, HEADER_SIZE + index * POSE_RECORD.size)[0]
+
+    def GetTimestamp(self, index):
+        return self[index]
+
+    def FindIndex(self, timestamp):
+        """Returns the index of the first record at or after a timestamp, len(self) if there is none."""
+        return bisect.bisect_left(self, timestamp)
+
+    def ReadPose(self, index, pose):
+        """
+        Reads a record into a pose sample.
+
+        Args:
+            index (int): Record index.
+            pose (PoseSample): Sample overwritten with the record.
+        """
+        (pose.timestamp, pose.lat, pose.lon, pose.alt,
+         pose.roll, pose.pitch, pose.yaw,
+         pose.velocityNorth, pose.velocityEast, pose.velocityDown,
+         pose.rollRate, pose.pitchRate, pose.yawRate,
+         pose.sequence, pose.vehicleId, flags, simTimeMs) = POSE_RECORD.unpack_from(self._mmap, HEADER_SIZE + index * POSE_RECORD.size)
+        pose.simTime = simTimeMs / 1e3
+        pose.hasVelocity = bool(flags & POSE_FRAME_FLAG_VELOCITY)
+        pose.hasAngularRate = bool(flags & POSE_FRAME_FLAG_ANGULAR_RATE)
+        pose.extrapolated = bool(flags & POSE_FRAME_FLAG_EXTRAPOLATED)
+
+    def Close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._recordFile.close()
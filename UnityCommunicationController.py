@@ -2,7 +2,9 @@ import threading
 import socket
 import logging
 
-from SharedData import SharedData
+from SharedData import SharedFlags, SharedQueue
+from Metrics import registry
+from SocketReactor import SocketReactor
 
 logging.basicConfig(level=logging.INFO)
 
@@ -13,12 +15,33 @@ class UnityCommunicationController:
     as well as the initialization status.
     """
 
+    # Message bits, identical on the wire and in the message flags
+    UNITY_ENVIRONMENT_STARTED = 0b00000001
+    UNITY_ENVIRONMENT_STOPPED = 0b00000010
+    UNITY_INITIALIZATION_READY = 0b00000100
+    START_UNITY_ENVIRONMENT = 0b00000001
+    STOP_UNITY_ENVIRONMENT = 0b00000010
+    # Events are queued one entry per message. Initialization ready announces a condition that Unity may repeat, so it
+    # is kept as a flag instead and repetitions coalesce.
+    RECEIVED_EVENTS = (UNITY_ENVIRONMENT_STARTED, UNITY_ENVIRONMENT_STOPPED)
+
+    # Received messages waiting to be consumed, further messages are dropped and counted
+    RECEIVE_QUEUE_CAPACITY = 256
+    # Datagrams up to this size are received whole, only the first byte carries message bits today
+    RECEIVE_BUFFER_SIZE = 2048
+    RECEIVE_SOCKET_BUFFER_SIZE = 1 << 18
+    # Upper bound on the datagrams drained per wakeup, so a flood cannot starve the send path
+    MAX_DATAGRAMS_PER_READ = 1024
+
     def __init__(self):
         """
         Initializes the UnityCommunicationController, setting up the necessary sockets and starting the controller thread.
         """
+        self._updateEvent = None
+        self._InitializeMetrics()
         self._InitializeReceiveMessages()
         self._InitializeTransmitMessages()
+        self._InitializeReactor()
         self._CreateAndStartControllerThread()
         
     def Terminate(self):
@@ -26,9 +49,17 @@ class UnityCommunicationController:
         Terminates the UnityCommunicationController, stopping the controller thread and closing the sockets.
         """
         self._running = False
+        self._reactor.Wakeup()
         self._thread.join()
         self._ReceiveSocket10006.close()
         self._TransmitSocket10003.close()
+        self._reactor.Close()
+
+    def _InitializeReactor(self):
+        """
+        Initializes the reactor the controller thread blocks on until a datagram arrives or a send is requested.
+        """
+        self._reactor = SocketReactor()
 
     def _CreateAndStartControllerThread(self):
         """
@@ -39,20 +70,33 @@ class UnityCommunicationController:
         self._running = True
         self._thread.start()
 
+    def _InitializeMetrics(self):
+        """
+        Creates the counters of the datagrams exchanged with the Unity environment.
+        """
+        self._messagesReceivedCounter = registry.Counter("avcimaster_messages_received_total", "Control datagrams received", peer="unity")
+        self._messagesSentCounter = registry.Counter("avcimaster_messages_sent_total", "Control datagrams sent", peer="unity")
+        self._socketErrorsCounter = registry.Counter("avcimaster_socket_errors_total", "Socket errors", peer="unity")
+        self._messagesDroppedCounter = registry.Counter("avcimaster_messages_dropped_total", "Received messages dropped because the receive queue was full",
+                                                        peer="unity")
+        self._messagesDiscardedCounter = registry.Counter("avcimaster_messages_discarded_total",
+                                                          "Received messages discarded because they did not apply to the state waiting for a message",
+                                                          peer="unity")
+
     def _InitializeReceiveMessages(self):
         """
-        Initializes the shared data objects for receiving messages from the Unity environment.
+        Initializes the bounded queue of the messages received from the Unity environment, one entry per message
+        in arrival order, and the receive buffer.
         """
-        self._unityEnvironmentStartedMessageReceived = SharedData(False)
-        self._unityEnvironmentStoppedMessageReceived = SharedData(False)
-        self._unityInitializationReadyMessageReceived = SharedData(False)
+        self._receivedMessages = SharedQueue(self.RECEIVE_QUEUE_CAPACITY)
+        self._receivedStatus = SharedFlags()
+        self._receiveBuffer = bytearray(self.RECEIVE_BUFFER_SIZE)
 
     def _InitializeTransmitMessages(self):
         """
-        Initializes the shared data objects for transmitting messages to the Unity environment.
+        Initializes the flags of the messages to transmit to the Unity environment.
         """
-        self._sendStartUnityEnvironmentMessage = SharedData(False)
-        self._sendStopUnityEnvironmentMessage = SharedData(False)
+        self._messagesToSend = SharedFlags()
 
     def GetUnityEnvironmentStartedMessageReceived(self)->bool:
         """
@@ -61,7 +105,7 @@ class UnityCommunicationController:
         Returns:
             bool: True if the Unity environment started message was received, False otherwise.
         """
-        return self._unityEnvironmentStartedMessageReceived.GetAndSet(False)
+        return self._TakeReceivedMessage(self.UNITY_ENVIRONMENT_STARTED)
 
     def GetUnityEnvironmentStoppedMessageReceived(self)->bool:
         """
@@ -70,7 +114,7 @@ class UnityCommunicationController:
         Returns:
             bool: True if the Unity environment stopped message was received, False otherwise.
         """
-        return self._unityEnvironmentStoppedMessageReceived.GetAndSet(False)
+        return self._TakeReceivedMessage(self.UNITY_ENVIRONMENT_STOPPED)
 
     def GetUnityInitializationReadyMessageReceived(self)->bool:
         """
@@ -79,25 +123,68 @@ class UnityCommunicationController:
         Returns:
             bool: True if the Unity initialization ready message was received, False otherwise.
         """
-        return self._unityInitializationReadyMessageReceived.GetAndSet(False)
+        return self._receivedStatus.Take(self.UNITY_INITIALIZATION_READY)
+
+    def GetDroppedMessageCount(self)->int:
+        """
+        Gets the number of received messages dropped because the receive queue was full.
+
+        Returns:
+            int: The number of dropped messages.
+        """
+        return self._receivedMessages.GetOverflowCount()
+
+    def _TakeReceivedMessage(self, message):
+        """
+        Removes the oldest queued occurrence of a message. Only the state waiting for the message asks for it, so
+        the messages queued before it, or all of them when it is missing, do not apply to that state and are
+        discarded instead of acting in a later state.
+
+        Returns:
+            bool: True if the message was queued.
+        """
+        receivedMessage, discardedCount = self._receivedMessages.TakeMatching(lambda queuedMessage: queuedMessage == message)
+        if discardedCount:
+            self._messagesDiscardedCounter.Increment(discardedCount)
+            print(f"Discarded {discardedCount} Unity messages received while waiting for message {message}.")
+        return receivedMessage is not None
     
+    def SetUpdateEvent(self, updateEvent):
+        """
+        Sets the event that is signalled whenever a message is received from the Unity environment.
+
+        Args:
+            updateEvent (SharedEvent): The event to signal.
+        """
+        self._updateEvent = updateEvent
+
+    def _NotifyUpdate(self):
+        """
+        Signals the update event, if one is set, so waiting consumers react to received messages immediately.
+        """
+        if self._updateEvent is not None:
+            self._updateEvent.Set()
+
     def SetSendStartUnityEnvironmentMessage(self):
         """
         Sets the flag to send the start Unity environment message.
         """
-        return self._sendStartUnityEnvironmentMessage.Set(True)
+        self._messagesToSend.Set(self.START_UNITY_ENVIRONMENT)
+        self._reactor.Wakeup()
 
     def SetSendStopUnityEnvironmentMessage(self):
         """
         Sets the flag to send the stop Unity environment message.
         """
-        return self._sendStopUnityEnvironmentMessage.Set(True)
+        self._messagesToSend.Set(self.STOP_UNITY_ENVIRONMENT)
+        self._reactor.Wakeup()
 
     def _Initialize10006ReceiveSocket(self):
         """
         Initializes the UDP socket for receiving messages from the Unity environment on port 10006.
         """
         self._ReceiveSocket10006 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._ReceiveSocket10006.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_SOCKET_BUFFER_SIZE)
         self._ReceiveSocket10006.bind(("0.0.0.0", 10006))
         self._ReceiveSocket10006.setblocking(False)
 
@@ -116,30 +203,38 @@ class UnityCommunicationController:
         """
         # Ensure message is sent as bytes
         self._TransmitSocket10003.sendto(bytes([message]), ("127.0.0.1", 10003))
+        self._messagesSentCounter.Increment()
 
     def _Read10006ReceiveSocket(self):
         """
-        Reads messages from the receive socket on port 10006 and updates the corresponding message received flags.
+        Drains every pending datagram from the receive socket on port 10006 and queues the messages they carry,
+        in arrival order, with a single queue operation per wakeup.
         """
+        messages = []
         try:
-            data, addr = self._ReceiveSocket10006.recvfrom(1)
-            data = int.from_bytes(data, byteorder='big')
-
-            unityEnvironmentStarted = bool(data & 0b00000001)
-            unityEnvironmentStopped = bool(data & 0b00000010)
-            unityEnvironmentInitializationReady = bool(data & 0b00000100)
-
-            if unityEnvironmentStarted:
-                self._unityEnvironmentStartedMessageReceived.Set(True)
-            if unityEnvironmentStopped:
-                self._unityEnvironmentStoppedMessageReceived.Set(True)
-            if unityEnvironmentInitializationReady:
-                self._unityInitializationReadyMessageReceived.Set(True)
+            for _ in range(self.MAX_DATAGRAMS_PER_READ):
+                size = self._ReceiveSocket10006.recv_into(self._receiveBuffer)
+                self._messagesReceivedCounter.Increment()
+                if size == 0:
+                    continue
+                data = self._receiveBuffer[0]
+                for message in self.RECEIVED_EVENTS:
+                    if data & message:
+                        messages.append(message)
+                self._receivedStatus.Set(data & self.UNITY_INITIALIZATION_READY)
         except BlockingIOError:
-            pass # No data available
+            pass # No more data available
         except Exception as e:
+            self._socketErrorsCounter.Increment()
             logging.error(f"Error in _Read10006ReceiveSocket: {e}")
 
+        if messages:
+            acceptedCount = self._receivedMessages.PutMany(messages)
+            if acceptedCount < len(messages):
+                self._messagesDroppedCounter.Increment(len(messages) - acceptedCount)
+                logging.error(f"Unity receive queue full, dropped {len(messages) - acceptedCount} messages.")
+        self._NotifyUpdate()
+
     def _ReadMessage(self):
         """
         Reads messages from the receive socket.
@@ -150,16 +245,13 @@ class UnityCommunicationController:
         """
         Sends messages to the Unity environment on port 10003 based on the set flags.
         """
-        sendStartUnityEnvironmentMessage = self._sendStartUnityEnvironmentMessage.GetAndSet(False)
-        sendStopUnityEnvironmentMessage = self._sendStopUnityEnvironmentMessage.GetAndSet(False)
+        messagesToSend = self._messagesToSend.TakeAll()
 
-        if sendStartUnityEnvironmentMessage:
-            message = 0b00000001
-            self._SendMessageFrom10003TransmitSocket(message)
+        if messagesToSend & self.START_UNITY_ENVIRONMENT:
+            self._SendMessageFrom10003TransmitSocket(self.START_UNITY_ENVIRONMENT)
 
-        if sendStopUnityEnvironmentMessage:
-            message = 0b00000010
-            self._SendMessageFrom10003TransmitSocket(message)
+        if messagesToSend & self.STOP_UNITY_ENVIRONMENT:
+            self._SendMessageFrom10003TransmitSocket(self.STOP_UNITY_ENVIRONMENT)
 
     def _SendMessage(self):
         """
@@ -170,11 +262,12 @@ class UnityCommunicationController:
     def _run(self):
         """
         The main communication loop, running in the controller thread.
-        Reads and sends messages in a loop while the controller is running.
+        Blocks on the reactor until a message arrives or a send is requested, then reads and sends messages.
         """
         self._Initialize10006ReceiveSocket()
         self._Initialize10003TransmitSocket()
+        self._reactor.Register(self._ReceiveSocket10006, self._ReadMessage)
 
         while(self._running):
-            self._ReadMessage()
-            self._SendMessage()
\ No newline at end of file
+            self._SendMessage()
+            self._reactor.Poll()
\ No newline at end of file
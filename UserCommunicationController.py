@@ -1,17 +1,44 @@
 import threading
 import socket
+import logging
 
-from SharedData import SharedData
+from SharedData import SharedFlags, SharedQueue
+from Metrics import registry
+from SocketReactor import SocketReactor
+from SetpointFrame import Setpoint, IsSetpointFrame, DecodeSetpointFrame
 
 class UserCommunicationController:
     """Handles communication with the user for starting and stopping simulations."""
+
+    # Message bits, identical on the wire and in the message flags
+    START_SIMULATION = 0b00000001
+    STOP_SIMULATION = 0b00000010
+    SIMULATION_STARTED = 0b00000001
+    SIMULATION_STOPPED = 0b00000010
+    RECEIVED_MESSAGES = (START_SIMULATION, STOP_SIMULATION)
+
+    # Received messages waiting to be consumed, further messages are dropped and counted
+    RECEIVE_QUEUE_CAPACITY = 256
+    # Datagrams up to this size are received whole, only the first byte carries message bits today
+    RECEIVE_BUFFER_SIZE = 2048
+    RECEIVE_SOCKET_BUFFER_SIZE = 1 << 18
+    # Upper bound on the datagrams drained per wakeup, so a flood cannot starve the send path
+    MAX_DATAGRAMS_PER_READ = 1024
     
     def __init__(self):
         """Initializes the communication controller, setting up message receive/transmit mechanisms and starting the controller thread."""
+        self._updateEvent = None
+        self._setpointCallback = None
+        self._InitializeMetrics()
         self._InitializeReceiveMessages()
         self._InitializeTransmitMessages()
+        self._InitializeReactor()
         self._CreateAndStartControllerThread()
         
+    def _InitializeReactor(self):
+        """Initializes the reactor the controller thread blocks on until a datagram arrives or a send is requested."""
+        self._reactor = SocketReactor()
+
     def _CreateAndStartControllerThread(self):
         """Creates and starts the controller thread responsible for handling communication."""
         self._thread = threading.Thread(target=self._run)
@@ -19,15 +46,29 @@ class UserCommunicationController:
         self._running = True
         self._thread.start()
         
+    def _InitializeMetrics(self):
+        """Creates the counters of the datagrams exchanged with the user."""
+        self._messagesReceivedCounter = registry.Counter("avcimaster_messages_received_total", "Control datagrams received", peer="user")
+        self._messagesSentCounter = registry.Counter("avcimaster_messages_sent_total", "Control datagrams sent", peer="user")
+        self._socketErrorsCounter = registry.Counter("avcimaster_socket_errors_total", "Socket errors", peer="user")
+        self._messagesDroppedCounter = registry.Counter("avcimaster_messages_dropped_total", "Received messages dropped because the receive queue was full",
+                                                        peer="user")
+        self._messagesDiscardedCounter = registry.Counter("avcimaster_messages_discarded_total",
+                                                          "Received messages discarded because they did not apply to the state waiting for a message",
+                                                          peer="user")
+        self._setpointsReceivedCounter = registry.Counter("avcimaster_setpoints_received_total", "Setpoint frames received from the user")
+        self._invalidSetpointsCounter = registry.Counter("avcimaster_setpoints_invalid_total",
+                                                         "Setpoint frames dropped for an unknown version or setpoint type")
+
     def _InitializeReceiveMessages(self):
-        """Initializes the mechanisms for receiving messages from the user."""
-        self._userStartSimulationMessageReceived = SharedData(False)
-        self._userStopSimulationMessageReceived = SharedData(False)
+        """Initializes the bounded queue of the messages received from the user, one entry per message in arrival order."""
+        self._receivedMessages = SharedQueue(self.RECEIVE_QUEUE_CAPACITY)
+        self._receiveBuffer = bytearray(self.RECEIVE_BUFFER_SIZE)
+        self._setpoint = Setpoint()
     
     def _InitializeTransmitMessages(self):
         """Initializes the mechanisms for transmitting messages to the user."""
-        self._sendSimulationStartedMessage = SharedData(False)
-        self._sendSimulationStoppedMessage = SharedData(False)
+        self._messagesToSend = SharedFlags()
   
     def GetUserStartSimulationMessageReceived(self) -> bool:
         """Checks and returns the status of the user start simulation message.
@@ -35,7 +76,7 @@ class UserCommunicationController:
         Returns:
             bool: True if the start simulation message was received, False otherwise.
         """
-        return self._userStartSimulationMessageReceived.GetAndSet(False)
+        return self._TakeReceivedMessage(self.START_SIMULATION)
 
     def GetUserStopSimulationMessageReceived(self) -> bool:
         """Checks and returns the status of the user stop simulation message.
@@ -43,26 +84,70 @@ class UserCommunicationController:
         Returns:
             bool: True if the stop simulation message was received, False otherwise.
         """
-        return self._userStopSimulationMessageReceived.GetAndSet(False)
+        return self._TakeReceivedMessage(self.STOP_SIMULATION)
+
+    def GetDroppedMessageCount(self) -> int:
+        """Returns the number of received messages dropped because the receive queue was full."""
+        return self._receivedMessages.GetOverflowCount()
+
+    def _TakeReceivedMessage(self, message):
+        """
+        Removes the oldest queued occurrence of a message. Returns True if the message was queued.
+        Only the state waiting for the message asks for it, so the messages queued before it, or all of them when it
+        is missing, do not apply to that state and are discarded. A repeated start or a stop while no simulation
+        runs can therefore never act later.
+        """
+        receivedMessage, discardedCount = self._receivedMessages.TakeMatching(lambda queuedMessage: queuedMessage == message)
+        if discardedCount:
+            self._messagesDiscardedCounter.Increment(discardedCount)
+            print(f"Discarded {discardedCount} user messages received while waiting for message {message}.")
+        return receivedMessage is not None
         
+    def SetUpdateEvent(self, updateEvent):
+        """Sets the event that is signalled whenever a message is received from the user.
+
+        Args:
+            updateEvent (SharedEvent): The event to signal.
+        """
+        self._updateEvent = updateEvent
+
+    def SetSetpointCallback(self, callback):
+        """Sets the function called on the controller thread with every setpoint received from the user.
+
+        Args:
+            callback (callable): Called as callback(setpoint). The setpoint is reused for the next frame, so it must
+                be copied if it is kept.
+        """
+        self._setpointCallback = callback
+
+    def _NotifyUpdate(self):
+        """Signals the update event, if one is set, so waiting consumers react to received messages immediately."""
+        if self._updateEvent is not None:
+            self._updateEvent.Set()
+
     def SetSendSimulationStartedMessage(self):
         """Sets the flag to send the simulation started message to the user."""
-        self._sendSimulationStartedMessage.Set(True)
+        self._messagesToSend.Set(self.SIMULATION_STARTED)
+        self._reactor.Wakeup()
     
     def SetSendSimulationStoppedMessage(self):
         """Sets the flag to send the simulation stopped message to the user."""
-        self._sendSimulationStoppedMessage.Set(True)
+        self._messagesToSend.Set(self.SIMULATION_STOPPED)
+        self._reactor.Wakeup()
 
     def Terminate(self):
         """Terminates the communication controller, stopping the controller thread and closing sockets."""
         self._running = False
+        self._reactor.Wakeup()
         self._thread.join()
         self._ReceiveSocket10002.close()
         self._TransmitSocket10001.close()
+        self._reactor.Close()
 
     def _Initialize10002ReceiveSocket(self):
         """Initialises the UDP socket for receiving messages on port 10002."""
         self._ReceiveSocket10002 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._ReceiveSocket10002.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_SOCKET_BUFFER_SIZE)
         self._ReceiveSocket10002.bind(("0.0.0.0", 10002))
         self._ReceiveSocket10002.setblocking(False)
         
@@ -78,34 +163,60 @@ class UserCommunicationController:
         """
         # Ensure message is sent as bytes
         self._TransmitSocket10001.sendto(bytes([message]), ("127.0.0.1", 10001))
+        self._messagesSentCounter.Increment()
         
     def _SendMessageOnPort10001(self):
         """Sends the appropriate message on port 10001 based on the current simulation state."""
-        sendSimulationStartedMessage = self._sendSimulationStartedMessage.GetAndSet(False)
-        sendSimulationStoppedMessage = self._sendSimulationStoppedMessage.GetAndSet(False)
-        
-        if sendSimulationStartedMessage:
-            message = 0b00000001
-            self._SendMessageFrom10001TransmitSocket(message)
-        if sendSimulationStoppedMessage:
-            message = 0b00000010
-            self._SendMessageFrom10001TransmitSocket(message)
+        messagesToSend = self._messagesToSend.TakeAll()
+
+        if messagesToSend & self.SIMULATION_STARTED:
+            self._SendMessageFrom10001TransmitSocket(self.SIMULATION_STARTED)
+        if messagesToSend & self.SIMULATION_STOPPED:
+            self._SendMessageFrom10001TransmitSocket(self.SIMULATION_STOPPED)
 
     def _Read10002ReceiveSocket(self):
-        """Reads and processes messages from the receive socket on port 10002."""
+        """
+        Drains every pending datagram from the receive socket on port 10002 and queues the messages in arrival order.
+        Setpoint frames bypass the queue and are handed to the setpoint callback as they are read.
+        """
+        messages = []
+        controlDatagramReceived = False
         try:
-            data, addr = self._ReceiveSocket10002.recvfrom(1)
-            data = int.from_bytes(data, byteorder='big')
+            for _ in range(self.MAX_DATAGRAMS_PER_READ):
+                size = self._ReceiveSocket10002.recv_into(self._receiveBuffer)
+                self._messagesReceivedCounter.Increment()
+                if IsSetpointFrame(self._receiveBuffer, size):
+                    self._HandleSetpointFrame()
+                    continue
+                controlDatagramReceived = True
+                if size == 0:
+                    continue
+                data = self._receiveBuffer[0]
+                for message in self.RECEIVED_MESSAGES:
+                    if data & message:
+                        messages.append(message)
+        except BlockingIOError:
+            pass # No more data available
+        except Exception as e:
+            self._socketErrorsCounter.Increment()
+            logging.error(f"Error in _Read10002ReceiveSocket: {e}")
 
-            userSimulationStart = bool(data & 0b00000001)
-            userSimulationStop = bool(data & 0b00000010)
+        if messages:
+            acceptedCount = self._receivedMessages.PutMany(messages)
+            if acceptedCount < len(messages):
+                self._messagesDroppedCounter.Increment(len(messages) - acceptedCount)
+                logging.error(f"User receive queue full, dropped {len(messages) - acceptedCount} messages.")
+        if controlDatagramReceived:
+            self._NotifyUpdate()
 
-            if userSimulationStart:
-                self._userStartSimulationMessageReceived.Set(True)
-            if userSimulationStop:
-                self._userStopSimulationMessageReceived.Set(True)
-        except BlockingIOError:
-            pass # No data available
+    def _HandleSetpointFrame(self):
+        """Decodes the setpoint frame in the receive buffer and passes it to the setpoint callback."""
+        self._setpointsReceivedCounter.Increment()
+        if not DecodeSetpointFrame(self._receiveBuffer, self._setpoint):
+            self._invalidSetpointsCounter.Increment()
+            return
+        if self._setpointCallback is not None:
+            self._setpointCallback(self._setpoint)
         
     def _ReadMessage(self):
         """Reads incoming messages from the user."""
@@ -119,7 +230,8 @@ class UserCommunicationController:
         """The main loop of the controller thread, handling message reading and sending."""
         self._Initialize10002ReceiveSocket()
         self._Initialize10001TransmitSocket()
+        self._reactor.Register(self._ReceiveSocket10002, self._ReadMessage)
 
         while(self._running):
-            self._ReadMessage()
-            self._SendMessage()
\ No newline at end of file
+            self._SendMessage()
+            self._reactor.Poll()
\ No newline at end of file
@@ -1,8 +1,116 @@
 import time
+import argparse
+from collections import deque
 from enum import Enum
+from SharedData import SharedEvent
+from Metrics import registry, StateDwellTracker, MetricsHttpServer, MetricsSnapshotWriter
 from UnityCommunicationController import UnityCommunicationController
 from UserCommunicationController import UserCommunicationController
 from PX4SITLProcessController import PX4SITLProcessController
+from PoseReplayController import PoseReplayController
+from PX4SITLLauncher import SitlLaunchMode, SpreadCpuCores
+from SitlInstancePool import SitlInstancePool
+from PoseFrame import PoseWireFormat
+from PoseMappedFile import PoseTransport, POSE_MAPPED_FILE_PATH_PREFIX
+
+def ParseMavlinkStreamRate(value):
+    """Parses a MESSAGE=HZ stream rate option into a (message name, rate) tuple."""
+    messageName, separator, rate = value.partition("=")
+    try:
+        if not separator:
+            raise ValueError
+        return messageName.upper(), float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected MESSAGE=HZ, got {value}")
+
+def GetMavlinkStreamRates(settings):
+    """Returns the MAVLink message rates requested by the stream rate options."""
+    streamRates = {}
+    if settings.mavlink_pose_rate is not None:
+        streamRates["GLOBAL_POSITION_INT"] = settings.mavlink_pose_rate
+        streamRates["ATTITUDE"] = settings.mavlink_pose_rate
+    streamRates.update(settings.mavlink_stream_rate)
+    return streamRates
+
+def ParseArguments(arguments=None):
+    """
+    Parses the AvciMaster command line options.
+    Args:
+        arguments (list, optional): Arguments to parse, defaults to sys.argv.
+    Returns:
+        argparse.Namespace: The settings used by AvciMaster.
+    """
+    parser = argparse.ArgumentParser(description="Simulation lifecycle controller between Unity, PX4 SITL and the user.")
+    parser.add_argument("--vehicle-count", type=int, default=1,
+                        help="number of PX4 instances, vehicle N > 0 uses MAVLink port 14540 + N and pose port 10100 + N")
+    parser.add_argument("--no-cpu-placement", action="store_true",
+                        help="do not pin the processes of each vehicle to its own group of CPU cores")
+    parser.add_argument("--sitl-launch-mode", choices=[mode.name.lower() for mode in SitlLaunchMode], default="make",
+                        help="start PX4 through make, start the prebuilt binaries directly when the build is up to date, "
+                             "or attach to an externally started simulation")
+    parser.add_argument("--sitl-pool-size", type=int, default=0,
+                        help="number of SITL instances kept warm at the ready-for-takeoff point")
+    parser.add_argument("--sim-speed-factor", type=float, default=1.0,
+                        help="simulation seconds per wall-clock second of PX4 and Gazebo, timeouts on the vehicle count simulation time")
+    parser.add_argument("--sitl-stop-deadlines", type=float, nargs=3, default=[3.0, 2.0, 1.0], metavar=("SIGINT", "SIGTERM", "SIGKILL"),
+                        help="seconds SITL gets to exit after each stop signal before the next one is sent, their sum bounds a stop")
+    parser.add_argument("--sitl-soft-restart", action="store_true",
+                        help="keep PX4 and Gazebo running between simulations and reset the vehicle instead")
+    parser.add_argument("--sitl-soft-restart-land-timeout", type=float, default=10.0,
+                        help="seconds the vehicle gets to land on a soft restart before it is disarmed in the air")
+    parser.add_argument("--setpoint-min-rate", type=float, default=20.0,
+                        help="rate in Hz at which the latest user setpoint is repeated to PX4 to keep it in offboard mode")
+    parser.add_argument("--sitl-log-file", default=None,
+                        help="file the SITL stdout and stderr lines are appended to")
+    parser.add_argument("--readiness-policy", choices=[policy.name.lower() for policy in PX4SITLProcessController.ReadinessPolicy],
+                        default="altitude", help="condition after which the simulation is reported as started")
+    parser.add_argument("--takeoff-altitude", type=float, default=50.0,
+                        help="takeoff altitude in meters (MIS_TAKEOFF_ALT)")
+    parser.add_argument("--takeoff-speed", type=float, default=5.0,
+                        help="takeoff climb speed in m/s (MPC_TKO_SPEED)")
+    parser.add_argument("--ready-altitude", type=float, default=None,
+                        help="altitude above home for the altitude readiness policy, defaults to 2 m below the takeoff altitude")
+    parser.add_argument("--pose-wire-format", choices=[wireFormat.name.lower() for wireFormat in PoseWireFormat], default="legacy",
+                        help="binary layout of the pose datagrams sent to Unity on port 10004, legacy keeps the original "
+                             "!6f frame, v1 and v2 need a Unity that decodes the versioned frame")
+    parser.add_argument("--pose-transport", choices=[transport.name.lower() for transport in PoseTransport], default="udp",
+                        help="send poses to Unity as UDP datagrams, write them to a memory-mapped pose file for a Unity on "
+                             "the same host, or both")
+    parser.add_argument("--pose-file-prefix", default=POSE_MAPPED_FILE_PATH_PREFIX,
+                        help="path prefix of the memory-mapped pose files, vehicle N writes <PREFIX>-vehicle<N>")
+    parser.add_argument("--pose-output-rate", type=float, default=None,
+                        help="send poses to Unity at this fixed rate in Hz, interpolated and extrapolated from MAVLink")
+    parser.add_argument("--pose-interpolation-delay", type=float, default=0.0,
+                        help="how far in the past fixed-rate poses are rendered, in seconds")
+    parser.add_argument("--mavlink-decoder-process", action="store_true",
+                        help="receive and decode MAVLink in a separate process per vehicle, read through shared memory")
+    parser.add_argument("--mavlink-fast-ingest", action="store_true",
+                        help="parse only MAVLink packet headers and unpack the used messages directly, skipping the rest undecoded")
+    parser.add_argument("--mavlink-pose-rate", type=float, default=None,
+                        help="request GLOBAL_POSITION_INT and ATTITUDE from PX4 at this rate in Hz")
+    parser.add_argument("--mavlink-stream-rate", type=ParseMavlinkStreamRate, action="append", default=[], metavar="MESSAGE=HZ",
+                        help="request a MAVLink message at a rate in Hz, 0 disables it, may be repeated")
+    parser.add_argument("--mavlink-suppress-unused-streams", action="store_true",
+                        help="disable every MAVLink stream PX4 sends that is not used for the pose or readiness")
+    parser.add_argument("--telemetry-record", default=None, metavar="PATH_PREFIX",
+                        help="record the poses sent to Unity of every run to <PATH_PREFIX>-vehicle<N>-<start time>.pose")
+    parser.add_argument("--telemetry-record-mavlink", action="store_true",
+                        help="also record the raw MAVLink messages to a .mavlink file next to the pose recording")
+    parser.add_argument("--telemetry-record-capacity", type=int, default=PX4SITLProcessController.TELEMETRY_RECORD_CAPACITY,
+                        help="maximum number of records per recording file, files grow on disk in chunks up to it")
+    parser.add_argument("--replay", nargs="+", default=None, metavar="POSE_RECORDING",
+                        help="feed Unity from pose recordings instead of PX4 SITL, one recording per vehicle")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="replay speed as a multiple of real time, 0 replays as fast as possible")
+    parser.add_argument("--replay-start", type=float, default=0.0,
+                        help="seconds from the beginning of the recordings at which the replay starts")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics in the Prometheus text format on http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--metrics-snapshot-file", default=None,
+                        help="periodically write metrics in the Prometheus text format to this file")
+    parser.add_argument("--metrics-snapshot-period", type=float, default=5.0,
+                        help="seconds between metrics snapshots")
+    return parser.parse_args(arguments)
 
 class AvciMaster:
     """
@@ -21,13 +129,31 @@ class AvciMaster:
         WAITING_UNITY_ENVIRONMENT_STOPPED_MESSAGE_FROM_UNITY = 9
         SEND_SIMULATION_STOPPED_MESSAGE_TO_USER = 10
 
-    def __init__(self):
-        """Initialize state and controllers."""
+    # Upper bound on a single wait for controller events, only a safety net since every controller signals the event.
+    UPDATE_WAIT_TIMEOUT = 1.0
+    TRANSITION_HISTORY_LENGTH = 256
+
+    def __init__(self, settings=None):
+        """
+        Initialize state and controllers.
+        Args:
+            settings (argparse.Namespace, optional): Settings returned by ParseArguments, defaults are used if omitted.
+        """
+        self.settings = settings if settings is not None else ParseArguments([])
         self._terminated = False
+        self._updateEvent = SharedEvent()
         self.InitializeState()
         self.InitializeControllers()
 
     def InitializeState(self):
+        self._transitionLatencies = deque(maxlen=self.TRANSITION_HISTORY_LENGTH)
+        self._transitionLatencyHistogram = registry.Histogram("avcimaster_transition_latency_seconds",
+                                                              "Time from a controller event to the state machine reacting to it")
+        self._simulationStopHistogram = registry.Histogram("avcimaster_simulation_stop_seconds",
+                                                           "Time to stop the simulations of every vehicle")
+        self._stateDwellTracker = StateDwellTracker("avcimaster")
+        self._stateEnterTime = time.perf_counter()
+        self.state = None
         self.SetState(self.State.IDLE)
 
     ####################################################################
@@ -36,18 +162,80 @@ class AvciMaster:
         
     def InitializeUnityCommunicationController(self):
         self.unityCommunicationController = UnityCommunicationController()
+        self.unityCommunicationController.SetUpdateEvent(self._updateEvent)
 
     def InitializeUserCommunicationController(self):
         self.userCommunicationController = UserCommunicationController()
+        self.userCommunicationController.SetUpdateEvent(self._updateEvent)
         
-    def InitializePX4SITLProcessController(self):
-        self.px4SitlProcessController = PX4SITLProcessController()
-        self.px4SitlProcessController.SetProcessErrorCallback(self.Px4SitlErrorCallback)
+    def InitializePX4SITLProcessControllers(self):
+        """Creates one PX4 SITL controller per vehicle, each on its own PX4 instance index and CPU core group."""
+        vehicleCount = self.settings.vehicle_count
+        cpuCoreGroups = SpreadCpuCores(vehicleCount) if vehicleCount > 1 and not self.settings.no_cpu_placement else None
+        self.px4SitlProcessControllers = []
+        for vehicleId in range(vehicleCount):
+            px4SitlProcessController = PX4SITLProcessController(vehicleId)
+            px4SitlProcessController.SetProcessErrorCallback(self.Px4SitlErrorCallback)
+            px4SitlProcessController.SetUpdateEvent(self._updateEvent)
+            px4SitlProcessController.SetSitlLaunchMode(SitlLaunchMode[self.settings.sitl_launch_mode.upper()])
+            px4SitlProcessController.SetSitlOutputLogFile(self.settings.sitl_log_file)
+            px4SitlProcessController.SetSimulationSpeedFactor(self.settings.sim_speed_factor)
+            px4SitlProcessController.SetSitlStopDeadlines(*self.settings.sitl_stop_deadlines)
+            px4SitlProcessController.SetSoftRestart(self.settings.sitl_soft_restart, self.settings.sitl_soft_restart_land_timeout)
+            px4SitlProcessController.SetSetpointMinimumRate(self.settings.setpoint_min_rate)
+            px4SitlProcessController.SetTakeoffParameters(self.settings.takeoff_altitude, self.settings.takeoff_speed)
+            px4SitlProcessController.SetReadinessPolicy(PX4SITLProcessController.ReadinessPolicy[self.settings.readiness_policy.upper()],
+                                                        self.settings.ready_altitude)
+            px4SitlProcessController.SetPoseWireFormat(PoseWireFormat[self.settings.pose_wire_format.upper()])
+            px4SitlProcessController.SetPoseTransport(PoseTransport[self.settings.pose_transport.upper()], self.settings.pose_file_prefix)
+            px4SitlProcessController.SetPoseOutputRate(self.settings.pose_output_rate, self.settings.pose_interpolation_delay)
+            px4SitlProcessController.SetMavlinkDecoderProcess(self.settings.mavlink_decoder_process)
+            px4SitlProcessController.SetMavlinkFastIngest(self.settings.mavlink_fast_ingest)
+            px4SitlProcessController.SetMavlinkStreamRates(GetMavlinkStreamRates(self.settings), self.settings.mavlink_suppress_unused_streams)
+            px4SitlProcessController.SetTelemetryRecording(self.settings.telemetry_record, self.settings.telemetry_record_mavlink,
+                                                           self.settings.telemetry_record_capacity)
+            if cpuCoreGroups is not None:
+                px4SitlProcessController.SetCpuAffinity(cpuCoreGroups[vehicleId])
+            # Pool instance indices start after the cold-start indices of all vehicles, each pool in its own range
+            poolSize = self.settings.sitl_pool_size
+            poolIndexCount = SitlInstancePool.GetInstanceIndexCount(poolSize)
+            px4SitlProcessController.SetSitlInstancePoolSize(poolSize, vehicleCount + vehicleId * poolIndexCount)
+            self.px4SitlProcessControllers.append(px4SitlProcessController)
+
+    def InitializePoseReplayControllers(self):
+        """Creates one pose replay controller per recording, standing in for the PX4 SITL controllers."""
+        self.px4SitlProcessControllers = []
+        for vehicleId, recordingPath in enumerate(self.settings.replay):
+            poseReplayController = PoseReplayController(recordingPath, vehicleId)
+            poseReplayController.SetProcessErrorCallback(self.Px4SitlErrorCallback)
+            poseReplayController.SetUpdateEvent(self._updateEvent)
+            poseReplayController.SetPoseWireFormat(PoseWireFormat[self.settings.pose_wire_format.upper()])
+            poseReplayController.SetPoseTransport(PoseTransport[self.settings.pose_transport.upper()], self.settings.pose_file_prefix)
+            poseReplayController.SetReplaySpeed(self.settings.replay_speed)
+            poseReplayController.Seek(self.settings.replay_start)
+            self.px4SitlProcessControllers.append(poseReplayController)
+
+    def InitializeMetricsExporters(self):
+        """Starts the metrics HTTP endpoint and snapshot writer that are enabled in the settings."""
+        self.metricsHttpServer = None
+        self.metricsSnapshotWriter = None
+        if self.settings.metrics_port is not None:
+            self.metricsHttpServer = MetricsHttpServer(self.settings.metrics_port)
+            self.metricsHttpServer.Start()
+            print(f"Serving metrics on http://127.0.0.1:{self.settings.metrics_port}/metrics")
+        if self.settings.metrics_snapshot_file is not None:
+            self.metricsSnapshotWriter = MetricsSnapshotWriter(self.settings.metrics_snapshot_file, self.settings.metrics_snapshot_period)
+            self.metricsSnapshotWriter.Start()
 
     def InitializeControllers(self):
+        self.InitializeMetricsExporters()
         self.InitializeUnityCommunicationController()
         self.InitializeUserCommunicationController()
-        self.InitializePX4SITLProcessController()
+        if self.settings.replay:
+            self.InitializePoseReplayControllers()
+        else:
+            self.InitializePX4SITLProcessControllers()
+        self.userCommunicationController.SetSetpointCallback(self.UserSetpointCallback)
 
     ####################################################################
     # C. UNITY AND PX4 FUNCTIONS
@@ -61,6 +249,12 @@ class AvciMaster:
     
     def Px4SitlErrorCallback(self):
         self.SetState(self.State.STOP_PX4_SITL_SIMULATION)
+        self._updateEvent.Set()
+
+    def UserSetpointCallback(self, setpoint):
+        """Hands a user setpoint straight to its vehicle, bypassing the state machine. Runs on the user communication thread."""
+        if setpoint.vehicleId < len(self.px4SitlProcessControllers):
+            self.px4SitlProcessControllers[setpoint.vehicleId].SubmitSetpoint(setpoint)
 
     ####################################################################
     # D. OWN CLASS FUNCTIONS AND MEMBERS
@@ -84,12 +278,17 @@ class AvciMaster:
             self.SetState(self.State.START_PX4_SITL_SIMULATION)
             
     def StartPx4SitlSimulationUpdate(self):
-        sitlProcessControllerState = self.px4SitlProcessController.GetState()
-        
-        if sitlProcessControllerState is PX4SITLProcessController.State.IDLE:
-            self.px4SitlProcessController.StartSITL()
+        allVehiclesStarted = True
+        for px4SitlProcessController in self.px4SitlProcessControllers:
+            sitlProcessControllerState = px4SitlProcessController.GetState()
+
+            if sitlProcessControllerState in (PX4SITLProcessController.State.IDLE, PX4SITLProcessController.State.STOPPED):
+                px4SitlProcessController.StartSITL()
+
+            if sitlProcessControllerState is not PX4SITLProcessController.State.STARTED:
+                allVehiclesStarted = False
         
-        if sitlProcessControllerState is PX4SITLProcessController.State.STARTED:
+        if allVehiclesStarted:
             self.SetState(self.State.SEND_SIMULATION_STARTED_MESSAGE_TO_USER)
             
     def SendSimulationStartedMessageToUserUpdate(self):
@@ -103,7 +302,15 @@ class AvciMaster:
             self.SetState(self.State.STOP_PX4_SITL_SIMULATION)
             
     def StopPx4SitlSimulationUpdate(self):
-        self.px4SitlProcessController.StopSITL()
+        stopStartTime = time.perf_counter()
+        # Every vehicle starts stopping before the first one is waited for, so they stop in parallel
+        for px4SitlProcessController in self.px4SitlProcessControllers:
+            px4SitlProcessController.RequestStopSITL()
+        for px4SitlProcessController in self.px4SitlProcessControllers:
+            px4SitlProcessController.StopSITL()
+        stopDuration = time.perf_counter() - stopStartTime
+        self._simulationStopHistogram.Observe(stopDuration)
+        print(f"Simulation stopped in {stopDuration:.2f} s")
         
         self.SetState(self.State.SEND_STOP_UNITY_ENVIRONMENT_MESSAGE_TO_UNITY)
         
@@ -129,37 +336,79 @@ class AvciMaster:
         if self._terminated:
             return
         self._terminated = True
-        self.px4SitlProcessController.Terminate()
+        for px4SitlProcessController in self.px4SitlProcessControllers:
+            px4SitlProcessController.RequestStopSITL()
+        for px4SitlProcessController in self.px4SitlProcessControllers:
+            px4SitlProcessController.Terminate()
         self.unityCommunicationController.Terminate()
         self.userCommunicationController.Terminate()
         self.StopUnityProcess()
+        if self.metricsHttpServer is not None:
+            self.metricsHttpServer.Terminate()
+        if self.metricsSnapshotWriter is not None:
+            self.metricsSnapshotWriter.Terminate()
 
     def SetState(self, state: 'AvciMaster.State'):
         """
-        Set the current state and print its name.
+        Set the current state, record the transition latency and print its name.
+
+        The latency is measured from the later of entering the previous state and the last controller
+        event, so it covers the time between a message arriving and the state machine reacting to it.
         Args:
             state (AvciMaster.State): The new state to set.
         """
+        now = time.perf_counter()
+        triggerTime = self._stateEnterTime
+        eventSetTime = self._updateEvent.GetSetTime()
+        if eventSetTime is not None and eventSetTime > triggerTime:
+            triggerTime = eventSetTime
+        latency = now - triggerTime
+
+        previousState = self.state
         self.state = state
-        print(f"State changed to: {state.name}")
+        self._stateEnterTime = now
+        self._stateDwellTracker.Transition(state, now)
+        if previousState is not None:
+            self._transitionLatencies.append((previousState, state, latency))
+            self._transitionLatencyHistogram.Observe(latency)
+            print(f"State changed to: {state.name} (transition latency: {latency * 1e3:.3f} ms)")
+        else:
+            print(f"State changed to: {state.name}")
+
+    def GetTransitionLatencies(self):
+        """
+        Get the most recent state transitions.
+
+        Returns:
+            list: (previous state, new state, latency in seconds) tuples, oldest first.
+        """
+        return list(self._transitionLatencies)
+
+    def WaitForUpdate(self):
+        """
+        Block until a controller signals an event, or the safety timeout expires.
+        """
+        self._updateEvent.Wait(self.UPDATE_WAIT_TIMEOUT)
 
     def Update(self):
         """
         Main update loop for the AvciMaster state machine.
         Waits for Unity initialization, then processes state transitions.
+        The loop only blocks when a state handler leaves the state unchanged, and it wakes as soon as a
+        controller signals a received message or a PX4 state change.
         """
-        unityInitializationReadyMessageReceived = False
-
         print("Waiting for Unity initialization ready message.")
-        while not unityInitializationReadyMessageReceived:
-            unityInitializationReadyMessageReceived = self.unityCommunicationController.GetUnityInitializationReadyMessageReceived()
-            if unityInitializationReadyMessageReceived:
+        while True:
+            self._updateEvent.Clear()
+            if self.unityCommunicationController.GetUnityInitializationReadyMessageReceived():
                 print("Unity initialization ready message received.")
                 self.SetState(self.State.WAITING_START_SIMULATION_MESSAGE_FROM_USER)
-            # Avoid busy waiting
-            time.sleep(0.1)
+                break
+            self.WaitForUpdate()
 
         while True:
+            self._updateEvent.Clear()
+            previousState = self.state
             match self.state:
                 case self.State.WAITING_START_SIMULATION_MESSAGE_FROM_USER:
                     self.WaitingStartSimulationMessageFromUserUpdate()
@@ -181,10 +430,11 @@ class AvciMaster:
                     self.WaitingUnityEnvironmentStoppedMessageFromUnityUpdate()
                 case self.State.SEND_SIMULATION_STOPPED_MESSAGE_TO_USER:
                     self.SendSimulationStoppedMessageToUser()
-            time.sleep(0.1)
+            if self.state is previousState:
+                self.WaitForUpdate()
 
 if __name__ == "__main__":
-    avciMaster = AvciMaster()
+    avciMaster = AvciMaster(ParseArguments())
     
     print("Staring unity.")
     avciMaster.StartUnityProcess()
@@ -0,0 +1,194 @@
+import threading
+import socket
+import time
+import logging
+
+from SocketReactor import SocketReactor
+from PoseFrame import PoseFrameDecoder, GetPosePort
+from PoseMappedFile import PoseMappedFileReader, GetPoseMappedFilePath
+
+
+class PoseStatistics:
+    """Pose frames received for one vehicle during a measurement window."""
+
+    def __init__(self):
+        self.frameCount = 0
+        self.invalidFrameCount = 0
+        self.firstSampleIndex = None
+        self.lastSampleIndex = None
+        self.sampleCount = 0
+        self.latencies = []
+        # Simulation and receive time of the first and last timed sample, the simulation time only in V2 frames
+        self.firstSimTime = None
+        self.lastSimTime = None
+        self.firstReceiveTime = None
+        self.lastReceiveTime = None
+
+
+class FakeUnityEndpoint:
+    """
+    Stands in for the Unity environment: announces initialization readiness on port 10006 until the first start
+    command, acknowledges start and stop commands received on port 10003 immediately, and receives the pose frames
+    of every vehicle, timing each emitted sample against the MavlinkEmitter. Poses are received on the pose ports
+    and, when a pose file prefix is given, also read from the memory-mapped pose files.
+    """
+
+    INITIALIZATION_READY_PERIOD = 0.05
+    POLL_TIMEOUT = 0.05
+    # Pose files are polled like a Unity frame loop would, but much faster so latencies stay comparable to UDP.
+    POSE_FILE_POLL_PERIOD = 0.001
+
+    def __init__(self, mavlinkEmitter, vehicleCount=1, poseFilePrefix=None):
+        """
+        Args:
+            mavlinkEmitter (MavlinkEmitter): Emitter the pose samples originate from.
+            vehicleCount (int): Number of vehicles whose pose ports are received.
+            poseFilePrefix (str, optional): Path prefix of the pose files to read.
+        """
+        self._mavlinkEmitter = mavlinkEmitter
+        self._vehicleCount = vehicleCount
+        self._poseDecoder = PoseFrameDecoder()
+        self._poseStatistics = [PoseStatistics() for _ in range(vehicleCount)]
+        self._mutex = threading.Lock()
+        self._startReceived = False
+        self._reactor = SocketReactor()
+        self._poseFilePrefix = poseFilePrefix
+        self._running = False
+        self._thread = None
+        self._poseFileThread = None
+
+    def Start(self):
+        self._commandSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._commandSocket.bind(("127.0.0.1", 10003))
+        self._commandSocket.setblocking(False)
+        self._reactor.Register(self._commandSocket, self._ReadCommand)
+        self._statusSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._poseSockets = []
+        for vehicleId in range(self._vehicleCount):
+            poseSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            poseSocket.bind(("127.0.0.1", GetPosePort(vehicleId)))
+            poseSocket.setblocking(False)
+            self._reactor.Register(poseSocket, lambda poseSocket=poseSocket, vehicleId=vehicleId: self._ReadPoses(poseSocket, vehicleId))
+            self._poseSockets.append(poseSocket)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        if self._poseFilePrefix is not None:
+            self._poseFileThread = threading.Thread(target=self._RunPoseFileReader, daemon=True)
+            self._poseFileThread.start()
+
+    def Stop(self):
+        self._running = False
+        self._reactor.Wakeup()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._poseFileThread is not None:
+            self._poseFileThread.join()
+            self._poseFileThread = None
+        for openSocket in [self._commandSocket, self._statusSocket] + self._poseSockets:
+            openSocket.close()
+        self._reactor.Close()
+
+    def TakePoseStatistics(self):
+        """
+        Returns the pose statistics collected since the previous call and starts a new measurement window.
+
+        Returns:
+            list: One PoseStatistics per vehicle.
+        """
+        with self._mutex:
+            poseStatistics = self._poseStatistics
+            self._poseStatistics = [PoseStatistics() for _ in range(self._vehicleCount)]
+        return poseStatistics
+
+    def _run(self):
+        nextInitializationReadyTime = time.monotonic()
+        while self._running:
+            if not self._startReceived and time.monotonic() >= nextInitializationReadyTime:
+                self._SendStatus(0b00000100)
+                nextInitializationReadyTime += self.INITIALIZATION_READY_PERIOD
+            self._reactor.Poll(self.POLL_TIMEOUT)
+
+    def _SendStatus(self, message):
+        self._statusSocket.sendto(bytes([message]), ("127.0.0.1", 10006))
+
+    def _ReadCommand(self):
+        try:
+            data = self._commandSocket.recv(1)
+        except BlockingIOError:
+            return
+        command = data[0] if data else 0
+        if command & 0b00000001:
+            self._startReceived = True
+            self._SendStatus(0b00000001)
+        if command & 0b00000010:
+            self._SendStatus(0b00000010)
+
+    def _ReadPoses(self, poseSocket, vehicleId):
+        while True:
+            try:
+                data = poseSocket.recv(256)
+            except BlockingIOError:
+                return
+            except Exception as e:
+                logging.error(f"Error in FakeUnityEndpoint pose receive: {e}")
+                return
+            receiveTime = time.monotonic()
+            self._HandlePoseFrame(vehicleId, data, receiveTime)
+
+    def _RunPoseFileReader(self):
+        readers = [None] * self._vehicleCount
+        nextSequences = [0] * self._vehicleCount
+        while self._running:
+            for vehicleId in range(self._vehicleCount):
+                if readers[vehicleId] is None:
+                    try:
+                        readers[vehicleId] = PoseMappedFileReader(GetPoseMappedFilePath(self._poseFilePrefix, vehicleId))
+                    except (OSError, ValueError):
+                        continue # Not written yet
+                nextSequences[vehicleId] = self._ReadPoseFile(readers[vehicleId], vehicleId, nextSequences[vehicleId])
+            time.sleep(self.POSE_FILE_POLL_PERIOD)
+        for reader in readers:
+            if reader is not None:
+                reader.Close()
+
+    def _ReadPoseFile(self, reader, vehicleId, nextSequence):
+        """Handles every frame written since nextSequence and returns the next sequence to read."""
+        writeSequence = reader.GetWriteSequence()
+        if writeSequence < nextSequence:
+            nextSequence = 0 # A new run restarted the file
+        receiveTime = time.monotonic()
+        for sequence in range(nextSequence, writeSequence):
+            frame = reader.ReadFrame(sequence)
+            if frame is not None:
+                self._HandlePoseFrame(vehicleId, frame, receiveTime)
+        return writeSequence
+
+    def _HandlePoseFrame(self, vehicleId, data, receiveTime):
+        with self._mutex:
+            pose = self._poseDecoder.Decode(data)
+            statistics = self._poseStatistics[vehicleId]
+            statistics.frameCount += 1
+            if pose is None:
+                statistics.invalidFrameCount += 1
+                return
+            sampleIndex = self._mavlinkEmitter.GetSampleIndex(vehicleId, pose.lat)
+            if sampleIndex is None:
+                return
+            # Attitude updates resend the latest sample, only its first frame is timed
+            if statistics.lastSampleIndex is not None and sampleIndex <= statistics.lastSampleIndex:
+                return
+            if statistics.firstSampleIndex is None:
+                statistics.firstSampleIndex = sampleIndex
+            statistics.lastSampleIndex = sampleIndex
+            statistics.sampleCount += 1
+            if pose.simTime:
+                if statistics.firstSimTime is None:
+                    statistics.firstSimTime = pose.simTime
+                    statistics.firstReceiveTime = receiveTime
+                statistics.lastSimTime = pose.simTime
+                statistics.lastReceiveTime = receiveTime
+            sendTime = self._mavlinkEmitter.GetSendTime(vehicleId, sampleIndex)
+            if sendTime is not None:
+                statistics.latencies.append(receiveTime - sendTime)
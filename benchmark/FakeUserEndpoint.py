@@ -0,0 +1,119 @@
+import threading
+import socket
+import time
+
+from SetpointFrame import SetpointFrameEncoder, SetpointType
+
+
+class FakeUserEndpoint:
+    """
+    Stands in for the user application: sends start and stop simulation commands to port 10002 and timestamps the
+    simulation started and stopped messages received on port 10001. While a simulation runs it can stream position
+    setpoints whose north value is a per-vehicle counter, keeping the send time of each.
+    """
+
+    RECEIVE_TIMEOUT = 0.05
+
+    def __init__(self):
+        self._startedTime = None
+        self._stoppedTime = None
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._running = False
+        self._thread = None
+        self._setpointThread = None
+        self._setpointsRunning = False
+        self._setpointSendTimes = []
+
+    def Start(self):
+        self._receiveSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._receiveSocket.bind(("127.0.0.1", 10001))
+        self._receiveSocket.settimeout(self.RECEIVE_TIMEOUT)
+        self._transmitSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._receiveSocket.close()
+        self._transmitSocket.close()
+
+    def RequestStart(self, timeout):
+        """
+        Sends a start simulation command and waits for the simulation started message.
+
+        Returns:
+            float: Seconds from sending the command to receiving the message, None on timeout.
+        """
+        self._started.clear()
+        return self._Request(0b00000001, self._started, lambda: self._startedTime, timeout)
+
+    def RequestStop(self, timeout):
+        """
+        Sends a stop simulation command and waits for the simulation stopped message.
+
+        Returns:
+            float: Seconds from sending the command to receiving the message, None on timeout.
+        """
+        self._stopped.clear()
+        return self._Request(0b00000010, self._stopped, lambda: self._stoppedTime, timeout)
+
+    def StartSetpoints(self, vehicleCount, rate):
+        """Starts sending a position setpoint to every vehicle at the given rate in Hz."""
+        self._setpointSendTimes = [[] for _ in range(vehicleCount)]
+        self._setpointsRunning = True
+        self._setpointThread = threading.Thread(target=self._SendSetpoints, args=(vehicleCount, 1.0 / rate), daemon=True)
+        self._setpointThread.start()
+
+    def StopSetpoints(self):
+        """
+        Stops sending setpoints.
+
+        Returns:
+            list: Per vehicle, the time.monotonic() send time of each setpoint, indexed by its counter.
+        """
+        self._setpointsRunning = False
+        if self._setpointThread is not None:
+            self._setpointThread.join()
+            self._setpointThread = None
+        return self._setpointSendTimes
+
+    def _SendSetpoints(self, vehicleCount, period):
+        encoder = SetpointFrameEncoder()
+        values = [0.0, 0.0, -50.0, 0.0]
+        nextSendTime = time.monotonic()
+        while self._setpointsRunning:
+            for vehicleId in range(vehicleCount):
+                sendTimes = self._setpointSendTimes[vehicleId]
+                values[0] = float(len(sendTimes))
+                timestamp = time.monotonic_ns()
+                self._transmitSocket.sendto(encoder.Encode(SetpointType.POSITION, vehicleId, values, timestamp), ("127.0.0.1", 10002))
+                sendTimes.append(timestamp * 1e-9)
+            nextSendTime += period
+            time.sleep(max(0.0, nextSendTime - time.monotonic()))
+
+    def _Request(self, command, event, getReceiveTime, timeout):
+        sendTime = time.monotonic()
+        self._transmitSocket.sendto(bytes([command]), ("127.0.0.1", 10002))
+        if not event.wait(timeout):
+            return None
+        return getReceiveTime() - sendTime
+
+    def _run(self):
+        while self._running:
+            try:
+                data = self._receiveSocket.recv(1)
+            except (socket.timeout, OSError):
+                continue
+            receiveTime = time.monotonic()
+            message = data[0] if data else 0
+            if message & 0b00000001:
+                self._startedTime = receiveTime
+                self._started.set()
+            if message & 0b00000010:
+                self._stoppedTime = receiveTime
+                self._stopped.set()
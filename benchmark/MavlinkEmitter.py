@@ -0,0 +1,167 @@
+import threading
+import time
+import logging
+from pymavlink import mavutil
+
+from SitlInstance import MAVLINK_BASE_PORT
+
+
+class MavlinkEmitter:
+    """
+    Stands in for PX4 SITL: sends the MAVLink stream of an airborne, healthy vehicle to the MAVLink port of every
+    vehicle, at a fixed rate and without any physics.
+
+    Every GLOBAL_POSITION_INT carries a unique latitude, base latitude plus a per-vehicle sample counter in units of
+    1e-7 degrees, and its send time is kept, so a receiver of the resulting pose frames can look up when the sample
+    left the emitter. Likewise the first arrival of every user setpoint forwarded by AvciMaster is timestamped by
+    its north value, which the benchmark sets to the setpoint counter.
+
+    The time_boot_ms of the messages advances speedFactor times as fast as the wall clock, like PX4's boot time in
+    a lockstep simulation running faster than real time. The message rate stays in wall-clock time.
+    """
+
+    BASE_LATITUDE = 399000000
+    BASE_LONGITUDE = 328000000
+    ALTITUDE = 950000
+    RELATIVE_ALTITUDE = 50000
+    HEARTBEAT_PERIOD = 0.1
+    # Flight commands acknowledged without effect, the emitted vehicle is always airborne.
+    ACCEPTED_COMMANDS = frozenset({mavutil.mavlink.MAV_CMD_NAV_TAKEOFF, mavutil.mavlink.MAV_CMD_NAV_LAND,
+                                   mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, mavutil.mavlink.MAV_CMD_DO_SET_MODE})
+    # Number of send times kept per vehicle, older samples can no longer be timed.
+    SEND_TIME_HISTORY = 1 << 16
+
+    def __init__(self, vehicleCount=1, rate=250.0, speedFactor=1.0):
+        """
+        Args:
+            vehicleCount (int): Number of vehicles, vehicle N is sent to MAVLink port 14540 + N.
+            rate (float): GLOBAL_POSITION_INT and ATTITUDE rate in Hz.
+            speedFactor (float): Simulation seconds per wall-clock second of time_boot_ms.
+        """
+        self._vehicleCount = vehicleCount
+        self._period = 1.0 / rate
+        self._speedFactor = speedFactor
+        self._connections = []
+        self._sendTimes = [[0.0] * self.SEND_TIME_HISTORY for _ in range(vehicleCount)]
+        self._sampleCounts = [0] * vehicleCount
+        self._setpointReceiveTimes = [{} for _ in range(vehicleCount)]
+        self._running = False
+        self._thread = None
+
+    def Start(self):
+        for vehicleId in range(self._vehicleCount):
+            connection = mavutil.mavlink_connection(f"udpout:127.0.0.1:{MAVLINK_BASE_PORT + vehicleId}",
+                                                    source_system=1 + vehicleId, source_component=1)
+            self._connections.append(connection)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def Stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+
+    def GetSampleCount(self, vehicleId):
+        """Returns the number of GLOBAL_POSITION_INT samples sent to a vehicle so far."""
+        return self._sampleCounts[vehicleId]
+
+    def GetSampleIndex(self, vehicleId, lat):
+        """Returns the sample counter encoded in a latitude in degrees, or None if it is not an emitted sample."""
+        latitude = lat * 1e7
+        sampleIndex = round(latitude)
+        if abs(latitude - sampleIndex) > 1e-3 or sampleIndex < self.BASE_LATITUDE:
+            return None
+        return sampleIndex - self.BASE_LATITUDE
+
+    def GetSendTime(self, vehicleId, sampleIndex):
+        """Returns the time.monotonic() send time of a sample, or None if it is too old or not sent yet."""
+        if not 0 <= self._sampleCounts[vehicleId] - 1 - sampleIndex < self.SEND_TIME_HISTORY:
+            return None
+        return self._sendTimes[vehicleId][sampleIndex % self.SEND_TIME_HISTORY]
+
+    def TakeSetpointReceiveTimes(self, vehicleId):
+        """
+        Returns the setpoints received by a vehicle since the last call. Arrivals are only noticed once per emitter
+        period, so the times are late by up to one period.
+
+        Returns:
+            dict: Setpoint counter to the time.monotonic() of its first arrival.
+        """
+        receiveTimes = self._setpointReceiveTimes[vehicleId]
+        self._setpointReceiveTimes[vehicleId] = {}
+        return receiveTimes
+
+    def _run(self):
+        startTime = time.monotonic()
+        nextSendTime = startTime
+        nextHeartbeatTime = startTime
+        while self._running:
+            now = time.monotonic()
+            timeBootMs = int((now - startTime) * self._speedFactor * 1e3) & 0xFFFFFFFF
+            sendHeartbeat = now >= nextHeartbeatTime
+            if sendHeartbeat:
+                nextHeartbeatTime += self.HEARTBEAT_PERIOD
+            for vehicleId, connection in enumerate(self._connections):
+                try:
+                    self._HandleCommands(vehicleId, connection)
+                    if sendHeartbeat:
+                        self._SendStatus(connection)
+                    self._SendPose(vehicleId, connection, timeBootMs)
+                except OSError:
+                    pass # Nobody listening on the MAVLink port between runs
+                except Exception as e:
+                    logging.error(f"Error in MavlinkEmitter: {e}")
+
+            nextSendTime += self._period
+            delay = nextSendTime - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                nextSendTime = time.monotonic()
+
+    def _HandleCommands(self, vehicleId, connection):
+        while True:
+            msg = connection.recv_msg()
+            if msg is None:
+                return
+            match msg.get_type():
+                case "SET_POSITION_TARGET_LOCAL_NED":
+                    # Keep-alive repetitions arrive later and do not count
+                    self._setpointReceiveTimes[vehicleId].setdefault(round(msg.x), time.monotonic())
+                case "COMMAND_LONG":
+                    connection.mav.command_ack_send(msg.command, self._HandleCommandLong(msg))
+                case "PARAM_SET":
+                    # Every parameter exists and takes any value
+                    connection.mav.param_value_send(msg.param_id.encode("ascii"), msg.param_value, msg.param_type, 0, 0)
+
+    def _HandleCommandLong(self, msg):
+        """Returns the MAV_RESULT of a command: stream rates of the emitted messages change, flight commands are accepted."""
+        if msg.command in self.ACCEPTED_COMMANDS:
+            return mavutil.mavlink.MAV_RESULT_ACCEPTED
+        if msg.command != mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+            return mavutil.mavlink.MAV_RESULT_UNSUPPORTED
+        if int(msg.param1) in (mavutil.mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT, mavutil.mavlink.MAVLINK_MSG_ID_ATTITUDE) and msg.param2 > 0:
+            self._period = msg.param2 / 1e6
+            return mavutil.mavlink.MAV_RESULT_ACCEPTED
+        return mavutil.mavlink.MAV_RESULT_DENIED
+
+    def _SendStatus(self, connection):
+        connection.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_QUADROTOR, mavutil.mavlink.MAV_AUTOPILOT_PX4,
+                                      mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED | mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                                      0, mavutil.mavlink.MAV_STATE_ACTIVE)
+        connection.mav.extended_sys_state_send(mavutil.mavlink.MAV_VTOL_STATE_UNDEFINED,
+                                               mavutil.mavlink.MAV_LANDED_STATE_IN_AIR)
+
+    def _SendPose(self, vehicleId, connection, timeBootMs):
+        sampleIndex = self._sampleCounts[vehicleId]
+        phase = sampleIndex * self._period
+        self._sendTimes[vehicleId][sampleIndex % self.SEND_TIME_HISTORY] = time.monotonic()
+        connection.mav.global_position_int_send(timeBootMs, self.BASE_LATITUDE + sampleIndex, self.BASE_LONGITUDE,
+                                                self.ALTITUDE, self.RELATIVE_ALTITUDE, 500, 0, 0, 9000)
+        self._sampleCounts[vehicleId] = sampleIndex + 1
+        connection.mav.attitude_send(timeBootMs, 0.01 * (phase % 1.0), 0.0, 1.57, 0.01, 0.0, 0.0)
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import signal
+import platform
+import argparse
+import threading
+import subprocess
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+from SitlOutputPump import SitlOutputPump
+from MavlinkEmitter import MavlinkEmitter
+from FakeUnityEndpoint import FakeUnityEndpoint
+from FakeUserEndpoint import FakeUserEndpoint
+
+WAITING_START_PATTERN = "State changed to: WAITING_START_SIMULATION_MESSAGE_FROM_USER"
+POSE_FILE_PREFIX = "/dev/shm/avcibench-pose"
+
+def ParseArguments(arguments=None):
+    """
+    Parses the benchmark command line options. Unknown options are passed on to avcimaster.py.
+    Returns:
+        tuple: The benchmark settings and the list of avcimaster.py arguments.
+    """
+    parser = argparse.ArgumentParser(description="End-to-end AvciMaster benchmark against local Unity, user and PX4 stand-ins.")
+    parser.add_argument("--vehicle-count", type=int, default=1, help="number of simulated vehicles")
+    parser.add_argument("--cycles", type=int, default=3, help="number of start, measure, stop cycles")
+    parser.add_argument("--duration", type=float, default=5.0, help="pose measurement window of each cycle in seconds")
+    parser.add_argument("--mavlink-rate", type=float, default=250.0, help="position and attitude message rate in Hz")
+    parser.add_argument("--sim-speed-factor", type=float, default=1.0,
+                        help="simulation speed factor of the emitted MAVLink time, also passed to AvciMaster")
+    parser.add_argument("--setpoint-rate", type=float, default=0.0,
+                        help="user position setpoint rate in Hz during the measurement window, 0 sends none")
+    parser.add_argument("--timeout", type=float, default=30.0, help="maximum wait for each protocol step in seconds")
+    parser.add_argument("--pose-transport", choices=["udp", "shm", "both"], default="udp",
+                        help="pose transport AvciMaster is started with, the Unity stand-in reads the matching channels")
+    parser.add_argument("--output", default=None, help="file the JSON results are written to, defaults to stdout")
+    return parser.parse_known_args(arguments)
+
+def Percentile(sortedValues, fraction):
+    """Nearest-rank percentile of an ascending list, None if it is empty."""
+    if not sortedValues:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, max(0, int(round(fraction * len(sortedValues))) - 1))]
+
+def ReadThreadCpuTimes(pid):
+    """
+    Reads the CPU time of every thread of a process from /proc.
+    Returns:
+        dict: Thread id to (thread name, user plus system CPU seconds).
+    """
+    clockTicks = os.sysconf("SC_CLK_TCK")
+    threadCpuTimes = {}
+    taskDirectory = f"/proc/{pid}/task"
+    for tid in os.listdir(taskDirectory):
+        try:
+            with open(os.path.join(taskDirectory, tid, "stat")) as statFile:
+                stat = statFile.read()
+        except OSError:
+            continue # Thread exited meanwhile
+        name = stat[stat.index("(") + 1:stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2:].split()
+        threadCpuTimes[int(tid)] = (name, (int(fields[11]) + int(fields[12])) / clockTicks)
+    return threadCpuTimes
+
+def ReadProcessCpuTime(pid):
+    """Returns the user plus system CPU seconds of a process, including its exited threads."""
+    with open(f"/proc/{pid}/stat") as statFile:
+        stat = statFile.read()
+    fields = stat[stat.rindex(")") + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def DiffThreadCpuTimes(before, after):
+    """Returns the CPU time every thread alive at the end used in between, busiest first."""
+    threads = []
+    for tid, (name, cpuTime) in after.items():
+        previousCpuTime = before.get(tid, (name, 0.0))[1]
+        threads.append({"tid": tid, "name": name, "cpuTime": cpuTime - previousCpuTime})
+    return sorted(threads, key=lambda thread: thread["cpuTime"], reverse=True)
+
+def SummarizePoses(poseStatistics, mavlinkEmitter, sampleCountsBefore, duration):
+    """Builds the pose delivery results of one measurement window."""
+    vehicles = []
+    for vehicleId, statistics in enumerate(poseStatistics):
+        latencies = sorted(statistics.latencies)
+        sentSampleCount = mavlinkEmitter.GetSampleCount(vehicleId) - sampleCountsBefore[vehicleId]
+        expectedSampleCount = 0
+        if statistics.firstSampleIndex is not None:
+            expectedSampleCount = statistics.lastSampleIndex - statistics.firstSampleIndex + 1
+        simSpeedFactor = None
+        if statistics.firstSimTime is not None and statistics.lastReceiveTime > statistics.firstReceiveTime:
+            simSpeedFactor = (statistics.lastSimTime - statistics.firstSimTime) / (statistics.lastReceiveTime - statistics.firstReceiveTime)
+        vehicles.append({
+            "vehicleId": vehicleId,
+            "framesReceived": statistics.frameCount,
+            "invalidFrames": statistics.invalidFrameCount,
+            "frameRate": statistics.frameCount / duration,
+            "samplesSent": sentSampleCount,
+            "samplesReceived": statistics.sampleCount,
+            "samplesDropped": expectedSampleCount - statistics.sampleCount,
+            "simSpeedFactor": simSpeedFactor,
+            "latency": {
+                "p50": Percentile(latencies, 0.50),
+                "p90": Percentile(latencies, 0.90),
+                "p99": Percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+            },
+        })
+    return vehicles
+
+def SummarizeSetpoints(setpointSendTimes, mavlinkEmitter):
+    """Builds the setpoint forwarding results of one measurement window, over all vehicles."""
+    sentCount = 0
+    latencies = []
+    for vehicleId, sendTimes in enumerate(setpointSendTimes):
+        sentCount += len(sendTimes)
+        for setpointIndex, receiveTime in mavlinkEmitter.TakeSetpointReceiveTimes(vehicleId).items():
+            if 0 <= setpointIndex < len(sendTimes):
+                latencies.append(receiveTime - sendTimes[setpointIndex])
+    latencies.sort()
+    return {
+        "sent": sentCount,
+        "received": len(latencies),
+        "latency": {
+            "p50": Percentile(latencies, 0.50),
+            "p99": Percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+def GetCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_DIRECTORY, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+def StartAvciMaster(settings, avcimasterArguments, waitingStart):
+    command = [sys.executable, "-u", os.path.join(REPOSITORY_DIRECTORY, "avcimaster.py"),
+               "--sitl-launch-mode", "external", "--readiness-policy", "heartbeat_ekf_healthy",
+               "--vehicle-count", str(settings.vehicle_count), "--pose-transport", settings.pose_transport,
+               "--pose-file-prefix", POSE_FILE_PREFIX, "--sim-speed-factor", str(settings.sim_speed_factor),
+               # The float32 latitude of legacy frames cannot carry the sample counter, the arguments may still override it
+               "--pose-wire-format", "v1"] + avcimasterArguments
+    process = subprocess.Popen(command, cwd=REPOSITORY_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=subprocess.DEVNULL, text=True, errors="backslashreplace")
+    outputPump = SitlOutputPump()
+    outputPump.AddTrigger(WAITING_START_PATTERN, lambda match: waitingStart.set(), once=False)
+    outputPump.Start(process, "avcimaster")
+    return process, outputPump
+
+def StopAvciMaster(process, outputPump, timeout):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    outputPump.Join(timeout)
+
+def RunCycles(settings, process, mavlinkEmitter, fakeUnity, fakeUser, waitingStart):
+    cycles = []
+    for cycle in range(settings.cycles):
+        if not waitingStart.wait(settings.timeout):
+            raise RuntimeError("AvciMaster did not become ready for a simulation start.")
+        waitingStart.clear()
+
+        startLatency = fakeUser.RequestStart(settings.timeout)
+        if startLatency is None:
+            raise RuntimeError(f"No simulation started message in cycle {cycle}.")
+
+        fakeUnity.TakePoseStatistics()
+        sampleCountsBefore = [mavlinkEmitter.GetSampleCount(vehicleId) for vehicleId in range(settings.vehicle_count)]
+        threadCpuTimesBefore = ReadThreadCpuTimes(process.pid)
+        if settings.setpoint_rate > 0:
+            for vehicleId in range(settings.vehicle_count):
+                mavlinkEmitter.TakeSetpointReceiveTimes(vehicleId)
+            fakeUser.StartSetpoints(settings.vehicle_count, settings.setpoint_rate)
+        time.sleep(settings.duration)
+        setpointSendTimes = fakeUser.StopSetpoints() if settings.setpoint_rate > 0 else None
+        threadCpuTimesAfter = ReadThreadCpuTimes(process.pid)
+        poseStatistics = fakeUnity.TakePoseStatistics()
+
+        stopLatency = fakeUser.RequestStop(settings.timeout)
+        if stopLatency is None:
+            raise RuntimeError(f"No simulation stopped message in cycle {cycle}.")
+
+        cycleResults = {
+            "startLatency": startLatency,
+            "stopLatency": stopLatency,
+            "vehicles": SummarizePoses(poseStatistics, mavlinkEmitter, sampleCountsBefore, settings.duration),
+            "threads": DiffThreadCpuTimes(threadCpuTimesBefore, threadCpuTimesAfter),
+        }
+        if setpointSendTimes is not None:
+            cycleResults["setpoints"] = SummarizeSetpoints(setpointSendTimes, mavlinkEmitter)
+        cycles.append(cycleResults)
+        print(f"Cycle {cycle}: start {startLatency * 1e3:.1f} ms, stop {stopLatency * 1e3:.1f} ms", file=sys.stderr)
+    return cycles
+
+def RunBenchmark(settings, avcimasterArguments):
+    """
+    Runs AvciMaster headless against the stand-ins for the configured number of cycles.
+    Returns:
+        dict: The machine-readable results.
+    """
+    mavlinkEmitter = MavlinkEmitter(settings.vehicle_count, settings.mavlink_rate, settings.sim_speed_factor)
+    poseFilePrefix = POSE_FILE_PREFIX if settings.pose_transport != "udp" else None
+    fakeUnity = FakeUnityEndpoint(mavlinkEmitter, settings.vehicle_count, poseFilePrefix)
+    fakeUser = FakeUserEndpoint()
+    waitingStart = threading.Event()
+    mavlinkEmitter.Start()
+    fakeUnity.Start()
+    fakeUser.Start()
+    process, outputPump = StartAvciMaster(settings, avcimasterArguments, waitingStart)
+    try:
+        cycles = RunCycles(settings, process, mavlinkEmitter, fakeUnity, fakeUser, waitingStart)
+        processCpuTime = ReadProcessCpuTime(process.pid)
+    except Exception:
+        for _, line in outputPump.GetLines()[-50:]:
+            print(line, file=sys.stderr)
+        raise
+    finally:
+        StopAvciMaster(process, outputPump, settings.timeout)
+        fakeUser.Stop()
+        fakeUnity.Stop()
+        mavlinkEmitter.Stop()
+
+    return {
+        "commit": GetCommit(),
+        "python": platform.python_version(),
+        "cpuCount": os.cpu_count(),
+        "settings": vars(settings),
+        "avcimasterArguments": avcimasterArguments,
+        "cycles": cycles,
+        "summary": {
+            "startLatency": {"min": min(cycle["startLatency"] for cycle in cycles),
+                             "max": max(cycle["startLatency"] for cycle in cycles)},
+            "stopLatency": {"min": min(cycle["stopLatency"] for cycle in cycles),
+                            "max": max(cycle["stopLatency"] for cycle in cycles)},
+            "samplesDropped": sum(vehicle["samplesDropped"] for cycle in cycles for vehicle in cycle["vehicles"]),
+            "processCpuTime": processCpuTime,
+        },
+    }
+
+if __name__ == "__main__":
+    benchmarkSettings, avcimasterArguments = ParseArguments()
+    results = RunBenchmark(benchmarkSettings, avcimasterArguments)
+    if benchmarkSettings.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(benchmarkSettings.output, "w") as outputFile:
+            json.dump(results, outputFile, indent=2)